@@ -17,9 +17,14 @@ import sys
 import shutil
 import os
 import copy
-import re
 import textwrap
 
+# The struct definitions are parsed by searchf.py in the util directory which caches the results.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../util'))
+import searchf
+from f90_struct_parser import arg_class, NOT, PTR, ALLOC
+
 ##################################################################################
 ##################################################################################
 # Init
@@ -66,10 +71,6 @@ def indent (string, numspace):
 ##################################################################################
 # Constants
 
-NOT = 'NOT'
-PTR = 'PTR'
-ALLOC = 'ALLOC'
-
 T = True
 F = False
 
@@ -102,33 +103,7 @@ class struct_def_class:
   def __repr__(self):
     return '[name: %s, #arg: %i]' % (self.short_name, len(self.arg))
 
-# arg_class.
-
-class arg_class:
-
-  def __init__(self):
-    self.is_component = True   # Is a structure component? If not, then will be array bound.
-    self.f_name = ''           # Fortran side name of argument. Will be lower case
-    self.c_name = ''           # C++ side name of argument. May be mangled to avoid reserved word conflicts.
-    self.type = ''             # Fortran type without '(...)'. EG: 'real', 'type', 'character', etc.
-    self.kind = ''             # Fortran kind. EG: '', 'rp', 'coord_struct', etc.
-    self.pointer_type = NOT    # NOT, PTR, or ALLOC
-    self.array = []            # EG: [':', ':'] or ['0:6', '3']
-    self.full_array = ''       # EG: '(:,:)', '(0:6, 3)'
-    self.lbound = []
-    self.ubound = []
-    self.init_value = ''       # Initialization value
-    self.comment = ''          # Comment with Fortran structure def.
-    self.f_side = 0
-    self.c_side = 0
-
-  def __repr__(self):
-    return '["%s(%s)", "%s", "%s", %s, "%s"]' % (self.type, self.kind, self.pointer_type, self.f_name, self.array, self.init_value)
-
-  def full_repr(self):
-    return '["%s(%s)", "%s", "%s", %s, "%s" %s %s "%s"]' % (self.type, 
-              self.kind, self.pointer_type, self.f_name, self.array, self.full_array, 
-              self.lbound, self.ubound, self.init_value)
+# arg_class: See util/f90_struct_parser.py
 
 ##################################################################################
 ##################################################################################
@@ -1305,206 +1280,39 @@ for name in params.struct_list:
 ##################################################################################
 # Parse structure definitions
 
-# Examples: 
-#  1) "type(abc), pointer :: a(:,:),b(7) = 23 ! Comment"
-#  2) "integer abc"
-# Notice that only in example 2 is space significant.
-
-# Current restrictions. That is, syntax to avoid:
-#   1) Line continuations: '&'
-#   2) Dimensions: "integer, dimension(7) :: abc"
-#   3) Kind: "integer(kind = 8) abc"
-#   4) Variable inits using "," or "(" characters: "real abc(2) = [1, 2]"
-
-re_end_type = re.compile('^\s*end\s*type')  # Match to: 'end type'
-re_match1 = re.compile('([,(]|::|\s+)')     # Match to: ',', '::', '(', ' '
-re_match2 = re.compile('([=[,(]|::)')       # Match to: ',', '::', '(', '[', '='
-re_contains = re.compile('^\s*contains')    # Match to: 'contains' (indicating type procedures are defined.)
+# The struct definitions are found and the component lines are parsed by searchf.cached_scan.
+# The parse results are kept in the parse cache shared with getf/listf so a file is only parsed
+# again if it has changed. See util/parse_cache.py and util/f90_struct_parser.py.
 
 for file_name in params.struct_def_files:
-  f_module_file = open(file_name)
-
-  for line in f_module_file:
-    split_line = line.lower().split()
-    if len(split_line) < 2: continue
-    if split_line[0] != 'type': continue
+  structs = searchf.cached_scan(file_name, 'structs', save = True)
 
-    found = False
-
-    for struct in struct_definitions:
-      if struct.f_name != split_line[1]: continue
-      found = True
-      break
-
-    if not found: continue
+  for struct in struct_definitions:
+    if struct.f_name not in structs: continue
+    args, notes, errors = structs[struct.f_name]
 
     struct.short_name = struct.f_name[:-7]   # Remove '_struct' suffix
     struct.cpp_class = 'CPP_' + struct.short_name
 
-    # Now collect the struct components
-
-    found_contains_statement = False
-
-    for line in f_module_file:
-      if re_end_type.match(line): break
-      if re_contains.match(line): found_contains_statement = True
-      if found_contains_statement: continue
-
-      print_debug('\nStart: ' + line.strip())
-      base_arg = arg_class()
-
-      part = line.partition('!')
-
-      base_arg.comment = part[2].strip()
-      line = part[0].strip()
-      if len(line) == 0: continue   # Blank line.
-      print_debug('P1: ' + line.strip())
-
-      # Get base_arg.type
-
-      split_line = re_match1.split(line, 1)
-      print_debug('P2: ' + str(split_line))
-      base_arg.type = split_line.pop(0)
-      if base_arg.type == 'integer' and split_line[0][0] == '(': base_arg.type = 'integer8'
-
-      if split_line[0][0] == ' ': 
-        split_line = re_match2.split(split_line[1], 1)
-        if split_line[0] == '': split_line.pop(0)
- 
-      print_debug('P3: ' + str(split_line))
-
-      # Now split_line[0] is a delimiter or component name
-      # Add type information if there is more...
-
-      if split_line[0] == '(':
-        split_line = split_line[1].partition(')')
-        base_arg.kind = split_line[0].strip()
-        split_line = re_match2.split(split_line[2].lstrip(), 1)
-        if split_line[0] == '': split_line.pop(0)   # EG: "real(rp) :: ..."
-
-      print_debug('P4: ' + str(split_line))
-
-      if split_line[0] == ',':
-        split_line = split_line[1].partition('::')
-
-        if split_line[0].strip() == 'allocatable':
-          base_arg.pointer_type = ALLOC
-        elif split_line[0].strip() == 'pointer':
-          base_arg.pointer_type = PTR
+    for note in notes: print(note)
+    if len(errors) > 0:
+      for statement in errors: print('Cannot parse struct component: ' + statement + ' in: ' + struct.f_name)
+      sys.exit()
 
-        split_line = [split_line[2].lstrip()]
+    # Sometimes must avoid reserved words on the C++ side. 
+    # This is handled on a case-by-case basis by params.c_side_name_translation
 
-      if split_line[0] == '::': split_line.pop(0)
-
-      # Join split_line into one string so that we are starting from a definite state.
-
-      if len(split_line) > 1: split_line = [''.join(split_line)]
-      print_debug('P5: ' + str(split_line))
-
-      # Now len(split_line) = 1 and the first word in split_line[0] is the structure component name.
-      # There may be multiple components defined so loop over all instances.
-
-      while True:
-
-        print_debug('L1: ' + str(split_line))
-
-        if len(split_line) > 1:
-          print('Confused parsing of struct component: ' + line.strip() + ' in: ' + struct.f_name)
-
-        split_line = re_match2.split(split_line[0], 1)
-
-        print_debug('L2: ' + str(split_line))
-
-        arg = copy.deepcopy(base_arg)
-        arg.f_name = split_line.pop(0).strip().lower()
-
-        # Sometimes must avoid reserved words on the C++ side. 
-        # This is handled on a case-by-case basis by params.c_side_name_translation
-
-        full_name = struct.f_name + '%' + arg.f_name
-        if full_name in params.c_side_name_translation:
-          arg.c_name = params.c_side_name_translation[full_name]
-        else:
-          arg.c_name = arg.f_name
-
-        if len(split_line) == 0: 
-          struct.arg.append(arg)        
-          break
-
-        # Get array bounds
-
-        if split_line[0] == '(':
-          split_line = split_line[1].lstrip().partition(')')
-          arg.full_array = '(' + split_line[0].strip().replace(' ', '') + ')'
-          arg.array = arg.full_array[1:-1].split(',')
-          print_debug('L2p1: ' + str(split_line))
-          split_line = re_match2.split(split_line[2].lstrip(), 1)
-          print_debug('L2p2: ' + str(split_line))
-          if split_line[0] == '': split_line.pop(0)  # Needed for EG: "integer aaa(5)"
-
-          if arg.array[0] != ':':   # If has explicit bounds...
-            for dim in arg.array:
-              if ':' in dim:
-                arg.lbound.append(dim.partition(':')[0])
-                arg.ubound.append(dim.partition(':')[2])
-              else:
-                arg.lbound.append('1')
-                arg.ubound.append(dim)
-
-        print_debug('L3: ' + str(split_line))
-
-        if len(split_line) == 0: 
-          struct.arg.append(arg)        
-          break
-
-        # Get initial value
-
-        if split_line[0] == '=':
-          split_line = re_match2.split(split_line[1].lstrip(), 1)
-          print_debug('L3p1: ' + str(split_line))
-
-          # If have EG: "b(2) = [3, 4], c => null()" need to 
-          # combine back "(...)" or "[...]" construct which is part of init string.
-
-          if len(split_line) > 1 and (split_line[1] == '(' or split_line[1] == '['):
-            split0 = split_line[0] + split_line[1]
-            n_parens = 1
-            for ix, char in enumerate(split_line[2]):
-              split0 = split0 + char
-              if char == '(' or char == '[': n_parens = n_parens + 1
-              if char == ')' or char == ']': n_parens = n_parens - 1
-              if n_parens == 0: break
-            split1 = split_line[2][ix+1:]
-            if split1 == '':
-              split_line = [split0]
-            elif split1[0] == ',':
-              split_line = [split0, ',', split1[1:]]
-            else:
-              print ('?????')
-              sys.exit()
-
-          print_debug('L3p2: ' + str(split_line))
-
-          arg.init_value = split_line[0]
-          if len(split_line) == 1:
-            split_line[0] = ''
-          else:
-            split_line.pop(0)
-
-        print_debug('L4: ' + str(split_line))
-
-        struct.arg.append(arg)        
-        if len(split_line) == 0 or split_line[0] == '': break
-
-        if split_line[0] != ',':
-          print('Expected "," while parsing: ' + line.strip()  + ' in: ' + struct.f_name)
-
-        split_line.pop(0)
+    for arg in args:
+      print_debug('Arg: ' + arg.full_repr())
+      full_name = struct.f_name + '%' + arg.f_name
+      if full_name in params.c_side_name_translation:
+        arg.c_name = params.c_side_name_translation[full_name]
+      else:
+        arg.c_name = arg.f_name
+      struct.arg.append(arg)
 
   # End of parsing
 
-  f_module_file.close()
-
 ##################################################################################
 ##################################################################################
 # Add Fortran and C++ side translation info.
@@ -0,0 +1,12 @@
+#+
+# Pytest configuration so that the regression tests can be run with:
+#   python -m pytest TESTS.LIST {-n <num_workers>} {--bmad-bin <bin_dir>}
+# from this directory. See scripts/bmad_regression/pytest_plugin.py.
+#-
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+
+pytest_plugins = ['bmad_regression.pytest_plugin']
@@ -0,0 +1,13 @@
+#+
+# Bmad regression test library.
+#
+# Provides the "output.now" / "output.correct" comparison, the TESTS.LIST parser and the runner
+# for one regression subdirectory so that these can be used outside of scripts/run_tests.py.
+# See pytest_plugin.py for running the regression tests under pytest.
+#-
+
+from .compare import compare_files, compare_result_class
+from .tests_list import strip_test_line, test_line_subdir, is_note_line, read_test_list
+from .runner import test_result_class, program_run_class, print_terminal, output_result, \
+                    normalize_bin_dir, run_test_dir, run_test_dir_captured
+from .report import result_record, json_stream_class, write_junit
@@ -0,0 +1,198 @@
+#+
+# Cache of regression test program output so that a regression subdirectory is not rerun if neither
+# its input files nor the program(s) it runs have changed.
+#
+# The cache for a subdirectory "zzz" is in <cache_dir>/zzz/ and holds a copy of "output.now" along
+# with the file "entry.json" containing:
+#   key         ! Hash of the programs run, the shared libraries they use and all the input files of the subdirectory.
+#   generated   ! Files created or modified by the last run of the program. These are not inputs.
+# The input files are all files in the subdirectory (including files in lower directories) except
+# "output.now" and the generated files. The comparison with "output.correct" is always redone.
+#
+# The programs are normally linked with the shared Bmad libraries (ACC_ENABLE_SHARED_ONLY = "Y") so
+# a change to a library alone does not change the programs. The key therefore also covers all the shared
+# libraries in the build "lib" directory next to the "bin" directory, the shared libraries the programs
+# are linked to as found by ldd, and, for run.py scripts that use pytao, the pytao shared libraries.
+#-
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import importlib.util
+import subprocess
+
+cache_version = 2     # Increment if the key computation changes.
+
+#----------------------------------------------------------
+# Return a dict of relative file name -> (size, modification time) for all files in a directory tree.
+
+def dir_file_stats(sub_path):
+  stats = {}
+  for dir_path, dir_names, file_names in os.walk(sub_path):
+    dir_names.sort()
+    for name in file_names:
+      full_name = os.path.join(dir_path, name)
+      try:
+        st = os.stat(full_name)
+      except OSError:
+        continue
+      stats[os.path.relpath(full_name, sub_path)] = (st.st_size, st.st_mtime_ns)
+  return stats
+
+# Files that are new or changed in stats_after compared to stats_before.
+
+def generated_files(stats_before, stats_after):
+  return sorted(name for name, stat in stats_after.items() if stats_before.get(name) != stat)
+
+#----------------------------------------------------------
+# Return the list of programs that a regression subdirectory runs along with the shared libraries
+# that they use. For a subdirectory with a run.py script, the programs are the files in bin_dir whose
+# names appear in run.py. program is the program run when there is no run.py script.
+
+def programs_used(sub_path, bin_dir, program):
+  bin_path = os.path.join(sub_path, os.path.expandvars(bin_dir))
+
+  if not os.path.isfile(os.path.join(sub_path, 'run.py')):
+    programs = [os.path.join(sub_path, os.path.expandvars(program))]
+    uses_pytao = False
+  else:
+    with open(os.path.join(sub_path, 'run.py'), 'r', errors = 'replace') as f:
+      words = set(re.findall(r'[\w.+-]+', f.read()))
+    programs = []
+    if os.path.isdir(bin_path):
+      programs = [os.path.join(bin_path, name) for name in sorted(os.listdir(bin_path)) if name in words]
+    uses_pytao = 'pytao' in words
+
+  libs = set(shared_libs_in(os.path.join(bin_path, '..', 'lib')))
+  for prog in programs:
+    libs.update(linked_libs(prog))
+  if uses_pytao: libs.update(pytao_libs())
+
+  return programs + sorted(libs)
+
+#----------------------------------------------------------
+# Shared library helper functions.
+
+def is_shared_lib(name):
+  return name.endswith('.so') or '.so.' in name or name.endswith('.dylib')
+
+# All shared libraries in a directory tree.
+
+def shared_libs_in(lib_path):
+  lib_path = os.path.normpath(lib_path)
+  if not os.path.isdir(lib_path): return []
+  libs = []
+  for dir_path, dir_names, file_names in os.walk(lib_path):
+    libs += [os.path.join(dir_path, name) for name in file_names if is_shared_lib(name)]
+  return libs
+
+# Shared libraries a program is linked to as reported by ldd. Empty if ldd is not available.
+
+linked_libs_memo = {}
+
+def linked_libs(program):
+  if program in linked_libs_memo: return linked_libs_memo[program]
+  libs = []
+  try:
+    proc = subprocess.run(['ldd', program], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, timeout = 60)
+    for line in proc.stdout.decode(errors = 'replace').splitlines():
+      match = re.search(r'(?:=>\s*)?(/\S+)\s+\(0x', line)
+      if match and os.path.isfile(match.group(1)): libs.append(os.path.realpath(match.group(1)))
+  except (OSError, subprocess.SubprocessError):
+    pass
+  linked_libs_memo[program] = libs
+  return libs
+
+# Shared libraries of the pytao package. pytao loads the Tao library at run time.
+
+def pytao_libs():
+  try:
+    spec = importlib.util.find_spec('pytao')
+  except (ImportError, ValueError):
+    return []
+  if spec is None or spec.submodule_search_locations is None: return []
+  libs = []
+  for location in spec.submodule_search_locations:
+    libs += shared_libs_in(location)
+  return libs
+
+#----------------------------------------------------------
+
+def update_hash(hasher, file_name):
+  with open(file_name, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      hasher.update(chunk)
+
+# Hash of a program or library file. The same libraries are used by most subdirectories so
+# hashes are remembered as long as the file size and modification time do not change.
+
+file_digest_memo = {}
+
+def file_digest(file_name):
+  st = os.stat(file_name)
+  memo_key = (os.path.realpath(file_name), st.st_size, st.st_mtime_ns)
+  if memo_key not in file_digest_memo:
+    hasher = hashlib.sha256()
+    update_hash(hasher, file_name)
+    file_digest_memo[memo_key] = hasher.hexdigest()
+  return file_digest_memo[memo_key]
+
+# Hash of the programs, shared libraries and the input files of a regression subdirectory.
+
+def input_key(sub_path, programs, generated):
+  hasher = hashlib.sha256()
+  hasher.update(('version %d\0' % cache_version).encode())
+
+  for program in programs:
+    hasher.update(('program %s %s\0' % (os.path.basename(program), file_digest(program))).encode())
+
+  exclude = set(generated)
+  exclude.add('output.now')
+  for name in sorted(dir_file_stats(sub_path)):
+    if name in exclude: continue
+    hasher.update(('file %s\0' % name).encode())
+    update_hash(hasher, os.path.join(sub_path, name))
+
+  return hasher.hexdigest()
+
+#----------------------------------------------------------
+# If the cache has an entry for the subdirectory whose key matches the current inputs, copy the
+# cached "output.now" into the subdirectory and return True. Otherwise return False.
+
+def cache_lookup(cache_dir, subdir, sub_path, programs):
+  entry_dir = os.path.join(cache_dir, subdir)
+  try:
+    with open(os.path.join(entry_dir, 'entry.json'), 'r') as f:
+      entry = json.load(f)
+  except (OSError, ValueError):
+    return False
+
+  if not os.path.isfile(os.path.join(entry_dir, 'output.now')): return False
+
+  try:
+    if entry['key'] != input_key(sub_path, programs, entry['generated']): return False
+  except (OSError, KeyError):
+    return False
+
+  shutil.copyfile(os.path.join(entry_dir, 'output.now'), os.path.join(sub_path, 'output.now'))
+  return True
+
+# Save the "output.now" of a program run in the cache.
+# stats_before is the result of dir_file_stats for the subdirectory just before the program was run.
+
+def cache_store(cache_dir, subdir, sub_path, programs, stats_before):
+  generated = generated_files(stats_before, dir_file_stats(sub_path))
+  entry = {'key': input_key(sub_path, programs, generated), 'generated': generated}
+
+  # The old entry is removed first and the new entry is written last so that an interrupted store
+  # never leaves an entry whose key does not go with the cached "output.now".
+  entry_dir = os.path.join(cache_dir, subdir)
+  os.makedirs(entry_dir, exist_ok = True)
+  if os.path.exists(os.path.join(entry_dir, 'entry.json')): os.remove(os.path.join(entry_dir, 'entry.json'))
+  shutil.copyfile(os.path.join(sub_path, 'output.now'), os.path.join(entry_dir, 'output.now'))
+
+  with open(os.path.join(entry_dir, 'entry.json.tmp'), 'w') as f:
+    json.dump(entry, f)
+  os.replace(os.path.join(entry_dir, 'entry.json.tmp'), os.path.join(entry_dir, 'entry.json'))
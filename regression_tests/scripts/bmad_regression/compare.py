@@ -0,0 +1,318 @@
+#+
+# Comparison of the "output.now" file generated by a regression test program with the "output.correct" file.
+# See the regression_tests/README file for the syntax of these files.
+#
+# Both files are read and split into specification lines once. Lines that are textually identical
+# only get the syntax checks. The numbers on all other REL, ABS and VEC_REL lines are put into flat
+# arrays and the tolerances are evaluated in bulk using NumPy. If NumPy is not available, the same
+# evaluation is done line by line.
+#-
+
+import math
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+#----------------------------------------------------------
+# Result of comparing two files.
+# messages is a list of [string, terminate, color, failing] entries with the same meaning as the
+# arguments of the print_all function in runner.py.
+# failures is a list of dicts, one for each failed line, in line order. Keys:
+#   line        ! Specification line number (1 = first line that is not blank or a comment).
+#   id          ! Identification string.
+#   type        ! 'STR', 'REL', 'ABS' or 'VEC_REL'.
+#   index       ! Datum number on the line (1 = first) of the worst datum.
+#   now         ! Datum from "output.now" (string).
+#   correct     ! Datum from "output.correct" (string).
+#   tolerance   ! Tolerance. Not present for STR.
+#   diff        ! |now - correct| for the worst datum. Not present for STR.
+#   diff_over_val ! diff / average absolute value. Not present for STR.
+# margins is a dict of ID string -> margin for the REL, ABS and VEC_REL lines. The margin of a line
+# is the largest value of |now - correct| / (allowed difference) for the data on the line so a
+# line fails if its margin is above 1. Lines with zero margin are not included.
+
+class compare_result_class:
+  def __init__(self):
+    self.messages = []
+    self.num_tests = 0
+    self.num_failures = 0
+    self.failures = []
+    self.margins = {}
+
+  def add(self, string, terminate = False, color = False, failing = False):
+    self.messages.append([string, terminate, color, failing])
+
+# A REL, ABS or VEC_REL line whose numbers are to be checked.
+
+class real_line_class:
+  def __init__(self, id_str, now_end, correct_vals, line_num):
+    # The "output.now" number strings are now_end[2:]. They are not copied to save time.
+    self.id_str = id_str              # Identification string.
+    self.line_num = line_num          # Specification line number.
+    self.now_end = now_end            # Split of the line after the ID. EG: ['REL', '1e-6', '0.23', ...]
+    self.tol_type = now_end[0]        # 'REL', 'ABS' or 'VEC_REL'
+    self.tol_val = float(now_end[1])
+    self.correct_vals = correct_vals  # List of strings from "output.correct"
+    self.bad_at = -1                  # Index of worst datum out of tolerance. -1 if none.
+    self.bad_diff_val = 0.0
+    self.bad_abs_val = 0.0
+
+#----------------------------------------------------------
+# Return the specification lines of a file. Blank lines and comment lines are dropped.
+
+def spec_lines(file_name):
+  with open(file_name, 'r') as f:
+    lines = f.read().split('\n')
+
+  spec = []
+  for line in lines:
+    line = line.strip()
+    if line != '' and line[0] != '!': spec.append(line)
+  return spec
+
+#----------------------------------------------------------
+# Convert "output.now" number strings to floats. Numbers that cannot be converted are set to 1e100
+# so that they fail.
+
+def now_float(string):
+  try:
+    return float(string)
+  except ValueError:
+    return 1e100
+
+#----------------------------------------------------------
+# Compare the numbers of all lines in real_list.
+# For each line, find the datum with the largest difference among the data that are out of tolerance.
+# Returns a list of the margins of the lines (see compare_result_class).
+
+def evaluate_real_lines(real_list):
+  if len(real_list) == 0: return []
+
+  if np is None:
+    return [evaluate_real_line(rl) for rl in real_list]
+
+  now_strs = [val for rl in real_list for val in rl.now_end[2:]]
+  correct_strs = [val for rl in real_list for val in rl.correct_vals]
+
+  try:
+    now = np.array(now_strs, dtype = float)
+  except ValueError:
+    now = np.array([now_float(val) for val in now_strs], dtype = float)
+
+  try:
+    correct = np.array(correct_strs, dtype = float)
+  except ValueError:
+    correct = np.array([float(val) for val in correct_strs], dtype = float)
+
+  with np.errstate(invalid = 'ignore', over = 'ignore', divide = 'ignore'):
+    return evaluate_arrays(real_list, now, correct).tolist()
+
+# Evaluate the flattened arrays of numbers. See evaluate_real_lines.
+
+def evaluate_arrays(real_list, now, correct):
+  n_vals = np.array([len(rl.correct_vals) for rl in real_list])
+  starts = np.concatenate(([0], np.cumsum(n_vals)[:-1]))
+
+  diff = np.abs(now - correct)
+  abs_val = (np.abs(now) + np.abs(correct)) / 2
+
+  is_rel = np.repeat([rl.tol_type == 'REL' for rl in real_list], n_vals)
+  is_vec_rel = np.repeat([rl.tol_type == 'VEC_REL' for rl in real_list], n_vals)
+  tol = np.repeat([rl.tol_val for rl in real_list], n_vals)
+  vec_amp = np.repeat(np.sqrt(np.add.reduceat(abs_val**2, starts)), n_vals)
+
+  factor = np.where(is_rel, abs_val, np.where(is_vec_rel, vec_amp, 1.0))
+  bad = (diff > factor * tol) & (diff > 0)
+  margin = np.where(diff > 0, diff / (factor * tol), 0.0)
+  bad_diff = np.where(bad, diff, -1.0)
+  worst = np.maximum.reduceat(bad_diff, starts)
+
+  for il in np.nonzero(worst > 0)[0]:
+    rl = real_list[il]
+    i0 = starts[il]
+    ix = int(np.argmax(bad_diff[i0:i0+n_vals[il]]))
+    rl.bad_at = ix
+    rl.bad_diff_val = float(diff[i0+ix])
+    rl.bad_abs_val = float(abs_val[i0+ix])
+
+  return np.maximum.reduceat(margin, starts)
+
+# Line by line version of evaluate_real_lines used when NumPy is not available.
+
+def evaluate_real_line(rl):
+  now = [now_float(val) for val in rl.now_end[2:]]
+  correct = [float(val) for val in rl.correct_vals]
+  abs_val = [(abs(n) + abs(c)) / 2 for n, c in zip(now, correct)]
+
+  if rl.tol_type == 'VEC_REL':
+    vec_amp = math.sqrt(sum(a**2 for a in abs_val))
+
+  margin = 0.0
+  for ix, (now_val, correct_val) in enumerate(zip(now, correct)):
+    diff_val = abs(now_val - correct_val)
+    factor = 1
+    if rl.tol_type == 'REL': factor = abs_val[ix]
+    if rl.tol_type == 'VEC_REL': factor = vec_amp
+
+    if diff_val > factor * rl.tol_val and diff_val > rl.bad_diff_val:
+      rl.bad_at = ix
+      rl.bad_diff_val = diff_val
+      rl.bad_abs_val = abs_val[ix]
+
+    if diff_val > 0:
+      allowed = factor * rl.tol_val
+      margin = max(margin, diff_val / allowed if allowed != 0 else math.inf)
+
+  return margin
+
+#----------------------------------------------------------
+# Compare "output.now" with "output.correct" and return a compare_result_class instance.
+#
+# The files are first checked line by line for structural problems (mismatched ID strings,
+# bad syntax, etc.) which, like string comparisons, are cheap. Messages are accumulated in
+# "items" which is a list whose entries are either a list of messages or, for a REL, ABS,
+# or VEC_REL line, a real_line_class instance whose messages are generated after all the
+# numbers have been evaluated together.
+
+def compare_files(now_file_name, correct_file_name):
+  result = compare_result_class()
+  now_lines = spec_lines(now_file_name)
+  correct_lines = spec_lines(correct_file_name)
+
+  items = []
+  real_list = []
+
+  def add(string, terminate = False, color = False, failing = False):
+    if len(items) == 0 or not isinstance(items[-1], list): items.append([])
+    items[-1].append([string, terminate, color, failing])
+
+  il = 0
+  while True:
+
+    if il >= len(now_lines) or il >= len(correct_lines):
+      add ('')
+      if il < len(now_lines):
+        add ('     Confusion! End of "output.correct" reached before End of "output.now"', True, True, True)
+      if il < len(correct_lines):
+        add ('     Confusion! End of "output.now" reached before End of "output.correct"', True, True, True)
+      break
+
+    now_line = now_lines[il]
+    correct_line = correct_lines[il]
+    il += 1
+
+    now_split = now_line.split('"', 2)
+    correct_split = correct_line.split('"', 2)
+
+    if now_split[0] != '' or len(now_split) != 3:
+      add ('     Cannot parse line from "output.now": ' + now_line, True, True, True)
+      break
+
+    if correct_split[0] != '' or len(correct_split) != 3:
+      add ('     Cannot parse line from "output.correct": ' + correct_line, True, True, True)
+      break
+
+    if now_split[1] != correct_split[1]:
+      add ('     Identification string for a line in "output.now":    ' + now_split[1], False, True, True)
+      add ('     Does not match corresponding ID in "output.correct": ' + correct_split[1], True, True, True)
+
+    now_end = now_split[2].split()
+    data_id = now_end[0] if len(now_end) > 0 else ''
+
+    result.num_tests += 1
+
+    #----------------------------------------------
+    # String test
+
+    if data_id == 'STR':
+      now2_split = now_split[2].split('"')
+      correct2_split = correct_split[2].split('"')[1:]
+
+      if len(now2_split) < 2:
+        add ('     Bad line line "output.now": ' + now_line, True, True, True)
+        break
+
+      now2_split.pop(0)    # Get rid of STR item.
+
+      if len(now2_split) != len(correct2_split):
+        add ('     Number of components in "output.now" line: ' + now_line, False, True, True)
+        add ('     Does not match number in "output.correct:  ' + correct_line, True, True, True)
+        break
+
+      # The split list alternates between the strings and the separators between them so
+      # string number n (counting from 1) is at index 2*(n-1).
+
+      for ix, (now1, correct1) in enumerate(zip(now2_split, correct2_split)):
+        if now1 != correct1:
+          datum = ix//2 + 1
+          add ('')
+          if len(now2_split) == 2:     # Will always have blank item in list.
+            add ('     Regression test failed:', color = True)
+          else:
+            add ('     Regression test failed for datum number: ' + str(datum), color = True)
+          add ('          Line from "output.now": ' + now_line, color = True)
+          add ('          Line from "output.correct": ' + correct_line, color = True)
+          result.num_failures += 1
+          result.failures.append({'line': il, 'id': now_split[1], 'type': 'STR', 'index': datum,
+                                  'now': now1, 'correct': correct1})
+          break
+
+    #----------------------------------------------
+    # Real test
+
+    elif data_id == 'ABS' or data_id == 'REL' or data_id == 'VEC_REL':
+      if len(now_end) < 3:
+        add ('     Bad line in "output.now": ' + now_line, True, True, True)
+        break
+
+      if now_line == correct_line: continue   # Identical lines cannot fail.
+
+      correct2_split = correct_split[2].split()[2:]   # [2:] -> Throw away EG: "ABS 2E-7"
+
+      if len(now_end) - 2 != len(correct2_split):
+        add ('     Number of components in "output.now" line: ' + now_line, False, True, True)
+        add ('     Does not match number in "output.correct:  ' + correct_line, True, True, True)
+        break
+
+      rl = real_line_class(now_split[1], now_end, correct2_split, il)
+      items.append(rl)
+      real_list.append(rl)
+
+    #----------------------------------------------
+    # Error test
+
+    else:
+      add ('     Bad data ID string in "output.now" file: ' + now_line, False, True, True)
+      add ('     Should be one of: STR, REL, or ABS.', True, True, True)
+      break
+
+  #----------------------------------------------
+  # Evaluate the numbers and assemble the messages in line order.
+
+  for rl, margin in zip(real_list, evaluate_real_lines(real_list)):
+    if margin > 0: result.margins[rl.id_str] = max(margin, result.margins.get(rl.id_str, 0.0))
+
+  for item in items:
+    if isinstance(item, list):
+      result.messages += item
+      continue
+
+    rl = item
+    if rl.bad_at == -1: continue
+    result.add ('')
+    result.add ('     Regression test failed for: "' + rl.id_str + '"   ' + rl.now_end[0] + '   ' + rl.now_end[1], color = True)
+    if len(rl.correct_vals) != 1:
+      result.add ('     Regression test failed for datum number: ' + str(rl.bad_at+1), color = True)
+    result.add ('        Data from "output.now":     ' + str(rl.now_end[2:]), color = True)
+    result.add ('        Data from "output.correct": ' + str(rl.correct_vals), color = True)
+    result.add ('        Diff: ' + str(rl.bad_diff_val) + '  Diff/Val: ' + str(abs(rl.bad_diff_val) / rl.bad_abs_val), color = True)
+    result.num_failures += 1
+    result.failures.append({'line': rl.line_num, 'id': rl.id_str, 'type': rl.tol_type, 'index': rl.bad_at + 1,
+                            'now': rl.now_end[2+rl.bad_at], 'correct': rl.correct_vals[rl.bad_at],
+                            'tolerance': rl.tol_val, 'diff': rl.bad_diff_val,
+                            'diff_over_val': abs(rl.bad_diff_val) / rl.bad_abs_val})
+
+  result.failures.sort(key = lambda failure: failure['line'])
+  return result
@@ -0,0 +1,79 @@
+#+
+# Pytest plugin to run the Bmad regression tests.
+#
+# Each regression subdirectory listed in a TESTS.LIST file becomes a separate pytest test so that
+# the tests can be selected with "-k" and distributed with pytest-xdist ("-n <num_workers>").
+# Example, from the regression_tests directory where conftest.py loads this plugin:
+#   python -m pytest TESTS.LIST -n 8 {--bmad-bin <bin_dir>}
+# Elsewhere, put regression_tests/scripts in PYTHONPATH and use "-p bmad_regression.pytest_plugin".
+#
+# A TESTS.LIST file is only collected if it is explicitly named on the command line so that a
+# plain pytest run over the source tree does not start the regression programs.
+#-
+
+import pytest
+
+from .tests_list import read_test_list, test_line_subdir, is_note_line, strip_test_line
+from .runner import normalize_bin_dir, run_test_dir
+
+#----------------------------------------------------------
+
+def pytest_addoption(parser):
+  group = parser.getgroup('bmad', 'Bmad regression tests')
+  group.addoption('--bmad-bin', default = '../production/bin',
+                  help = 'Directory with the regression test programs. Relative to the TESTS.LIST directory. '
+                         'Default: ../production/bin')
+  group.addoption('--bmad-timeout', type = float, default = 3600.0,
+                  help = 'Time limit in seconds for each regression program. 0 = No limit. Default: 3600')
+
+def pytest_collect_file(parent, file_path):
+  if file_path.name == 'TESTS.LIST' and parent.session.isinitpath(file_path):
+    return test_list_file_class.from_parent(parent, path = file_path)
+  return None
+
+#----------------------------------------------------------
+# A TESTS.LIST file. Notes in the file are not tests and are skipped.
+# A line with no subdirectory is named by the line itself so that it fails when run.
+
+class test_list_file_class(pytest.File):
+  def collect(self):
+    for test_dir in read_test_list(self.path):
+      if is_note_line(test_dir): continue
+      subdir = test_line_subdir(test_dir)
+      if subdir == '': subdir = strip_test_line(test_dir)
+      yield regression_item_class.from_parent(self, name = subdir, test_dir = test_dir)
+
+# One regression subdirectory.
+
+class regression_item_class(pytest.Item):
+  def __init__(self, *, test_dir, **kwargs):
+    super().__init__(**kwargs)
+    self.test_dir = test_dir
+
+  def runtest(self):
+    bin_dir = normalize_bin_dir(self.config.getoption('bmad_bin'))
+    timeout = self.config.getoption('bmad_timeout')
+    if timeout <= 0: timeout = None
+    result = run_test_dir(self.test_dir, bin_dir, capture = True, root_dir = str(self.path.parent),
+                          timeout = timeout)
+
+    self.user_properties.append(('num_tests', result.num_tests))
+    self.user_properties.append(('num_failures', result.num_failures))
+    self.user_properties.append(('num_flow_failures', result.num_flow_failures))
+
+    if not result.passed: raise regression_failure_class(result)
+
+  def repr_failure(self, excinfo):
+    if isinstance(excinfo.value, regression_failure_class):
+      return '\n'.join(string for [string, color, to_results_file] in excinfo.value.result.lines)
+    return super().repr_failure(excinfo)
+
+  def reportinfo(self):
+    return self.path, None, 'regression: ' + self.name
+
+# Raised when a regression subdirectory fails. The result holds the output of the test.
+
+class regression_failure_class(Exception):
+  def __init__(self, result):
+    super().__init__(result.subdir)
+    self.result = result
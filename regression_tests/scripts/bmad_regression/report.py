@@ -0,0 +1,92 @@
+#+
+# Machine readable output of regression test results.
+#
+# json_stream_class writes one JSON record per regression subdirectory to a file as soon as the
+# subdirectory has finished so that the file can be read while a long run is in progress.
+# write_junit writes a JUnit XML summary at the end of a run for CI systems.
+#-
+
+import json
+import time
+import socket
+import xml.etree.ElementTree as ET
+
+#----------------------------------------------------------
+# Return a dict with the results for a regression subdirectory.
+# Notes in the TESTS.LIST file (results with no subdirectory) return None.
+
+def result_record(result):
+  if result.subdir == '': return None
+
+  record = {'test': result.subdir, 'passed': result.passed, 'num_tests': result.num_tests,
+            'num_failures': result.num_failures, 'max_fail': result.max_fail,
+            'num_flow_failures': result.num_flow_failures, 'num_timeouts': result.num_timeouts,
+            'cached': result.cached, 'duration': None if result.duration is None else round(result.duration, 3),
+            'flow_messages': result.flow_messages, 'failures': result.failures}
+
+  if result.run is not None and result.run.user_cpu is not None:
+    record['max_rss_mb'] = round(result.run.max_rss_mb, 1)
+    record['user_cpu'] = round(result.run.user_cpu, 3)
+    record['sys_cpu'] = round(result.run.sys_cpu, 3)
+    if result.run.rss_floor_mb is not None: record['rss_floor_mb'] = round(result.run.rss_floor_mb, 1)
+
+  return record
+
+#----------------------------------------------------------
+# JSON-lines results file. The file is flushed after each record.
+
+class json_stream_class:
+  def __init__(self, file_name):
+    self.file = open(file_name, 'w')
+    self.run_time = time.strftime('%Y-%m-%dT%H:%M:%S')
+    self.host = socket.gethostname()
+
+  def write(self, result):
+    record = result_record(result)
+    if record is None: return
+    record['run'] = self.run_time
+    record['host'] = self.host
+    self.file.write(json.dumps(record) + '\n')
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+#----------------------------------------------------------
+# Write a JUnit XML file with one testcase per regression subdirectory.
+# Failed comparisons are reported as failures and flow failures (including timeouts) as errors.
+
+def write_junit(file_name, result_list, duration):
+  records = [record for record in (result_record(result) for result in result_list) if record is not None]
+  suite = ET.Element('testsuite', name = 'bmad_regression', tests = str(len(records)),
+                     failures = str(sum(1 for r in records if not r['passed'] and r['num_flow_failures'] == 0)),
+                     errors = str(sum(1 for r in records if r['num_flow_failures'] > 0)),
+                     time = '%.3f' % duration, hostname = socket.gethostname(),
+                     timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+  for result, record in zip([r for r in result_list if r.subdir != ''], records):
+    case = ET.SubElement(suite, 'testcase', classname = 'regression', name = record['test'],
+                         time = '%.3f' % (record['duration'] or 0.0))
+
+    if record['num_flow_failures'] > 0:
+      error_type = 'timeout' if record['num_timeouts'] > 0 else 'flow_failure'
+      ET.SubElement(case, 'error', type = error_type, message = '; '.join(record['flow_messages']))
+
+    elif not record['passed']:
+      message = '%d of %d tests failed (%d allowed)' % (record['num_failures'], record['num_tests'], record['max_fail'])
+      failure = ET.SubElement(case, 'failure', type = 'comparison', message = message)
+      failure.text = '\n'.join(junit_failure_line(f) for f in record['failures'])
+
+    output = ET.SubElement(case, 'system-out')
+    output.text = '\n'.join(string for [string, color, to_results_file] in result.lines if to_results_file)
+
+  ET.ElementTree(suite).write(file_name, encoding = 'utf-8', xml_declaration = True)
+
+# One line description of a failed datum for the JUnit file.
+
+def junit_failure_line(failure):
+  line = '"%s" %s datum %d: now = %s  correct = %s' % (failure['id'], failure['type'], failure['index'],
+                                                         failure['now'], failure['correct'])
+  if 'diff' in failure:
+    line += '  diff = %g  diff/val = %g  tolerance = %g' % (failure['diff'], failure['diff_over_val'], failure['tolerance'])
+  return line
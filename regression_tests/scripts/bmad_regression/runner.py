@@ -0,0 +1,376 @@
+#+
+# Running the regression test program of one regression subdirectory and comparing its output.
+#-
+
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+from .compare import compare_files
+from .cache import dir_file_stats, programs_used, cache_lookup, cache_store
+from .tests_list import strip_test_line, test_line_subdir, split_test_line
+
+warning_color = '\033[91m\033[1m'   # Red + Bold
+normal_color = '\033[0m'
+
+#----------------------------------------------------------
+# Class to hold the results of running the tests in one regression subdirectory.
+# The lines destined for "regression.results" are accumulated in the lines list so that,
+# when tests are run in parallel, the per-test blocks can be written in TESTS.LIST order.
+
+class test_result_class:
+  def __init__(self, subdir = '', echo = True):
+    self.subdir = subdir
+    self.echo = echo              # Print lines to the terminal as they are generated?
+    self.lines = []               # List of [string, color, to_results_file] entries.
+    self.max_fail = 0
+    self.num_tests = 0
+    self.num_failures = 0
+    self.num_flow_failures = 0
+    self.num_timeouts = 0         # Timeouts are also counted as flow failures.
+    self.passed = True
+    self.duration = None          # Wall clock time in seconds. None if no program was run.
+    self.cached = False           # True if the program was not run since a cached output.now was used.
+    self.run = None               # program_run_class instance. None if no program was run.
+    self.failures = []            # Failed datum details. See compare_result_class in compare.py.
+    self.flow_messages = []       # Messages that caused a flow failure.
+    self.margins = {}             # Tolerance margin of each real data line. See compare.py.
+
+  def print_all(self, string, terminate = False, color = False, failing = False):
+    if failing: self.passed = False
+
+    self.lines.append([string, color, True])
+    if self.echo: print_terminal(string, color)
+
+    if terminate:
+      self.flow_messages.append(string.strip())
+      string2 = '     Flow Failure. Stopping here for this regression.'
+      self.lines.append([string2, False, True])
+      if self.echo: print_terminal(string2, False)
+      self.num_flow_failures += 1
+
+  # Program output captured when not echoing. Only goes to the terminal.
+
+  def add_program_output(self, output):
+    if output == '': return
+    self.lines.append([output.rstrip('\n'), False, False])
+
+#----------------------------------------------------------
+
+def print_terminal(string, color):
+  if color:
+    print(warning_color + string + normal_color)
+  else:
+    print(string)
+
+#----------------------------------------------------------
+# Write the lines of a test result block to the results file and, if the lines were not
+# echoed when generated, to the terminal.
+
+def output_result(result, results_file):
+  for [string, color, to_results_file] in result.lines:
+    if to_results_file: results_file.write(string + '\n')
+    if not result.echo: print_terminal(string, color)
+  results_file.flush()
+
+#----------------------------------------------------------
+# Class to hold the output and resource usage of a program run.
+# The resource usage is that of the program and all of its child processes. It is None if the
+# platform does not support os.wait4. The program is started by rusage_launch.py so that the peak RSS
+# does not include the memory of this process. The peak RSS of a small program is rss_floor_mb
+# (a few MB) since that is the memory of the launcher when the program is started.
+
+class program_run_class:
+  def __init__(self):
+    self.output = ''              # Captured stdout and stderr.
+    self.wall_time = 0.0          # Seconds.
+    self.user_cpu = None          # Seconds.
+    self.sys_cpu = None           # Seconds.
+    self.max_rss_mb = None        # Peak resident memory of the largest process in MB.
+    self.rss_floor_mb = None      # Smallest max_rss_mb that can be measured. See rusage_launch.py.
+    self.timed_out = False        # Set True if the program was killed for exceeding the time limit.
+
+  # Average number of CPUs busy while the program ran. For an OpenMP program compare with OMP_NUM_THREADS.
+
+  def cpu_per_wall(self):
+    if self.user_cpu is None or self.wall_time <= 0: return None
+    return (self.user_cpu + self.sys_cpu) / self.wall_time
+
+  # Line for the results file.
+
+  def usage_line(self):
+    if self.user_cpu is None: return None
+    line = '     Peak RSS (MB): %.1f   CPU time user/sys (sec): %.2f/%.2f   CPU/wall: %.2f' % \
+                        (self.max_rss_mb, self.user_cpu, self.sys_cpu, self.cpu_per_wall())
+    if self.rss_floor_mb is not None:
+      line += '   RSS floor (MB): %.1f' % self.rss_floor_mb
+    num_threads = os.environ.get('OMP_NUM_THREADS', '')
+    if num_threads.isdigit() and int(num_threads) > 0:
+      line += '   OpenMP thread utilization: %.0f%%' % (100 * self.cpu_per_wall() / int(num_threads))
+    return line
+
+#----------------------------------------------------------
+# Kill a program along with any processes it has started.
+# On POSIX the program is run in its own process group (session) so that the whole group can be
+# signaled. SIGTERM is sent first and, if anything is still alive after grace seconds, SIGKILL.
+
+def kill_program(proc, grace = 5.0):
+  if os.name != 'posix':
+    proc.kill()
+    return
+
+  try:
+    os.killpg(proc.pid, signal.SIGTERM)
+    time0 = time.time()
+    while time.time() - time0 < grace:
+      time.sleep(0.1)
+      os.killpg(proc.pid, 0)    # Raises ProcessLookupError when all the processes are gone.
+    os.killpg(proc.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+
+# Called by the timer thread when the time limit of a program is reached.
+
+def program_timed_out(proc, run):
+  run.timed_out = True
+  kill_program(proc)
+
+#----------------------------------------------------------
+# Run a program (or run.py script) in a regression subdirectory and return a program_run_class instance.
+# If capture is True, stdout and stderr of the program are captured. Otherwise the output goes
+# directly to the terminal.
+# If timeout (seconds) is not None, the program and all of its child processes are killed if the
+# program has not finished within that time.
+# Where os.wait4 is available, the program is started by rusage_launch.py which measures the resource usage
+# of the program and writes it to a pipe.
+
+launch_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rusage_launch.py')
+
+def run_program(command, subdir, capture, timeout = None):
+  run = program_run_class()
+  sys.stdout.flush()
+  time0 = time.time()
+
+  stdout = subprocess.PIPE if capture else None
+  stderr = subprocess.STDOUT if capture else None
+
+  usage_fd = None
+  if hasattr(os, 'wait4'):
+    usage_fd, write_fd = os.pipe()
+    try:
+      proc = subprocess.Popen([sys.executable, '-S', '-E', launch_file, str(write_fd), command], cwd = subdir,
+                              stdout = stdout, stderr = stderr, start_new_session = True, pass_fds = [write_fd])
+    except BaseException:
+      os.close(usage_fd)
+      raise
+    finally:
+      os.close(write_fd)
+  else:
+    proc = subprocess.Popen(command, shell = True, cwd = subdir, stdout = stdout, stderr = stderr,
+                            start_new_session = (os.name == 'posix'))
+
+  timer = None
+  if timeout is not None:
+    timer = threading.Timer(timeout, program_timed_out, [proc, run])
+    timer.daemon = True
+    timer.start()
+
+  # Since the program is in its own session, Ctrl-C does not reach it and it has to be killed here.
+  try:
+    if capture:
+      run.output = proc.stdout.read().decode('utf-8', errors = 'replace')
+      proc.stdout.close()
+    wait_program(proc, run, usage_fd)
+  except KeyboardInterrupt:
+    kill_program(proc, 0)
+    raise
+  finally:
+    if timer is not None:
+      timer.cancel()
+      timer.join()    # If the program timed out, wait until all its processes have been killed.
+    if usage_fd is not None: os.close(usage_fd)
+
+  run.wall_time = time.time() - time0
+  return run
+
+# Wait for the program to finish and get its resource usage from the line written by rusage_launch.py
+# to usage_fd. If the launcher was killed before writing the line (time limit), the resource usage
+# is left as None.
+
+def wait_program(proc, run, usage_fd):
+  proc.wait()
+  if usage_fd is None: return
+
+  words = os.read(usage_fd, 1000).split()
+  if len(words) != 4: return
+
+  rss_unit = 1024**2 if sys.platform == 'darwin' else 1024    # Bytes on macOS, kB on Linux.
+  run.max_rss_mb = int(words[0]) / rss_unit
+  run.user_cpu = float(words[1])
+  run.sys_cpu = float(words[2])
+  run.rss_floor_mb = int(words[3]) / rss_unit
+
+#----------------------------------------------------------
+# Put the bin directory given by the user into the form used by run_test_dir.
+# A relative directory is relative to the directory containing TESTS.LIST, and the program is run
+# from the regression subdirectory, so "../" is prepended.
+
+def normalize_bin_dir(bin_dir):
+  if bin_dir[0] != '/' and bin_dir[0] != '$': bin_dir = '../' + bin_dir
+  if bin_dir[-1] != '/': bin_dir = bin_dir + '/'
+  return bin_dir
+
+#----------------------------------------------------------
+# Run the tests for one line of the TESTS.LIST file.
+# The program is run with the regression subdirectory as its working directory so that
+# the working directory of the caller is never changed and tests can run concurrently.
+# If capture is True, terminal output is saved in the returned result instead of being printed.
+# root_dir is the directory containing the TESTS.LIST file. Default is the current directory.
+# If cache_dir is not None, the program is not run if the cache has the output for the current
+# inputs and program (see cache.py). With force = True the program is always run and the cache updated.
+# timeout is the default time limit in seconds for the program. A "timeout=<sec>" setting on the
+# TESTS.LIST line overrides this. None means no limit.
+
+def run_test_dir(test_dir, bin_dir, capture = False, root_dir = '', cache_dir = None, force = False,
+                 timeout = None):
+  time0_test = time.time()
+
+  test_dir = strip_test_line(test_dir)
+  if len(test_dir) == 0: return None
+
+  result = test_result_class(echo = not capture)
+  print_all = result.print_all
+
+  # Is this a note:
+
+  if test_dir[:5] == 'NOTE:':
+    print_all ('Note in TESTS.LIST file: ' + test_dir, False, True, False)
+    return result
+
+  #-----------------------------------------------------------
+  # Run the programs
+
+  # The subdirectory is set before the line is checked so that a bad line still produces a
+  # record in the JSON and JUnit output.
+
+  result.subdir = test_line_subdir(test_dir)
+  dir_split, timeout_str = split_test_line(test_dir)
+
+  if len(dir_split) == 0:
+    print_all ('\nNo subdirectory on line in "TESTS.LIST": ' + test_dir, True, True, True)
+    return result
+
+  if len(dir_split) > 2:
+    print_all ('\nExtra stuff on line in "TESTS.LIST": ' + test_dir, True, True, True)
+    return result
+
+  if timeout_str is not None:
+    try:
+      timeout = float(timeout_str)
+    except ValueError:
+      print_all ('\nBad timeout setting on line in "TESTS.LIST": ' + test_dir, True, True, True)
+      return result
+
+  if len(dir_split) == 2:
+    try:
+      result.max_fail = int(dir_split[1])
+    except ValueError:
+      print_all ('\nBad number of allowed failures on line in "TESTS.LIST": ' + test_dir, True, True, True)
+      return result
+
+  subdir = result.subdir
+  sub_path = os.path.join(root_dir, subdir)
+
+  if not os.path.exists(sub_path):
+    print_all ('\nNon-existant subdirectory given in "TESTS.LIST": ' + subdir, True, True, True)
+    return result
+
+  print_all ('\n%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
+  print_all ('Starting testing in subdirectory: ' + subdir)
+
+  # Remove output.now
+
+  if os.path.exists(os.path.join(sub_path, 'output.now')): os.remove(os.path.join(sub_path, 'output.now'))
+
+  # Run process and make sure output.now has been created
+
+  has_run_py = os.path.exists(os.path.join(sub_path, 'run.py'))
+  program = bin_dir + subdir
+
+  if not has_run_py and not os.path.isfile(os.path.join(sub_path, os.path.expandvars(program))):
+    print_all ('     Running program: ' + program)
+    print_all ('     !!! Program does not exist!', True, True, True)
+    return result
+
+  if cache_dir is not None:
+    programs = programs_used(sub_path, bin_dir, program)
+    if not force and cache_lookup(cache_dir, subdir, sub_path, programs):
+      print_all ('     Inputs, programs and libraries unchanged. Using cached "output.now".')
+      result.cached = True
+    else:
+      stats_before = dir_file_stats(sub_path)
+
+  if not result.cached:
+    # run.py
+    if has_run_py:
+      print_all ('     Found run.py. Running this script.')
+      result.run = run_program('python run.py ' + bin_dir, sub_path, capture, timeout)
+
+    else:
+      print_all ('     Running program: ' + program)
+      result.run = run_program(program, sub_path, capture, timeout)
+
+    result.add_program_output(result.run.output)
+
+    if result.run.timed_out:
+      print_all ('     !!! Program timed out after %g seconds. Program and its child processes killed.' %
+                                                                              timeout, True, True, True)
+      result.num_timeouts += 1
+      result.duration = time.time() - time0_test
+      return result
+
+  # Look for output
+
+  if not os.path.isfile(os.path.join(sub_path, 'output.now')):
+    print_all ('     !!! Program failed to create "output.now" file', True, True, True)
+    return result
+
+  if cache_dir is not None and not result.cached:
+    cache_store(cache_dir, subdir, sub_path, programs, stats_before)
+
+  if not os.path.isfile(os.path.join(sub_path, 'output.correct')):
+    print_all ('     !!! No "output.correct" file', True, True, True)
+    return result
+
+  # Compare the output of the program "output.now" to the expected output "output.correct"
+
+  comp = compare_files(os.path.join(sub_path, 'output.now'), os.path.join(sub_path, 'output.correct'))
+  for message in comp.messages: print_all(*message)
+  result.num_tests = comp.num_tests
+  result.num_failures = comp.num_failures
+  result.failures = comp.failures
+  result.margins = comp.margins
+
+  #------------------
+
+  print_all ('     Number of tests:        ' + str(result.num_tests))
+  print_all ('     Number of failed tests: ' + str(result.num_failures), False, color = (result.num_failures != 0))
+  result.duration = time.time() - time0_test
+  print_all ('     Duration of test (sec): ' + str(result.duration))
+  if result.run is not None and result.run.usage_line() is not None: print_all (result.run.usage_line())
+  print_all ('     Maximum allowed failed tests: ' + str(result.max_fail))
+  if result.num_failures > result.max_fail:
+    print_all ('     Grade for tests in subdirectory ' + subdir + ': FAILED!', False, True, True)
+  else:
+    print_all ('     Grade for tests in subdirectory ' + subdir + ': Passed.')
+
+  return result
+
+# Wrapper for use with Pool.imap_unordered which passes a single argument.
+# The index of the test in the list is passed back so that results can be put back in order.
+
+def run_test_dir_captured(args):
+  return [args[0], run_test_dir(args[1], args[2], True, cache_dir = args[3], force = args[4], timeout = args[5])]
@@ -0,0 +1,46 @@
+#+
+# Launcher used by runner.run_program to measure the resource usage of a regression program.
+#
+# Usage:
+#   python -S -E rusage_launch.py <fd> <command>
+#
+# The command is run with "/bin/sh -c" in a child process. When it finishes, a line with the peak RSS
+# and the user and system CPU times of the command and its child processes is written to file
+# descriptor <fd>:
+#   <ru_maxrss> <ru_utime> <ru_stime> <floor_rss>
+# ru_maxrss and floor_rss are in the units of the OS (kB on Linux, bytes on macOS). The exit code is that
+# of the command.
+#
+# On Linux, the peak RSS of a process includes the RSS that the process which called exec had at that
+# time. If the program was started directly by run_tests.py, every program would appear to use at least
+# as much memory as run_tests.py, which grows as the tests run. This launcher is a fresh Python without
+# site packages so the floor is small (a few MB) and fixed. floor_rss is the smallest peak RSS that can be
+# measured. It is found from a child process that exits right after it is forked.
+#
+# This file is run as a script and is not imported.
+#-
+
+import os
+import sys
+
+fd = int(sys.argv[1])
+os.set_inheritable(fd, False)    # Do not pass the file descriptor on to the program.
+
+pid = os.fork()
+if pid == 0: os._exit(0)
+floor_rss = os.wait4(pid, 0)[2].ru_maxrss
+
+pid = os.fork()
+if pid == 0:
+  try:
+    os.execv('/bin/sh', ['sh', '-c', sys.argv[2]])
+  finally:
+    os._exit(127)
+
+pid, status, rusage = os.wait4(pid, 0)
+
+with os.fdopen(fd, 'w') as f:
+  f.write('%d %.6f %.6f %d\n' % (rusage.ru_maxrss, rusage.ru_utime, rusage.ru_stime, floor_rss))
+
+exit_code = os.waitstatus_to_exitcode(status)
+sys.exit(128 - exit_code if exit_code < 0 else exit_code)   # Shell convention for a killed program.
@@ -0,0 +1,53 @@
+#+
+# Parsing of the "TESTS.LIST" file which lists the regression subdirectories to run.
+#
+# Each line is one of:
+#   <subdir> {<max_fail>} {timeout=<sec>}  ! Regression subdirectory, optional number of allowed
+#                                          !   failures and optional wall clock time limit.
+#   NOTE: <text>                           ! Note that is printed when the tests are run.
+# Anything after a "!" is a comment. Blank lines are ignored.
+#-
+
+#----------------------------------------------------------
+# Remove any "!" comment from a line of the TESTS.LIST file.
+
+def strip_test_line(test_dir):
+  test_dir = test_dir.strip()
+  ix = test_dir.find('!')
+  if ix != -1: test_dir = test_dir[:ix]
+  return test_dir
+
+# Name of the regression subdirectory for a line of the TESTS.LIST file. This is the first word after
+# any "timeout=<sec>" setting is removed. Blank for a note or for a line with no subdirectory.
+
+def test_line_subdir(test_dir):
+  if is_note_line(test_dir): return ''
+  words, timeout = split_test_line(test_dir)
+  if len(words) == 0: return ''
+  return words[0].rstrip('/')
+
+# True if a line of the TESTS.LIST file is a note.
+
+def is_note_line(test_dir):
+  return strip_test_line(test_dir)[:5] == 'NOTE:'
+
+# Split a line of the TESTS.LIST file into words with any "timeout=<sec>" setting removed.
+# Returns [words, timeout] where timeout is the setting string or None if not present.
+
+def split_test_line(test_dir):
+  words = []
+  timeout = None
+  for word in strip_test_line(test_dir).split():
+    if word[:8] == 'timeout=':
+      timeout = word[8:]
+    else:
+      words.append(word)
+  return [words, timeout]
+
+#----------------------------------------------------------
+# Return the lines of a TESTS.LIST file with blank and comment only lines removed.
+# The lines are otherwise unmodified so that they can be passed to run_test_dir.
+
+def read_test_list(test_list_file):
+  with open(test_list_file, 'r') as f:
+    return [test_dir for test_dir in f.readlines() if strip_test_line(test_dir) != '']
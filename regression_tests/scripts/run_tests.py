@@ -4,351 +4,466 @@
 # Script to run regression tests for the Bmad libraries.
 #-
 
-import re
 import os
 import sys
 import time
-import math
+import json
+import socket
+import statistics
+import subprocess
+from multiprocessing import Pool
 
-num_tests = 0
-num_failures = 0
-num_flow_failures = 0
-num_programs = 0
-pass_all_tests = True
-
-warning_color = '\033[91m\033[1m'   # Red + Bold
-normal_color = '\033[0m'
-
-#----------------------------------------------------------
-
-def print_all(string, terminate = False, color = False, failing = False):
-  global pass_all_tests
-  if failing: pass_all_tests = False
-
-  results.write(string + '\n')
-  if color:
-    print(warning_color + string + normal_color)
-  else:
-    print(string)
-
-  if terminate: 
-    string2 = '     Flow Failure. Stopping here for this regression.'
-    results.write(string2 + '\n')
-    print(string2)
-    global num_flow_failures
-    num_flow_failures += 1
+from bmad_regression import test_result_class, print_terminal, output_result, test_line_subdir, \
+                            read_test_list, normalize_bin_dir, run_test_dir, run_test_dir_captured, \
+                            json_stream_class, write_junit
 
 #----------------------------------------------------------
 def print_help():
   print('''
 Usage:
-   run_test.py {-bin <bin_dir>} {-debug} {-test <test_dir>} {-list <test_list_file>}
+   run_test.py {-bin <bin_dir>} {-debug} {-test <test_dir>} {-list <test_list_file>} {-j <num_jobs>}
+               {-history <history_file>} {-shard <k>/<n>} {-force} {-no_cache} {-timeout <sec>}
+               {-json <json_file>} {-junit <junit_file>}
+   run_test.py -timing_report {-history <history_file>} {-ratio <ratio>} {-window <num_runs>}
+   run_test.py -margin_report {-margins <margins_file>} {-window <num_runs>} {-top <num_top>}
 Note: Do not use -debug with -bin
 Defaults:
    <bin_dir>  = "../production/bin" ! Relative to current directory.
               = "../debug/bin"      ! If -debug switch is present
    <test_dir> = ""                  ! For running a single test. Overrides test.list list.
-   <test_list_file> = "test.list"   ! For running multiple tests.''')
+   <test_list_file> = "test.list"   ! For running multiple tests.
+   <num_jobs> = 1                   ! Number of test subdirectories to run concurrently.
+   <history_file> = "regression.history" ! Test durations from each run are appended to this file.
+   <margins_file> = "regression.margins" ! Tolerance margins from each run are appended to this file.
+   <num_top> = 30                   ! -margin_report lists the lines with the <num_top> largest margins.
+   <ratio> = 1.5                    ! -timing_report flags tests slower than <ratio> * median.
+   <num_runs> = 10                  ! Number of previous runs used to compute the median.
+   <k>/<n>                          ! Only run shard <k> of <n> shards balanced by historical run time.
+   -force                           ! Run all programs even if the cached output is up to date.
+   -no_cache                        ! Do not use or update the cache in ".regression_cache".
+   <sec> = 3600                     ! Time limit for each program. 0 = No limit. "timeout=<sec>" in TESTS.LIST overrides.
+   <json_file>                      ! JSON-lines file with a record written as each subdirectory finishes.
+   <junit_file>                     ! JUnit XML file written at the end of the run.''')
   exit()
 
 #----------------------------------------------------------
-# List of tests is in "test.list".
-
-results = open('regression.results', 'w')
-
-bin_dir = '../production/bin/'
-test_dir_list = []
-test_list_file = 'TESTS.LIST'
-time0 = time.time()
-
-i = 1
-while i < len(sys.argv):
-  if sys.argv[i] == '-bin':
-    bin_dir = sys.argv[i+1]
-    i += 1
-  elif sys.argv[i] == '-test':
-    test_dir_list = [sys.argv[i+1]]
-    i += 1
-  elif sys.argv[i] == '-list':
-    test_list_file = [sys.argv[i+1]]
-    i += 1
-  elif sys.argv[i] == '-debug':
-    bin_dir = '../debug/bin'
-  else:
-    print_help()
-
-  i += 1
+# Git revision of the checkout being tested. Blank if not in a git repository.
 
-if bin_dir[0] != '/' and bin_dir[0] != '$': bin_dir = '../' + bin_dir
-if bin_dir[-1] != '/': bin_dir = bin_dir + '/'
-if len(test_dir_list) == 1 and test_dir_list[0] == 'all': test_dir_list = []
+def git_revision():
+  try:
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                          stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+    return proc.stdout.decode().strip()
+  except OSError:
+    return ''
 
-if len(test_dir_list) == 0:
-  dir_file = open (test_list_file, 'r')
-  test_dir_list = dir_file.readlines()
+#----------------------------------------------------------
+# Append a record for each test that was run to the history file.
+# The history file has one JSON record per line so that it can be appended to cheaply.
+
+def append_history(history_file, result_list, time0):
+  run_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time0))
+  host = socket.gethostname()
+  git_rev = git_revision()
+
+  with open(history_file, 'a') as f_hist:
+    for result in result_list:
+      if result.duration is None or result.cached: continue
+      record = {'run': run_time, 'host': host, 'git_rev': git_rev, 'test': result.subdir,
+                'duration': round(result.duration, 3), 'num_tests': result.num_tests,
+                'num_failures': result.num_failures, 'passed': result.passed}
+      if result.run is not None and result.run.user_cpu is not None:
+        record['max_rss_mb'] = round(result.run.max_rss_mb, 1)
+        record['user_cpu'] = round(result.run.user_cpu, 3)
+        record['sys_cpu'] = round(result.run.sys_cpu, 3)
+        if result.run.rss_floor_mb is not None: record['rss_floor_mb'] = round(result.run.rss_floor_mb, 1)
+      f_hist.write(json.dumps(record) + '\n')
 
-#-------------------------------------------------------------
+#----------------------------------------------------------
+# Append the tolerance margins of each test that was run to the margins file.
+# Like the history file, the margins file has one JSON record per test per run. Only lines with a
+# non-zero margin are recorded. Margins are rounded to 4 significant digits to keep the file small.
+
+def append_margins(margins_file, result_list, time0):
+  run_time = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time0))
+  host = socket.gethostname()
+  git_rev = git_revision()
+
+  with open(margins_file, 'a') as f_marg:
+    for result in result_list:
+      if result.duration is None or result.cached: continue
+      margins = {id_str: float('%.4g' % margin) for id_str, margin in result.margins.items()}
+      record = {'run': run_time, 'host': host, 'git_rev': git_rev, 'test': result.subdir, 'margins': margins}
+      f_marg.write(json.dumps(record) + '\n')
 
-for test_dir in test_dir_list:
-  time0_test = time.time()
-  test_dir = test_dir.strip()
-  ix = test_dir.find('!')
-  if ix != -1: test_dir = test_dir[:ix]
-  if len(test_dir) == 0: continue
+#----------------------------------------------------------
+# Read the history file and return a dict of test name -> list of records (oldest first).
 
-  # Is this a note:
+def read_history(history_file):
+  history = {}
+  if not os.path.isfile(history_file): return history
 
-  if test_dir[:5] == 'NOTE:':
-    print_all ('Note in TESTS.LIST file: ' + test_dir, False, True, False)
-    continue
+  with open(history_file, 'r') as f_hist:
+    for line in f_hist:
+      if line.strip() == '': continue
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue     # Ignore a truncated line from an interrupted run.
+      history.setdefault(record['test'], []).append(record)
 
-  #-----------------------------------------------------------
-  # Run the programs
+  return history
 
-  dir_split = test_dir.split()
-  num_programs += 1
-  num_local_tests = 0
-  num_local_failures = 0
+#----------------------------------------------------------
+# Print a report comparing the latest duration and peak memory (RSS) of each test with the median of
+# the previous <window> runs on the same host. Tests slower or using more memory by more than a factor
+# of <ratio> are flagged. Tests that take less than min_duration seconds or less than min_rss_mb MB
+# are never flagged for that quantity since the numbers are noise.
+# Returns True if no test was flagged.
+
+def timing_report(history_file, ratio, window, min_duration = 1.0, min_rss_mb = 50.0):
+  history = read_history(history_file)
+  if len(history) == 0:
+    print('No timing history found in: ' + history_file)
+    return True
+
+  print('Timing report from: ' + history_file)
+  print('Tests flagged if latest duration or RSS > %.2f * median of previous %d runs.' % (ratio, window))
+  floors = [recs[-1]['rss_floor_mb'] for recs in history.values() if 'rss_floor_mb' in recs[-1]]
+  if len(floors) > 0:
+    print('The RSS of a program is never less than the %.1f MB used by the launcher that starts it.' % max(floors))
+  print('')
+  print('%-36s %10s %10s %8s %6s %10s %8s' % ('Test', 'Latest', 'Median', 'Ratio', 'Runs', 'RSS (MB)', 'Ratio'))
+
+  num_flagged = 0
+  for test in sorted(history):
+    records = history[test]
+    latest = records[-1]['duration']
+    host = records[-1]['host']
+    previous_recs = [rec for rec in records[:-1] if rec['host'] == host][-window:]
+    previous = [rec['duration'] for rec in previous_recs]
+    latest_rss = records[-1].get('max_rss_mb')
+    previous_rss = [rec['max_rss_mb'] for rec in previous_recs if 'max_rss_mb' in rec]
+    rss_str = '-' if latest_rss is None else '%.1f' % latest_rss
+
+    if len(previous) == 0:
+      print('%-36s %10.2f %10s %8s %6d %10s %8s' % (test, latest, '-', '-', 0, rss_str, '-'))
+      continue
 
-  if len(dir_split) > 2:
-    print_all ('\nExtra stuff on line in "TESTS.LIST": ' + dir_split, True, True, True)
-    continue
+    median = statistics.median(previous)
+    this_ratio = latest / median if median > 0 else float('inf')
+    flag = ''
+    if this_ratio > ratio and latest > min_duration:
+      flag = '   <-- SLOWER'
 
-  max_fail = 0
-  if len(dir_split) == 2: max_fail = int(dir_split[1])
+    rss_ratio_str = '-'
+    if latest_rss is not None and len(previous_rss) > 0:
+      median_rss = statistics.median(previous_rss)
+      rss_ratio = latest_rss / median_rss if median_rss > 0 else float('inf')
+      rss_ratio_str = '%.2f' % rss_ratio
+      if rss_ratio > ratio and latest_rss > min_rss_mb:
+        flag += '   <-- MORE MEMORY'
 
-  subdir = dir_split[0]
-  if subdir[-1] == "/": subdir = subdir[:-1]
+    if flag != '': num_flagged += 1
+    line = '%-36s %10.2f %10.2f %8.2f %6d %10s %8s%s' % (test, latest, median, this_ratio, len(previous),
+                                                          rss_str, rss_ratio_str, flag)
+    print_terminal(line, flag != '')
 
-  if not os.path.exists(subdir):
-    print_all ('\nNon-existant subdirectory given in "TESTS.LIST": ' + subdir, True, True, True)
-    continue
+  print('\nNumber of tests flagged as slower or using more memory: ' + str(num_flagged))
+  return num_flagged == 0
 
-  os.chdir(subdir)
+#----------------------------------------------------------
+# Print a report of the tolerance margins (see compare.py) of the real data lines over the last
+# <window> runs of each test on the same host as the latest run. Lines are sorted by latest margin and
+# the top <num_top> are printed. A line is flagged as creeping if its latest margin is at least
+# min_margin and larger than at the start of the window.
+# Returns True if no line was flagged.
+
+def margin_report(margins_file, window, num_top, min_margin = 0.5):
+  history = read_history(margins_file)
+  if len(history) == 0:
+    print('No margin history found in: ' + margins_file)
+    return True
+
+  rows = []
+  for test, records in history.items():
+    host = records[-1]['host']
+    records = [rec for rec in records if rec['host'] == host][-window:]
+    id_set = set()
+    for rec in records: id_set.update(rec['margins'])
+    for id_str in id_set:
+      rows.append([test, id_str, [rec['margins'].get(id_str, 0.0) for rec in records]])
+
+  rows.sort(key = lambda row: (-row[2][-1], row[0], row[1]))
+
+  print('Tolerance margin report from: ' + margins_file)
+  print('Margin = |now - correct| / allowed difference. A line fails if margin > 1.')
+  print('Lines flagged if latest margin >= %.2f and larger than %d runs ago.\n' % (min_margin, window))
+  print('%-28s %-36s %10s %10s %10s %6s' % ('Test', 'ID', 'Latest', 'First', 'Max', 'Runs'))
+
+  num_flagged = 0
+  for ix, [test, id_str, series] in enumerate(rows):
+    latest = series[-1]
+    flag = ''
+    if latest > 1:
+      flag = '   <-- FAILING'
+    elif latest >= min_margin and latest > series[0]:
+      flag = '   <-- CREEPING'
+      num_flagged += 1
+    if ix >= num_top and flag == '': continue
+    line = '%-28s %-36s %10.3g %10.3g %10.3g %6d%s' % (test, '"' + id_str[:34] + '"', latest, series[0],
+                                                      max(series), len(series), flag)
+    print_terminal(line, flag != '')
+
+  print('\nNumber of lines flagged as creeping toward tolerance: ' + str(num_flagged))
+  return num_flagged == 0
 
-  print_all ('\n%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%')
-  print_all ('Starting testing in subdirectory: ' + subdir)
+#----------------------------------------------------------
+# Expected duration of each test in test_dir_list based upon the median of the last <window>
+# recorded durations on the same host as the latest record of the test. Timings from different hosts
+# are not mixed since a slow CI host and a fast workstation can differ by a large factor.
+# The host is taken from the history file and not the current host so that all CI runners sharing
+# a history file agree on the shard split. Tests without history are given the average expected
+# duration of the tests that have history. Notes in the list are given zero duration.
+
+def expected_durations(test_dir_list, history_file, window):
+  history = read_history(history_file)
+  durations = []
+
+  for test_dir in test_dir_list:
+    subdir = test_line_subdir(test_dir)
+    if subdir == '':
+      durations.append(0.0)
+    elif subdir in history:
+      host = history[subdir][-1]['host']
+      records = [rec for rec in history[subdir] if rec['host'] == host][-window:]
+      durations.append(statistics.median([rec['duration'] for rec in records]))
+    else:
+      durations.append(None)
 
-  # Remove output.now
+  known = [d for d, t in zip(durations, test_dir_list) if d is not None and test_line_subdir(t) != '']
+  default = sum(known) / len(known) if len(known) > 0 else 1.0
+  return [default if d is None else d for d in durations]
 
-  os.system('rm output.now')
+#----------------------------------------------------------
+# Split test_dir_list into num_shard shards with roughly equal total expected duration and
+# return the lines in shard number ix_shard (1 to num_shard) in their original order.
+# Tests are assigned longest first to the shard with the least total duration so far.
+# The assignment only depends upon the history file so all CI runners sharing a history file
+# agree on the split. Notes are put in every shard.
+
+def shard_test_list(test_dir_list, durations, ix_shard, num_shard):
+  shard_time = [0.0] * num_shard
+  in_shard = [False] * len(test_dir_list)
+
+  order = sorted(range(len(test_dir_list)), key = lambda ix: (-durations[ix], ix))
+  for ix in order:
+    if test_line_subdir(test_dir_list[ix]) == '':
+      in_shard[ix] = True
+      continue
+    ish = shard_time.index(min(shard_time))
+    shard_time[ish] += durations[ix]
+    if ish == ix_shard - 1: in_shard[ix] = True
 
-  # Run process and make sure output.now has been created
+  return [ix for ix in range(len(test_dir_list)) if in_shard[ix]]
 
-  program = subdir
-  if program[-1] == '/': program = program[:-1]
+#----------------------------------------------------------
+# Generator that takes [index, result] pairs in any order and yields the results in index order
+# as soon as all results with lower index have been yielded.
+# If on_arrival is not None, it is called with each result as soon as it arrives.
+
+def in_order(indexed_results, on_arrival = None):
+  pending = {}
+  ix_next = 0
+  for ix, result in indexed_results:
+    if on_arrival is not None: on_arrival(result)
+    pending[ix] = result
+    while ix_next in pending:
+      yield pending.pop(ix_next)
+      ix_next += 1
 
-  # run.py
-  if os.path.exists('run.py'):
-    print_all ('     Found run.py. Running this script.')
-    os.system('python run.py ' + bin_dir)
+#----------------------------------------------------------
+# Main program.
+# List of tests is in "TESTS.LIST".
+
+def main():
+  bin_dir = '../production/bin/'
+  test_dir_list = []
+  test_list_file = 'TESTS.LIST'
+  num_jobs = 1
+  history_file = 'regression.history'
+  do_timing_report = False
+  do_margin_report = False
+  margins_file = 'regression.margins'
+  num_top = 30
+  ratio = 1.5
+  window = 10
+  ix_shard = 1
+  num_shard = 1
+  cache_dir = '.regression_cache'
+  force = False
+  timeout = 3600.0
+  json_file = None
+  junit_file = None
+  time0 = time.time()
+
+  i = 1
+  while i < len(sys.argv):
+    if sys.argv[i] == '-bin':
+      bin_dir = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-test':
+      test_dir_list = [sys.argv[i+1]]
+      i += 1
+    elif sys.argv[i] == '-list':
+      test_list_file = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-debug':
+      bin_dir = '../debug/bin'
+    elif sys.argv[i] == '-j':
+      num_jobs = int(sys.argv[i+1])
+      i += 1
+    elif sys.argv[i] == '-history':
+      history_file = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-timing_report':
+      do_timing_report = True
+    elif sys.argv[i] == '-margin_report':
+      do_margin_report = True
+    elif sys.argv[i] == '-margins':
+      margins_file = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-top':
+      num_top = int(sys.argv[i+1])
+      i += 1
+    elif sys.argv[i] == '-ratio':
+      ratio = float(sys.argv[i+1])
+      i += 1
+    elif sys.argv[i] == '-window':
+      window = int(sys.argv[i+1])
+      i += 1
+    elif sys.argv[i] == '-json':
+      json_file = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-junit':
+      junit_file = sys.argv[i+1]
+      i += 1
+    elif sys.argv[i] == '-timeout':
+      timeout = float(sys.argv[i+1])
+      i += 1
+    elif sys.argv[i] == '-force':
+      force = True
+    elif sys.argv[i] == '-no_cache':
+      cache_dir = None
+    elif sys.argv[i] == '-shard':
+      ix_shard, num_shard = [int(n) for n in sys.argv[i+1].split('/')]
+      if ix_shard < 1 or ix_shard > num_shard: print_help()
+      i += 1
+    else:
+      print_help()
 
-  else:
-    program = bin_dir + program
-    print_all ('     Running program: ' + program)
-  
-    if not os.path.isfile(program):
-      print_all ('     !!! Program does not exist!', True, True, True)
-      os.chdir('..')
-      continue
+    i += 1
 
-    os.system(program)
-
-  # Look for output
-
-  if not os.path.isfile('output.now'):
-    print_all ('     !!! Program failed to create "output.now" file', True, True, True)
-    os.chdir('..')
-    continue
-
-  if not os.path.isfile('output.correct'):
-    print_all ('     !!! No "output.correct" file', True, True, True)
-    os.chdir('..')
-    continue
-
-  # Compare the output of the program "output.now" to the expected output "output.correct"
-
-  now_file = open('output.now', 'r')  
-  correct_file = open('output.correct', 'r')
-  test_count = 0
-
-  while True:
-
-    while True:
-      now_line = now_file.readline()
-      if len(now_line) == 0: break                # End of file
-      if len(now_line.strip()) == 0: continue     # Skip blank line
-      if now_line.strip()[0] == '!': continue     # Skip comment line
-      break
-
-    while True:
-      correct_line = correct_file.readline()
-      if len(correct_line) == 0: break                # End of file
-      if len(correct_line.strip()) == 0: continue     # Skip blank line
-      if correct_line.strip()[0] == '!': continue     # Skip comment line
-      break
-
-    if len(now_line) == 0 or len(correct_line) == 0: 
-      print_all ('')
-      if len(now_line) != 0:
-        print_all ('     Confusion! End of "output.correct" reached before End of "output.now"', True, True, True)
-      if len(correct_line) != 0:
-        print_all ('     Confusion! End of "output.now" reached before End of "output.correct"', True, True, True)
-      break
-
-    now_line = now_line.strip()
-    correct_line = correct_line.strip()
-
-    now_split = now_line.split('"', 2)
-    correct_split = correct_line.split('"', 2)
-    
-    if now_split[0] != '' or len(now_split) != 3:
-      print_all ('     Cannot parse line from "output.now": ' + now_line, True, True, True)
-      break
-
-    if correct_split[0] != '' or len(correct_split) != 3:
-      print_all ('     Cannot parse line from "output.correct": ' + correct_line, True, True, True)
-      break
-
-    if now_split[1] != correct_split[1]:
-      print_all ('     Identification string for a line in "output.now":    ' + now_split[1], False, True, True)
-      print_all ('     Does not match corresponding ID in "output.correct": ' + correct_split[1], True, True, True)
-
-    now_end = now_split[2].strip().split()
-
-    #----------------------------------------------
-    # String test
-
-    num_local_tests += 1
-
-    if now_end[0] == 'STR':
-      now2_split = now_split[2].split('"')
-      correct2_split = correct_split[2].split('"')[1:]
-
-      if len(now2_split) < 2:
-        print_all ('     Bad line line "output.now": ' + now_line, True, True, True)
-        break
-
-      now2_split.pop(0)    # Get rid of STR item.
-
-      if len(now2_split) != len(correct2_split):
-        print_all ('     Number of components in "output.now" line: ' + now_line, False, True, True)
-        print_all ('     Does not match number in "output.correct:  ' + correct_line, True, True, True)
-        break
-
-      for ix, (now1, correct1) in enumerate(list(zip(now2_split, correct2_split))):
-        if now1 != correct1:
-          print_all ('')
-          if len(now2_split) == 2:     # Will always have blank item in list.
-            print_all ('     Regression test failed:', color = True)
-          else:
-            print_all ('     Regression test failed for datum number: ' + str(ix+1), color = True)
-          print_all ('          Line from "output.now": ' + now_line, color = True)
-          print_all ('          Line from "output.correct": ' + correct_line, color = True)
-          num_local_failures += 1
-          break
-
-    #----------------------------------------------
-    # Real test
-
-    elif now_end[0] == 'ABS' or now_end[0] == 'REL' or now_end[0] == 'VEC_REL':
-      now2_split = now_split[2].strip().split()
-      correct2_split = correct_split[2].strip().split()[2:]   # [2:] -> Throw away EG: "ABS 2E-7"
-      
-      if len(now2_split) < 3:
-        print_all ('     Bad line in "output.now": ' + now_line, True, True, True)
-        break
-
-      tol_type = now2_split.pop(0)           # Pop REL or ABS item.
-      tol_val  = float(now2_split.pop(0))    # Pop tollerance
-
-      if len(now2_split) != len(correct2_split):
-        print_all ('     Number of components in "output.now" line: ' + now_line, False, True, True)
-        print_all ('     Does not match number in "output.correct:  ' + correct_line, True, True, True)
-        break
-
-      bad_at = -1
-      bad_diff_val  = 0
-
-      if tol_type == 'VEC_REL':
-        vec_amp = 0
-        for ix, (now1, correct1) in enumerate(list(zip(now2_split, correct2_split))):
-          now_val = float(now1)
-          correct_val = float(correct1)
-          vec_amp += ((abs(now_val) + abs(correct_val)) / 2) ** 2
-        vec_amp = math.sqrt(vec_amp)
-
-      for ix, (now1, correct1) in enumerate(list(zip(now2_split, correct2_split))):
-        try:
-          now_val = float(now1)
-        except:
-          now_val = 1e100
-        correct_val = float(correct1)
-        diff_val = abs(now_val - correct_val)
-        abs_val = (abs(now_val) + abs(correct_val)) / 2
-        factor = 1
-        if tol_type == 'REL': factor = abs_val
-        if tol_type == 'VEC_REL': factor = vec_amp
-
-        if diff_val > factor * tol_val and diff_val > bad_diff_val: 
-          bad_at = ix
-          bad_diff_val = diff_val
-          bad_abs_val = abs_val
-
-      if bad_at > -1:
-        print_all ('')
-        if now_end[0] == 'STR':
-          print_all ('     Regression test failed for: "' + now_split[1] + '"', color = True)
-        else:
-          print_all ('     Regression test failed for: "' + now_split[1] + '"   ' + now_end[0] + '   ' + now_end[1], color = True)
-        if len(now2_split) != 1: 
-          print_all ('     Regression test failed for datum number: ' + str(bad_at+1), color = True)
-        print_all ('        Data from "output.now":     ' + str(now2_split), color = True)
-        print_all ('        Data from "output.correct": ' + str(correct2_split), color = True)
-        print_all ('        Diff: ' + str(bad_diff_val) + '  Diff/Val: ' + str(abs(bad_diff_val) / bad_abs_val), color = True)
-        num_local_failures += 1
-
-    #----------------------------------------------
-    # Error test
+  if do_timing_report:
+    if timing_report(history_file, ratio, window):
+      exit(0)
+    else:
+      exit(1)
 
+  if do_margin_report:
+    if margin_report(margins_file, window, num_top):
+      exit(0)
     else:
-      print_all ('     Bad data ID string in "output.now" file: ' + now_line, False, True, True)
-      print_all ('     Should be one of: STR, REL, or ABS.', True, True, True)
-      break
-
-  #------------------
-
-  print_all ('     Number of tests:        ' + str(num_local_tests))
-  print_all ('     Number of failed tests: ' + str(num_local_failures), False, color = (num_local_failures != 0))
-  print_all ('     Duration of test (sec): ' + str(time.time() - time0_test))
-  print_all ('     Maximum allowed failed tests: ' + str(max_fail))
-  if num_local_failures > max_fail: 
-    print_all ('     Grade for tests in subdirectory ' + subdir + ': FAILED!', False, True, True)
+      exit(1)
+
+  bin_dir = normalize_bin_dir(bin_dir)
+  if timeout <= 0: timeout = None
+  if len(test_dir_list) == 1 and test_dir_list[0] == 'all': test_dir_list = []
+
+  if len(test_dir_list) == 0:
+    test_dir_list = read_test_list(test_list_file)
+  durations = expected_durations(test_dir_list, history_file, window)
+
+  if num_shard > 1:
+    ix_list = shard_test_list(test_dir_list, durations, ix_shard, num_shard)
+    test_dir_list = [test_dir_list[ix] for ix in ix_list]
+    durations = [durations[ix] for ix in ix_list]
+    print('Running shard %d of %d: %d lines of the test list.' % (ix_shard, num_shard, len(test_dir_list)))
+
+  results_file = open('regression.results', 'w')
+  summary = test_result_class()
+
+  #-------------------------------------------------------------
+  # Run the tests. With parallel running, the tests are started longest first so that a long
+  # test does not end up running alone at the end. The results are put back in TESTS.LIST order.
+
+  num_tests = 0
+  num_failures = 0
+  num_flow_failures = 0
+  num_timeouts = 0
+  result_list = []
+
+  # The JSON file gets the results as they arrive and not in TESTS.LIST order.
+  json_stream = None
+  if json_file is not None: json_stream = json_stream_class(json_file)
+
+  def stream_result(result):
+    if json_stream is not None and result is not None: json_stream.write(result)
+
+  if num_jobs > 1:
+    pool = Pool(num_jobs)
+    order = sorted(range(len(test_dir_list)), key = lambda ix: (-durations[ix], ix))
+    result_iter = in_order(pool.imap_unordered(run_test_dir_captured,
+                                  [[ix, test_dir_list[ix], bin_dir, cache_dir, force, timeout] for ix in order]),
+                           stream_result)
   else:
-    print_all ('     Grade for tests in subdirectory ' + subdir + ': Passed.')
-
-
-  num_tests += num_local_tests
-  num_failures += num_local_failures
-
-  os.chdir('..')
-  
-#------------------------------------------------------------
-
-
-print_all ('Total number of tests:           ' + str(num_tests))
-print_all ('Total number of failed tests:    ' + str(num_failures), color = (num_failures != 0))
-print_all ('Number of Program flow failures: ' + str(num_flow_failures), color = (num_flow_failures != 0))
-print_all ('Duration of all tests (sec): %5.2f' % (time.time() - time0))
+    result_iter = in_order(((ix, run_test_dir(test_dir, bin_dir, cache_dir = cache_dir, force = force, timeout = timeout))
+                            for ix, test_dir in enumerate(test_dir_list)), stream_result)
+
+  for result in result_iter:
+    if result is None: continue
+    result_list.append(result)
+    output_result(result, results_file)
+    num_tests += result.num_tests
+    num_failures += result.num_failures
+    num_flow_failures += result.num_flow_failures
+    num_timeouts += result.num_timeouts
+    if not result.passed: summary.passed = False
+
+  if num_jobs > 1:
+    pool.close()
+    pool.join()
+
+  append_history(history_file, result_list, time0)
+  append_margins(margins_file, result_list, time0)
+  if json_stream is not None: json_stream.close()
+  if junit_file is not None: write_junit(junit_file, result_list, time.time() - time0)
+
+  #------------------------------------------------------------
+
+  print_all = summary.print_all
+  print_all ('Total number of tests:           ' + str(num_tests))
+  print_all ('Total number of failed tests:    ' + str(num_failures), color = (num_failures != 0))
+  print_all ('Number of Program flow failures: ' + str(num_flow_failures), color = (num_flow_failures != 0))
+  print_all ('   Of which are timeouts:        ' + str(num_timeouts), color = (num_timeouts != 0))
+  print_all ('Duration of all tests (sec): %5.2f' % (time.time() - time0))
+
+  print('Results file: regression.results')
+
+  if summary.passed:
+    print_all ('\nBottom line for all tests: The code PASSES regression testing.')
+  else:
+    print_all ('\nBottom line for all tests: The code FAILS regression testing.', color = True)
 
-print('Results file: regression.results')
+  output_result(summary, results_file)
+  results_file.close()
 
-if pass_all_tests:
-  print_all ('\nBottom line for all tests: The code PASSES regression testing.')
-  exit(0)
-else:
-  print_all ('\nBottom line for all tests: The code FAILS regression testing.', color = True)
-  exit(1)
+  if summary.passed:
+    exit(0)
+  else:
+    exit(1)
 
-results.close()
+#----------------------------------------------------------
 
+if __name__ == '__main__':
+  main()
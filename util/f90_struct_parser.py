@@ -0,0 +1,203 @@
+#+
+# Parser for the component lines of Fortran structure definitions.
+#
+# Used by cpp_bmad_interface/scripts/create_interface.py to create the C++ interface
+# and by searchf.py to index struct components for getf/listf.
+#
+# Examples:
+#  1) "type(abc), pointer :: a(:,:),b(7) = 23 ! Comment"
+#  2) "integer abc"
+# Notice that only in example 2 is space significant.
+#
+# Current restrictions. That is, syntax to avoid:
+#   1) Line continuations: '&'
+#   2) Dimensions: "integer, dimension(7) :: abc"
+#   3) Kind: "integer(kind = 8) abc"
+#   4) Variable inits using "," or "(" characters: "real abc(2) = [1, 2]"
+#-
+
+import copy
+import re
+
+NOT = 'NOT'
+PTR = 'PTR'
+ALLOC = 'ALLOC'
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# arg_class.
+# A structure component.
+
+class arg_class:
+
+  def __init__(self):
+    self.is_component = True   # Is a structure component? If not, then will be array bound.
+    self.f_name = ''           # Fortran side name of argument. Will be lower case
+    self.c_name = ''           # C++ side name of argument. May be mangled to avoid reserved word conflicts.
+    self.type = ''             # Fortran type without '(...)'. EG: 'real', 'type', 'character', etc.
+    self.kind = ''             # Fortran kind. EG: '', 'rp', 'coord_struct', etc.
+    self.pointer_type = NOT    # NOT, PTR, or ALLOC
+    self.array = []            # EG: [':', ':'] or ['0:6', '3']
+    self.full_array = ''       # EG: '(:,:)', '(0:6, 3)'
+    self.lbound = []
+    self.ubound = []
+    self.init_value = ''       # Initialization value
+    self.comment = ''          # Comment with Fortran structure def.
+    self.f_side = 0
+    self.c_side = 0
+
+  def __repr__(self):
+    return '["%s(%s)", "%s", "%s", %s, "%s"]' % (self.type, self.kind, self.pointer_type, self.f_name, self.array, self.init_value)
+
+  def full_repr(self):
+    return '["%s(%s)", "%s", "%s", %s, "%s" %s %s "%s"]' % (self.type,
+              self.kind, self.pointer_type, self.f_name, self.array, self.full_array,
+              self.lbound, self.ubound, self.init_value)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# parse_struct_component function
+#
+# Returns the list of arg_class components defined on a line of the definition of structure struct_name.
+# The list is empty for blank and comment lines.
+#
+# Warnings are printed or, if notes is a list, appended to notes.
+# A ValueError is raised if an initial value cannot be parsed.
+
+re_end_type = re.compile(r'^\s*end\s*type')  # Match to: 'end type'
+re_match1 = re.compile(r'([,(]|::|\s+)')     # Match to: ',', '::', '(', ' '
+re_match2 = re.compile(r'([=[,(]|::)')       # Match to: ',', '::', '(', '[', '='
+re_contains = re.compile(r'^\s*contains')    # Match to: 'contains' (indicating type procedures are defined.)
+
+def parse_struct_component (line, struct_name, notes = None):
+
+  def note (message):
+    if notes is None:
+      print(message)
+    else:
+      notes.append(message)
+
+  args = []
+  base_arg = arg_class()
+
+  part = line.partition('!')
+
+  base_arg.comment = part[2].strip()
+  line = part[0].strip()
+  if len(line) == 0: return args   # Blank line.
+
+  # Get base_arg.type
+
+  split_line = re_match1.split(line, 1)
+  base_arg.type = split_line.pop(0)
+  if base_arg.type == 'integer' and split_line[0][0] == '(': base_arg.type = 'integer8'
+
+  if split_line[0][0] == ' ':
+    split_line = re_match2.split(split_line[1], 1)
+    if split_line[0] == '': split_line.pop(0)
+
+  # Now split_line[0] is a delimiter or component name
+  # Add type information if there is more...
+
+  if split_line[0] == '(':
+    split_line = split_line[1].partition(')')
+    base_arg.kind = split_line[0].strip()
+    split_line = re_match2.split(split_line[2].lstrip(), 1)
+    if split_line[0] == '': split_line.pop(0)   # EG: "real(rp) :: ..."
+
+  if split_line[0] == ',':
+    split_line = split_line[1].partition('::')
+
+    if split_line[0].strip() == 'allocatable':
+      base_arg.pointer_type = ALLOC
+    elif split_line[0].strip() == 'pointer':
+      base_arg.pointer_type = PTR
+
+    split_line = [split_line[2].lstrip()]
+
+  if split_line[0] == '::': split_line.pop(0)
+
+  # Join split_line into one string so that we are starting from a definite state.
+
+  if len(split_line) > 1: split_line = [''.join(split_line)]
+
+  # Now len(split_line) = 1 and the first word in split_line[0] is the structure component name.
+  # There may be multiple components defined so loop over all instances.
+
+  while True:
+
+    if len(split_line) > 1:
+      note('Confused parsing of struct component: ' + line.strip() + ' in: ' + struct_name)
+
+    split_line = re_match2.split(split_line[0], 1)
+
+    arg = copy.deepcopy(base_arg)
+    arg.f_name = split_line.pop(0).strip().lower()
+    arg.c_name = arg.f_name
+
+    if len(split_line) == 0:
+      args.append(arg)
+      break
+
+    # Get array bounds
+
+    if split_line[0] == '(':
+      split_line = split_line[1].lstrip().partition(')')
+      arg.full_array = '(' + split_line[0].strip().replace(' ', '') + ')'
+      arg.array = arg.full_array[1:-1].split(',')
+      split_line = re_match2.split(split_line[2].lstrip(), 1)
+      if split_line[0] == '': split_line.pop(0)  # Needed for EG: "integer aaa(5)"
+
+      if arg.array[0] != ':':   # If has explicit bounds...
+        for dim in arg.array:
+          if ':' in dim:
+            arg.lbound.append(dim.partition(':')[0])
+            arg.ubound.append(dim.partition(':')[2])
+          else:
+            arg.lbound.append('1')
+            arg.ubound.append(dim)
+
+    if len(split_line) == 0:
+      args.append(arg)
+      break
+
+    # Get initial value
+
+    if split_line[0] == '=':
+      split_line = re_match2.split(split_line[1].lstrip(), 1)
+
+      # If have EG: "b(2) = [3, 4], c => null()" need to
+      # combine back "(...)" or "[...]" construct which is part of init string.
+
+      if len(split_line) > 1 and (split_line[1] == '(' or split_line[1] == '['):
+        split0 = split_line[0] + split_line[1]
+        n_parens = 1
+        for ix, char in enumerate(split_line[2]):
+          split0 = split0 + char
+          if char == '(' or char == '[': n_parens = n_parens + 1
+          if char == ')' or char == ']': n_parens = n_parens - 1
+          if n_parens == 0: break
+        split1 = split_line[2][ix+1:]
+        if split1 == '':
+          split_line = [split0]
+        elif split1[0] == ',':
+          split_line = [split0, ',', split1[1:]]
+        else:
+          note('?????')
+          raise ValueError('Cannot parse initial value: ' + line.strip() + ' in: ' + struct_name)
+
+      arg.init_value = split_line[0]
+      if len(split_line) == 1:
+        split_line[0] = ''
+      else:
+        split_line.pop(0)
+
+    args.append(arg)
+    if len(split_line) == 0 or split_line[0] == '': break
+
+    if split_line[0] != ',':
+      note('Expected "," while parsing: ' + line.strip()  + ' in: ' + struct_name)
+
+    split_line.pop(0)
+
+  return args
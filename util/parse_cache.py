@@ -0,0 +1,157 @@
+#+
+# Cache of file parse results shared by searchf.py (getf, listf, create_searchf_namelist) and
+# cpp_bmad_interface/scripts/create_interface.py.
+#
+# Each result is pickled to a file in the cache directory. The cache file name is made from the sha1 hash
+# of the contents of the parsed file and a key naming the kind of parse (which should include a version
+# number that is changed when the parser output changes). Since results are found by content, a file that
+# has not changed, or that has the same contents in another checkout of the code, is only parsed once.
+#
+# The cache directory is set by the BMAD_PARSE_CACHE environment variable.
+# Default is $XDG_CACHE_HOME/bmad_parse_cache or, if XDG_CACHE_HOME is not set, ~/.cache/bmad_parse_cache.
+# Setting BMAD_PARSE_CACHE to blank disables the cache.
+#
+# Since cache files are unpickled, the cache is not used if the cache directory is not owned by the user or
+# is writable by other users.
+#
+# Results are only saved by programs that build something (the searchf.db index and create_interface.py).
+# getf and listf searches without an index only read the cache. Index builds also call prune which removes
+# cache files not used in max_age_days days and then, if the cache is larger than max_size_mb, the least
+# recently used files. The cache directory may be deleted at any time.
+#-
+
+import os
+import time
+import stat
+import pickle
+import hashlib
+
+max_age_days = 60          # Cache files not used for this long are removed by prune.
+max_size_mb = 500          # Maximum size of the cache after prune.
+prune_interval_hours = 24  # prune does nothing if the cache was pruned more recently than this.
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# cache_dir function
+#
+# Returns the cache directory or blank if the cache is disabled.
+
+def cache_dir ():
+  if 'BMAD_PARSE_CACHE' in os.environ: return os.environ['BMAD_PARSE_CACHE']
+  base = os.environ.get('XDG_CACHE_HOME', '') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'bmad_parse_cache')
+
+def enabled ():
+  return cache_dir() != ''
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# dir_is_safe function
+#
+# Returns True if the cache directory exists, is owned by the user and cannot be written by other users.
+
+def dir_is_safe ():
+  try:
+    st = os.lstat(cache_dir())
+  except OSError:
+    return False
+  return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0o022) == 0
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# file_hash function
+#
+# Returns the sha1 hash of the contents of a file.
+
+def file_hash (file_name):
+  with open(file_name, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# load function
+#
+# Returns the cached result for a file content hash and kind of parse. Returns None if there is no result.
+# If touch is True, the modification time of the cache file is set to now so that prune sees it as used.
+
+def cache_file_name (hash, key):
+  return os.path.join(cache_dir(), hash[:2], hash + '-' + key + '.pickle')
+
+def load (hash, key, touch = False):
+  if not enabled() or not dir_is_safe(): return None
+  file_name = cache_file_name(hash, key)
+  try:
+    with open(file_name, 'rb') as f:
+      result = pickle.load(f)
+    if touch: os.utime(file_name)
+    return result
+  except Exception:    # Missing, unreadable or corrupt cache file.
+    return None
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# save function
+#
+# Saves a result in the cache. The cache file is written to a temporary file and then renamed so that
+# processes reading the cache never see a partially written file. Errors are ignored.
+
+def save (hash, key, result):
+  if not enabled(): return
+  file_name = cache_file_name(hash, key)
+  tmp_file = file_name + '.' + str(os.getpid()) + '.tmp'
+  try:
+    os.makedirs(cache_dir(), mode = 0o700, exist_ok = True)
+    if not dir_is_safe(): return
+    os.makedirs(os.path.dirname(file_name), mode = 0o700, exist_ok = True)
+    with open(tmp_file, 'wb') as f:
+      pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, file_name)
+  except OSError:
+    if os.path.exists(tmp_file): os.remove(tmp_file)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# prune function
+#
+# Removes cache files that have not been used in max_age_days days and left over temporary files.
+# Then, if the cache is larger than max_size_mb, the least recently used files are removed.
+# To keep this cheap, nothing is done if the cache was pruned in the last prune_interval_hours hours.
+# Errors are ignored.
+
+def prune ():
+  if not enabled() or not dir_is_safe(): return
+  stamp_file = os.path.join(cache_dir(), 'last_prune')
+  now = time.time()
+  try:
+    if now - os.stat(stamp_file).st_mtime < prune_interval_hours * 3600: return
+  except OSError:
+    pass
+
+  try:
+    with open(stamp_file, 'w'): pass
+  except OSError:
+    return
+
+  files = []    # [mtime, size, file_name] of files kept.
+  for sub_dir in os.scandir(cache_dir()):
+    if not sub_dir.is_dir(follow_symlinks = False): continue
+    for entry in os.scandir(sub_dir.path):
+      try:
+        st = entry.stat(follow_symlinks = False)
+        if entry.name.endswith('.tmp'):
+          if now - st.st_mtime > 3600: os.remove(entry.path)    # From a killed process.
+        elif now - st.st_mtime > max_age_days * 86400:
+          os.remove(entry.path)
+        else:
+          files.append([st.st_mtime, st.st_size, entry.path])
+      except OSError:
+        pass
+
+  size = sum(file[1] for file in files)
+  for mtime, file_size, file_name in sorted(files):
+    if size <= max_size_mb * 1000000: break
+    try:
+      os.remove(file_name)
+      size -= file_size
+    except OSError:
+      pass
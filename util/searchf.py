@@ -5,15 +5,38 @@
 #   getf
 #   listf
 #   create_searchf_namelist
+#   searchf_server
 #
 # See the Bmad manual for a description of listf and getf.
-# See create_searchf_namelist for documentation on the searchf.namelist files
+# See create_searchf_namelist for documentation on the searchf.namelist and searchf.db files.
+#
+# Each Fortran and C/C++ file is scanned into a list of definitions (sym_class instances) that
+# record where the definition and its comments are in the file. getf/listf print the definitions
+# that match the search string. If a root search directory has a searchf.db symbol index (made by
+# create_searchf_namelist), the matching definitions are looked up in the index and read directly
+# from the files without scanning any files. With the "-x" option, getf/listf instead print where a name
+# is used. The cross references are found by scan_refs and are also kept in searchf.db.
+# Scan results of index builds are cached by file contents using parse_cache.py. See cached_scan.
 #-
 
 import os
 import sys
 import re
-from multiprocessing import Pool, Process
+import io
+import json
+import mmap
+import time
+import bisect
+import signal
+import socket
+import sqlite3
+import difflib
+import hashlib
+import contextlib
+import multiprocessing
+import searchf_client
+import parse_cache
+import f90_struct_parser
 
 # The idea is to look for a local copy of the library to search.
 # We have found a local copy when we find one specific file that we know 
@@ -31,9 +54,31 @@ class search_com_class:
     self.doc_type       = 'FULL'   # (for getf), 'SHORT' (for listf), 'LIST' (for create_searchf_namelist), or 'RAW'
     self.match_str      = ''
     self.case_sensitive = False
-    self.namelist_file  = ''
     self.file_name_rel_root = ''   # File name relative to the root search directory
     self.search_only_for = ''
+    self.xref           = False    # List cross references instead of definitions ("-x" option).
+    self.json           = False    # Print one JSON object per line instead of text ("--json" option).
+    self.expand         = False    # Print struct components with nested structs expanded ("-e" option).
+    self.dir_list       = []       # Root search directories.
+    self.component_cache = {}      # Struct name -> component rows found by indexed_components.
+    self.n_proc         = os.cpu_count() or 1   # Number of processes used to scan files.
+    self.server         = None     # server_class instance when running as a query server.
+    self.re_match_str   = None     # Compiled match_str for Fortran names.
+    self.re_c_match_str = None     # Compiled match_str for C/C++ names.
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# real_path function
+#
+# File names are kept as they are printed which, for a relative name, is relative to the working directory
+# of the getf/listf command. work_dir is that directory. It is blank except in the query server which sets
+# it for each request instead of changing the working directory of the server process.
+# real_path returns the name to use when opening a file.
+
+work_dir = ''
+
+def real_path (file_name):
+  return os.path.join(work_dir, file_name)
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
@@ -43,22 +88,22 @@ def choose_path (dir_list, root_dir, base_dir, base_file, release_sub_dir):
   this_dir = ''
 
   if root_dir == '':
-    if os.path.isfile(base_dir + base_file):
+    if os.path.isfile(real_path(base_dir + base_file)):
       this_dir = base_dir
 
-    elif os.path.isfile('../' + base_dir + base_file):
+    elif os.path.isfile(real_path('../' + base_dir + base_file)):
       this_dir = '../' + base_dir
 
-    elif os.path.isfile('../../' + base_dir + base_file):
+    elif os.path.isfile(real_path('../../' + base_dir + base_file)):
       this_dir = '../../' + base_dir
 
-    elif os.path.isfile(release_sub_dir + base_dir + base_file):
+    elif os.path.isfile(real_path(release_sub_dir + base_dir + base_file)):
       this_dir = release_sub_dir + base_dir
 
-    elif os.path.isfile(release_dir + release_sub_dir + base_dir + base_file):
+    elif os.path.isfile(real_path(release_dir + release_sub_dir + base_dir + base_file)):
       this_dir = release_dir + release_sub_dir + base_dir
 
-    elif os.path.isfile(dist_dir + base_dir + base_file):
+    elif os.path.isfile(real_path(dist_dir + base_dir + base_file)):
       this_dir = dist_dir + base_dir
 
     # If release_dir is defined then we should have found the directory.
@@ -69,10 +114,10 @@ def choose_path (dir_list, root_dir, base_dir, base_file, release_sub_dir):
   else:
     if root_dir[-1] != '/': root_dir = root_dir + '/'
 
-    if os.path.isfile(root_dir + base_dir + base_file):
+    if os.path.isfile(real_path(root_dir + base_dir + base_file)):
       this_dir = root_dir + base_dir
 
-    elif os.path.isfile(root_dir + release_sub_dir + base_dir + base_file):
+    elif os.path.isfile(real_path(root_dir + release_sub_dir + base_dir + base_file)):
       this_dir = root_dir + release_sub_dir + base_dir
 
     else:
@@ -94,16 +139,25 @@ def print_help_message ():
   Options:
      -c          # Case sensitive search when searching C/C++ files.
      -d <s_dir>  # Use <s_dir> as the search directory. Will not search standard directories. 
+     -e          # Expand structs: For getf, print the components of a struct with the components of
+                 #   any component that is itself a struct printed (recursively) below it.
      -h          # Print this help message.
+     -j <n_proc> # Number of processes used to scan files. Default is the number of cores.
      -r <r_dir>  # Use <r_dir> as the root directory to search for the search directories.
      -s <what>   # Search only for: <what> = "struct", "routine", "parameter", or "module".
+     -x          # List where <search_string> is used (calls, use statements, struct components, etc.)
+                 #   instead of where it is defined. Only Fortran files are searched.
+     --json      # Print each match as a JSON object on its own line. Fields are:
+                 #   file, line, line_end, kind, name, args, doc, module
+                 #   With -x the fields are: file, line, kind, name, context, text
 
   Explanation: getf/listf will search the "Search directories" and any sub-directories
   for files of the type:
       *.f90    *.inc    *.cpp    *.h    *.c
   Within each of these files getf/listf will search for any routine, struct, parameter or 
   module that matches <search_string>. Wild cards "*" and "." may be used. See the Bmad
-  manual for more details.
+  manual for more details. If nothing matches, similar names are suggested when the
+  search directories have been indexed with create_searchf_namelist.
 
   Note: getf/listf look for search directories locally and then, if not found, look for the
   search directories in a release or distribution. The exception is that if the "-r <r_dir>" option
@@ -139,10 +193,82 @@ def routine_here (line2, routine_name):
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
-# search_f90 function
+# sym_class
+#
+# A definition found in a Fortran or C/C++ file.
+# The doc and body spans are lists of [byte_start, byte_end) ranges of whole lines in the file.
+# The doc spans are the comment lines before the definition and the body spans are the lines printed
+# by getf. Definitions with the same group number come from the same statement (for example, parameters
+# defined on the same line) and are printed only once.
+
+class sym_class:
+  def __init__(self, kind, name, line_num, group):
+    self.kind = kind           # 'module', 'parameter', 'type', 'interface', 'routine', or 'c_routine'.
+    self.name = name           # Lower case for Fortran.
+    self.line_num = line_num   # Line number of the definition. First line of the file is 1.
+    self.line_end = line_num   # Line number of the last line of the body.
+    self.group = group
+    self.module = ''           # Fortran module containing the definition.
+    self.doc = []
+    self.body = []
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# read_lines function
+#
+# Returns the lines of a file and the byte offset of the start of each line. Line endings are converted to "\n".
+# The offsets list has one extra entry which is the length of the file.
+
+def read_lines (file_name, encoding):
+  with open(real_path(file_name), 'rb') as f:
+    raw_lines = f.read().splitlines(True)
+
+  offsets = [0]
+  lines = []
+  for raw in raw_lines:
+    offsets.append(offsets[-1] + len(raw))
+    line = raw.decode(encoding, 'replace')
+    stripped = line.rstrip('\r\n')
+    lines.append(line if stripped == line else stripped + '\n')
+
+  return lines, offsets
+
+# Convert a list of line indexes to a list of byte spans. Adjacent lines are merged into one span.
+
+def line_spans (offsets, ix_lines):
+  spans = []
+  for ix in ix_lines:
+    if len(spans) > 0 and spans[-1][1] == offsets[ix]:
+      spans[-1][1] = offsets[ix+1]
+    else:
+      spans.append([offsets[ix], offsets[ix+1]])
+  return spans
+
+# Read the lines in a list of byte spans from an open (binary mode) file.
+
+def read_spans (f, spans, encoding):
+  lines = []
+  for start, end in spans:
+    f.seek(start)
+    lines += [raw.decode(encoding, 'replace').rstrip() for raw in f.read(end-start).splitlines()]
+  return lines
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# scan_f90 function
+#
+# Returns the list of definitions in a Fortran file.
+#
+# The file is memory mapped and searched as a single lower case byte string. Lines are only looked at if
+# they may be significant:
+#   Outside of routines: re_f90_top_hit finds the lines that are blank or start with a comment, a preprocessor
+#     directive or a keyword, and lines containing "parameter" are found with find. The lines in between
+#     can only end a comment block. Runs of comment lines are added to the comment block in one step.
+#   Inside of routines: Only lines containing "program", "subroutine", "function" or "interface" can start
+#     or end a routine. These are found with find.
+# The logic applied to these lines is the same as a line-by-line scan would apply to every line.
 
 re_blank_interface_begin = re.compile('interface\s*$')
-re_interface_end         = re.compile('end +interface')
 re_type_var              = re.compile(r'type *\(')
 re_type_def              = re.compile(r'type +\w')
 re_type_def_end          = re.compile('end +type')
@@ -150,110 +276,184 @@ re_module_begin          = re.compile('module')
 re_module_header_end     = re.compile('contains')
 re_parameter             = re.compile(' parameter\s*::')
 re_parameter1            = re.compile(r'\s*([\$\w]+)\s*(\(.+\)|)?\s*=')  # match to: "charge_of(-3:n_charge$) = "
+re_type_interface_def    = re.compile(r'(type|interface) +(\w+)\s')
 re_type_interface_end    = re.compile('end +(type|interface)')
 re_end                   = re.compile('end')
 re_routine_name_here     = re.compile('program|subroutine|function|interface')
 
-def search_f90 (file_name, search_com):
+# Byte regexes for the lower case file buffer. The patterns start with the newline ending the previous line
+# since a literal prefix makes the search much faster. f90_space matches what str.lstrip removes from a line.
 
-  re_match_str  = re.compile(search_com.match_str.lower() + '$')
-  re_type_interface_match = re.compile('^(type|interface) +' + search_com.match_str.lower() + '\s') 
+f90_space                = rb'[ \t\x0b\x0c\x1c-\x1f\x85\xa0]*'
+f90_top_hit              = f90_space + rb'(?:[!#]|\r?\n|type|interface|module|contains|end +type|program|subroutine|' + \
+                           rb'recursive|elemental|function|real\(rp\) *function|integer *function|logical *function)'
+re_f90_top_hit           = re.compile(rb'\n' + f90_top_hit)
+re_f90_first_line_hit    = re.compile(f90_top_hit)
+re_f90_interface_end     = re.compile(rb'\n' + f90_space + rb'end +interface')
+re_f90_type_interface_end = re.compile(rb'\n' + f90_space + rb'end +(?:type|interface)')
+re_f90_comment_run       = re.compile(rb'(?:' + f90_space + rb'!(?!---------)[^\n]*\n)*')   # Not separator comments
+re_lone_cr               = re.compile(rb'\r(?!\n)')
+f90_routine_keywords     = [b'program', b'subroutine', b'function', b'interface']
 
-  found_one_in_this_file = False
-  have_printed_file_name = False
+def scan_f90 (file_name):
+
+  with open(real_path(file_name), 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0: return []
+    try:
+      with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf:
+        low = buf[:].lower()
+    except (OSError, ValueError):
+      low = f.read().lower()
+
+  # Lone carriage returns are line ends. Changing them to newlines does not change any byte offsets.
+
+  if low.find(b'\r') != -1: low = re_lone_cr.sub(b'\n', low)
+
+  syms = scan_f90_buffer(low)
+  line_numbers(low, syms)
+  return syms
+
+# Returns the line that starts at byte pos (with the line end converted to "\n") and the start of the next line.
+
+def buffer_line (buf, pos):
+  ix = buf.find(b'\n', pos)
+  if ix == -1: return buf[pos:].decode('ISO-8859-1'), len(buf)
+  line = buf[pos:ix].decode('ISO-8859-1')
+  if line[-1:] == '\r': line = line[:-1]
+  return line + '\n', ix + 1
+
+# Converts the sym line_num and line_end byte offsets set by scan_f90_buffer to line numbers.
+
+def line_numbers (buf, syms):
+  line_num = {}
+  pos = 0
+  n_line = 1
+  for offset in sorted(set([sym.line_num for sym in syms] + [sym.line_end for sym in syms])):
+    n_line += buf.count(b'\n', pos, offset)
+    line_num[offset] = n_line
+    pos = offset
+
+  for sym in syms:
+    sym.line_num = line_num[sym.line_num]
+    sym.line_end = line_num[sym.line_end]
+
+#
+
+def scan_f90_buffer (buf):
+
+  size = len(buf)
+  syms = []
   in_module_header = False
   in_type_def = False
   routine_name = ['']
   blank_line_found = False
+  module_name = ''
+  comments = []      # Comment line spans
+  pos = 0            # Start of the line after the last line looked at.
 
-  comments = []
+  # Next occurrence, at or after pos, of "parameter" and the routine keywords, and the next top level hit.
+  # Saved since a search may go past the next line looked at.
 
-  try:
-    if sys.version_info[0] < 3:
-      f90_file = open(file_name, 'r')
-    else:
-      f90_file = open(file_name, 'r', encoding = 'ISO-8859-1')
-  except:
-    print ('Note: Cannot open: ' + file_name)
-    return
+  next_parameter = -1
+  next_keyword = [-1] * len(f90_routine_keywords)
+  next_top_hit = -1
+
+  # Adds a definition whose lines are from byte start to byte body_end. last_line is the start of the last line.
+
+  def add_sym (kind, name, start, last_line, body_end, group = None, doc = True):
+    if group is None: group = len(syms)
+    sym = sym_class(kind, name, start, group)
+    sym.line_end = last_line
+    sym.module = module_name
+    if doc: sym.doc = [span[:] for span in comments]
+    sym.body = [[start, body_end]]
+    syms.append(sym)
+
+  # Returns the start of the last line of a statement that is continued with "&" and the end of the statement.
+
+  def continuation_end (start, line, next_pos):
+    while line.rstrip()[-1:] == '&' and next_pos < size:
+      start = next_pos
+      line, next_pos = buffer_line(buf, start)
+    return start, next_pos
+
+  #
 
   while True:
-    line = f90_file.readline()
-    if line == '': return
+
+    # Find the next line to look at.
+
+    if next_top_hit < pos:
+      if pos == 0 and re_f90_first_line_hit.match(buf):
+        next_top_hit = 0
+      else:
+        match = re_f90_top_hit.search(buf, max(0, pos-1))
+        next_top_hit = size if match is None else match.start() + 1
+
+    if next_parameter < pos:
+      next_parameter = buf.find(b'parameter', pos)
+      if next_parameter == -1: next_parameter = size
+
+    if next_top_hit <= next_parameter:
+      start = next_top_hit
+    else:
+      start = buf.rfind(b'\n', 0, next_parameter) + 1
+
+    if start >= size: return syms
+    if start > pos: comments = []    # Lines skipped over end any comment block.
+    line, pos = buffer_line(buf, start)
+
+    # Line logic
+
     line2 = line.lstrip().lower()
-    if line2.rstrip() == '': 
+    if line2.rstrip() == '':
       blank_line_found = True
       continue
 
     # Skip blank interface blocks
 
     if re_blank_interface_begin.match(line2):
-      while True:
-        line = f90_file.readline()
-        if line == '': return
-        line2 = line.lstrip().lower()
-        if re_interface_end.match(line2): break
+      match = re_f90_interface_end.search(buf, pos-1)
+      if match is None: return syms
+      start = match.start() + 1
+      line, pos = buffer_line(buf, start)
+      line2 = line.lstrip().lower()
 
     # Skip "type (" constructs and separator comments.
 
     if re_type_var.match(line2): continue
     if line2[0] == '#': continue
     if line2[0:10] == '!---------': continue   # ignore separator comment
-    if line2[:11] == 'recursive &': 
-      comments.append(line)
+    if line2[:11] == 'recursive &':
+      if len(comments) > 0 and comments[-1][1] == start:
+        comments[-1][1] = pos
+      else:
+        comments.append([start, pos])
       continue
 
-
-    # In the header section of a module
+    # In the header section of a module.
+    # "module procedure" and "module function" lines do not start a new module.
+    # "module procedure" lines in named interface blocks are not definitions.
 
     match = re_module_begin.match(line2)
     if match:
       in_module_header = True
-      name_match = re.match('\w+', line2[match.end(0):].lstrip())
-      if name_match and 'module'.startswith(search_com.search_only_for):
-        module_name = name_match.group(0)
-        if re_match_str.match(module_name):
-          search_com.found_one = True
-          found_one_in_this_file = True
-          if search_com.doc_type == 'LIST':
-            if not have_printed_file_name: search_com.namelist_file.write('\nFile: '  + search_com.file_name_rel_root + '\n')
-            have_printed_file_name = True
-            search_com.namelist_file.write(module_name + '\n')
-          elif search_com.doc_type == 'FULL':
-            print ('\nFile: ', file_name)
-            for com in comments: print (com.rstrip())
-          elif search_com.doc_type == 'SHORT':
-            print ('\nFile: ' + file_name)
-            print ('    ' + line.rstrip())
+      name_match = re_routine_name.match(line2[match.end(0):].lstrip())
+      if name_match:
+        name = name_match.group(0)
+        if name not in ('procedure', 'function', 'subroutine'): module_name = name
+        if name != 'procedure': add_sym('module', name, start, start, pos)
 
     if not in_type_def and re_module_header_end.match(line2): in_module_header = False
-    
-    # Search for parameters
-
-    if in_module_header:
-      if re_parameter.search(line2) and 'parameter'.startswith(search_com.search_only_for):
-        chunks = re_parameter.split(line2)[1].split(',')
-        for chunk in chunks:
-          chunk_match = re_parameter1.match(chunk)
-          if chunk_match:
-            if search_com.doc_type == 'LIST':
-              if not have_printed_file_name: search_com.namelist_file.write('\nFile: '  + search_com.file_name_rel_root + '\n')
-              have_printed_file_name = True
-              search_com.namelist_file.write(chunk_match.group(1) + '\n')
-            elif search_com.doc_type != 'RAW':
-              param = chunk_match.group(1)
-              if re_match_str.match(param) or \
-                 (param[-1] == '$' and re_match_str.match(param[:-1])):
-                search_com.found_one = True
-                found_one_in_this_file = True
-                if not have_printed_file_name:
-                  print ('\nFile: ' + file_name)
-                  have_printed_file_name = True
-                print ('    ' + line.rstrip())
-                while line.rstrip()[-1] == '&':
-                  line = f90_file.readline()
-                  print ('    ' + line.rstrip())                
-                break
+
+    # Parameters
+
+    if in_module_header and re_parameter.search(line2):
+      last_line, end = continuation_end(start, line, pos)
+      group = len(syms)
+      for chunk in re_parameter.split(line2)[1].split(','):
+        chunk_match = re_parameter1.match(chunk)
+        if chunk_match: add_sym('parameter', chunk_match.group(1), start, last_line, end, group, False)
 
     # Add to comment block if a comment
 
@@ -261,78 +461,61 @@ def search_f90 (file_name, search_com):
       if blank_line_found:
         comments = []
         blank_line_found = False
-      if search_com.doc_type == 'FULL': comments.append(line)
+      if len(comments) > 0 and comments[-1][1] == start:
+        comments[-1][1] = pos
+      else:
+        comments.append([start, pos])
+
+      # Add any following comment lines in one step.
+
+      end = re_f90_comment_run.match(buf, pos).end()
+      if end > pos and in_module_header:
+        if next_parameter < pos:
+          next_parameter = buf.find(b'parameter', pos)
+          if next_parameter == -1: next_parameter = size
+        if next_parameter < end: end = buf.rfind(b'\n', 0, next_parameter) + 1
+      if end > pos:
+        comments[-1][1] = end
+        pos = end
       continue
 
-    # Match to type or interface statement
-    # These we type the whole definition
+    # Type or interface statement. The body is the whole definition.
+    # The lines of a named interface block are scanned so that the routines declared in the block are found.
 
     if in_type_def and re_type_def_end.match(line2): in_type_def = False
     if not in_type_def and re_type_def.match(line2): in_type_def = True
 
-    match = re_type_interface_match.match(line2)
-    if match and 'struct'.startswith(search_com.search_only_for):
-      search_com.found_one = True
-      found_one_in_this_file = True
-
-      if search_com.doc_type == 'LIST':
-        if not have_printed_file_name: search_com.namelist_file.write('\nFile: '  + search_com.file_name_rel_root + '\n')
-        have_printed_file_name = True
-        search_com.namelist_file.write(match.group(2) + '\n')
-      elif search_com.doc_type == 'FULL':
-        print ('\nFile: ' + file_name)
-        for com in comments: print (com.rstrip())
-        if len(comments) > 0: print ('')
-        print (line.rstrip())
-        while True:
-          line = f90_file.readline()
-          if line == '': return
-          line2 = line.lstrip().lower()
-          print (line.rstrip())
-          if re_type_interface_end.match(line2): break
-          in_type_def = False
-      elif search_com.doc_type == 'SHORT':
-        print ('\nFile: ' + file_name)
-        print ('    ' + line.rstrip())
-      elif search_com.doc_type == 'RAW':
-        while True:
-          line = f90_file.readline()
-          if line == '': return
-          line2 = line.lstrip().lower()
-          if re_type_interface_end.match(line2): break
-          print (line.rstrip())
-          in_type_def = False
-
+    match = re_type_interface_def.match(line2)
+    if match:
+      end_match = re_f90_type_interface_end.search(buf, pos-1)
+      if end_match is None:
+        last_line = buf.rfind(b'\n', 0, size-1) + 1
+        end = size
+      else:
+        last_line = end_match.start() + 1
+        end = buffer_line(buf, last_line)[1]
+      add_sym(match.group(1), match.group(2), start, last_line, end)
       comments = []
       continue
 
-    # match to subroutine, function, etc.
+    # Subroutine, function, etc.
 
     if routine_here(line2, routine_name):
-      if re_match_str.match(routine_name[0]) and 'routine'.startswith(search_com.search_only_for):
-        search_com.found_one = True
-        found_one_in_this_file = True
-        if search_com.doc_type == 'LIST':
-          if not have_printed_file_name: search_com.namelist_file.write('\nFile: '  + search_com.file_name_rel_root + '\n')
-          have_printed_file_name = True
-          search_com.namelist_file.write(routine_name[0] + '\n')
-        elif search_com.doc_type == 'FULL':
-          print ('\nFile: ' + file_name)
-          for com in comments: print (com.rstrip())
-          while True:
-            print (line.rstrip())
-            if line.rstrip()[-1] != '&': break
-            line = f90_file.readline()
-        else:
-          print ('\nFile: ' + file_name)
-          print ('    ' + line.rstrip())
+      last_line, end = continuation_end(start, line, pos)
+      add_sym('routine', routine_name[0], start, last_line, end)
 
       # Skip rest of routine including contained routines
 
       count = 1
       while True:
-        line = f90_file.readline()
-        if line == '': return
+        for ik, keyword in enumerate(f90_routine_keywords):
+          if next_keyword[ik] < pos:
+            next_keyword[ik] = buf.find(keyword, pos)
+            if next_keyword[ik] == -1: next_keyword[ik] = size
+        next_pos = min(next_keyword)
+        if next_pos == size: return syms
+
+        line, pos = buffer_line(buf, buf.rfind(b'\n', 0, next_pos) + 1)
         line2 = line.lstrip().lower()
 
         if re_end.match(line2):
@@ -349,28 +532,29 @@ def search_f90 (file_name, search_com):
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
-# search_c function
+# scan_c function
+#
+# Returns the list of routines in a C/C++ file.
+# The name of a routine is any word, preceded by a blank, which is followed by an argument list and the
+# opening curly bracket. All such words of a function line are recorded with the same group number.
 
 re_quote            = re.compile('"|\'')
+re_c_name           = re.compile(r' (\w+)')
+re_c_args           = re.compile(r'\s*(\(.*\))\s*{')
+
+def scan_c (file_name):
 
-def search_c (file_name, search_com):
+  lines, offsets = read_lines(file_name, 'utf-8')
 
-  found_one_in_this_file = False
+  syms = []
   in_extended_comment = False
   blank_line_here = False
   n_curly = 0
   comments = []
   lines_after_comments = []
   function_line = ''
-  have_printed_file_name = False
 
-  c_file = open(file_name)
-  while True:
-    try:
-      line = c_file.readline()
-    except:
-      continue    # If line contains a non-ascii character.
-    if line == '': return
+  for ix_line, line in enumerate(lines):
     line2 = line.lstrip()
     if line2.rstrip() == '':
       blank_line_here = True
@@ -382,11 +566,10 @@ def search_c (file_name, search_com):
 
     # Throw out quoted substrings
 
-    line2.replace(r'\"', '').replace(r"\'", '')
     while True:
       match = re_quote.search(line2)
       if not match: break
-      char = match.group(0)      
+      char = match.group(0)
       ix = line2.find(char, match.end(0))
       if ix == -1: break
       line2 = line2[0:match.start(0)] + line2[ix+1:]
@@ -394,15 +577,14 @@ def search_c (file_name, search_com):
     # Look For multiline comment "/* ... */" construct and remove if present.
 
     if n_curly == 0:
-      if line2[0:2] == '//' or line2[0:2] == '/*' or in_extended_comment: 
+      if line2[0:2] == '//' or line2[0:2] == '/*' or in_extended_comment:
         if blank_line_here:
           comments = []
           blank_line_here = False
-        comments.append(line)
+        comments.append(ix_line)
         lines_after_comments = []
       else:
-        lines_after_comments.append(line)
-
+        lines_after_comments.append(ix_line)
 
     while True:
       ix_save = 0
@@ -427,43 +609,586 @@ def search_c (file_name, search_com):
 
     for char in line2:
 
-      if n_curly == 0: 
+      if n_curly == 0:
         function_line = function_line + char
-        if char == ';': 
+        if char == ';':
           function_line = ''
           comments = []
           lines_after_comments = []
 
       if char == '{':
         n_curly += 1
-        if n_curly == 1:
-          if search_com.case_sensitive:
-            is_match = re.search(' ' + search_com.match_str + '_?\s*(\(.*\))\s*{', function_line)
-          else:
-            is_match = re.search(' ' + search_com.match_str + '_?\s*(\(.*\))\s*{', function_line, re.I)
-          if is_match and 'routine'.startswith(search_com.search_only_for):
-            search_com.found_one = True
-            if search_com.doc_type == 'LIST':
-              if not have_printed_file_name: search_com.namelist_file.write('\nFile: '  + search_com.file_name_rel_root + '\n')
-              have_printed_file_name = True
-              search_com.namelist_file.write(is_match.group(1) + '\n')
-            elif search_com.doc_type == 'FULL':
-              print ('\nFile: ' + file_name)
-              for com in comments: print (com.rstrip())
-              for com in lines_after_comments: print (com.rstrip())
-            else:
-              if not found_one_in_this_file: 
-                print ('\nFile: ' + file_name)
-                found_one_in_this_file = True
-              for com in lines_after_comments: print ('    ' + com.rstrip())
+        if n_curly == 1 and len(lines_after_comments) > 0:
+          group = len(syms)
+          for match in re_c_name.finditer(function_line):
+            if not re_c_args.match(function_line, match.end(0)): continue
+            sym = sym_class('c_routine', match.group(1), lines_after_comments[0]+1, group)
+            sym.line_end = lines_after_comments[-1] + 1
+            sym.doc = line_spans(offsets, comments)
+            sym.body = line_spans(offsets, lines_after_comments)
+            syms.append(sym)
 
       elif char == '}':
         n_curly -= 1
-        if n_curly == 0: 
+        if n_curly == 0:
           function_line = ''
           comments = []
           lines_after_comments = []
-  return
+
+  return syms
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# scan_refs function
+#
+# Returns the cross references in a Fortran file. A reference is any use of a name outside of comments
+# and strings. The kind of reference is:
+#   'call'       ! "call <name>"
+#   'use'        ! "use <name>" module statement.
+#   'component'  ! "%<name>" struct component access.
+#   'type'       ! "type(<name>)" or "class(<name>)" declaration.
+#   'ref'        ! Anything else: Function references, parameters, variables, etc.
+# The context of a reference is the innermost routine, struct definition, or module containing it.
+#
+# The references are returned as a list of [name, kind, context, lines] where lines is the list
+# of [line number, byte offset of line start] where the name is used with that kind and context.
+# C/C++ files are not scanned for references.
+
+re_f90_ref      = re.compile(r'(?:(?<![\w$])(call)\s+|(%)\s*|(?<![\w$])(type|class)\s*\(\s*|(?<![\w$]))([a-z][\w$]*)')
+re_f90_use      = re.compile(r'use\s*(?:,\s*\w+\s*)?(?:::)?\s*(\w+)')
+re_f90_noncode  = re.compile(r'''"[^"]*"?|'[^']*'?|!.*''')
+re_f90_end_routine = re.compile(r'end\s*(program|subroutine|function|$)')
+re_f90_end_type = re.compile(r'end\s*type')
+re_f90_type_def = re.compile(r'type\s*(?:,[^:]*::\s*|\s+|::\s*)(\w+)')
+
+f90_keywords = set(['if', 'then', 'else', 'elseif', 'end', 'endif', 'enddo', 'do', 'while', 'select', 'case',
+                    'default', 'where', 'elsewhere', 'forall', 'return', 'stop', 'exit', 'cycle', 'go', 'to',
+                    'goto', 'continue', 'contains', 'implicit', 'none', 'integer', 'real', 'logical',
+                    'character', 'complex', 'double', 'precision', 'dimension', 'allocatable', 'pointer',
+                    'target', 'intent', 'in', 'out', 'inout', 'optional', 'save', 'parameter', 'public',
+                    'private', 'protected', 'external', 'intrinsic', 'allocate', 'deallocate', 'nullify',
+                    'module', 'procedure', 'interface', 'subroutine', 'function', 'program', 'recursive',
+                    'elemental', 'pure', 'result', 'use', 'only', 'kind', 'len', 'print', 'write', 'read',
+                    'open', 'close', 'format', 'sequence', 'extends', 'abstract', 'bind', 'value', 'block',
+                    'associate', 'type', 'class', 'call', 'operator', 'assignment', 'generic', 'final'])
+
+def scan_refs (file_name):
+
+  if file_encoding(file_name) != 'ISO-8859-1': return []
+
+  with open(real_path(file_name), 'rb') as f:
+    text = f.read().lower().decode('ISO-8859-1')   # Latin-1 so string offsets are byte offsets.
+  if text.find('\r') != -1: text = re.sub('\r(?!\n)', '\n', text)    # Lone carriage returns are line ends.
+
+  refs = {}           # (name, kind, context) -> lines
+  context = []        # Stack of [name, is_type_def] of the routines and struct definitions being scanned.
+  module_name = ''
+  offset = 0
+
+  for ix_line, line in enumerate(text.split('\n')):
+    start = offset
+    offset += len(line) + 1
+    code = line.strip()
+    if code == '' or code[0] == '!' or code[0] == '#': continue
+    if '!' in code or '"' in code or "'" in code:
+      code = re_f90_noncode.sub(lambda match: '' if match.group(0)[0] == '!' else '""', code).rstrip()
+
+    # Track the routine, struct definition and module that references are in.
+    # The name being defined on a line is not a reference.
+
+    defined = ''
+    if code[:3] == 'end':
+      if re_f90_end_routine.match(code) or re_f90_end_type.match(code):
+        if len(context) > 0: context.pop()
+        continue
+      if code[3:].lstrip()[:6] == 'module': continue
+
+    routine_name = ['']
+    if routine_here(code + ' ', routine_name) and not code.startswith('interface'):
+      defined = routine_name[0]
+      context.append([defined, False])
+    elif code[:4] == 'type':
+      match = re_f90_type_def.match(code)
+      if match:
+        defined = match.group(1)
+        context.append([defined, True])
+    elif code[:6] == 'module':
+      match = re_routine_name.match(code[6:].lstrip())
+      if match and match.group(0) not in ('procedure', 'function', 'subroutine'):
+        module_name = match.group(0)
+        continue
+
+    this_context = context[-1][0] if len(context) > 0 else module_name
+    pos = 0
+
+    if code[:3] == 'use':
+      match = re_f90_use.match(code)
+      if match:
+        refs.setdefault((match.group(1), 'use', this_context), []).append([ix_line+1, start])
+        pos = match.end(0)
+
+    for match in re_f90_ref.finditer(code, pos):
+      name = match.group(4)
+      if match.group(1):
+        kind = 'call'
+      elif match.group(2):
+        kind = 'component'
+      elif match.group(3):
+        kind = 'type'
+      else:
+        if name in f90_keywords or name == defined: continue
+        if code[match.start(4)-1:match.start(4)] == '.' and code[match.end(4):match.end(4)+1] == '.': continue   # .and. etc.
+        kind = 'ref'
+      lines = refs.setdefault((name, kind, this_context), [])
+      if len(lines) == 0 or lines[-1][0] != ix_line+1: lines.append([ix_line+1, start])
+
+  return [[name, kind, context, lines] for (name, kind, context), lines in refs.items()]
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# parse_components function
+#
+# Returns the components (f90_struct_parser.arg_class instances) of a struct given the lines of its definition.
+# The lines are parsed with f90_struct_parser.parse_struct_component after statements continued with "&" are joined.
+# Type bound procedures are ignored. Parser warnings are appended to the notes list and statements that cannot be
+# parsed are appended to the errors list.
+
+def parse_components (struct_name, lines, notes = None, errors = None):
+  if notes is None: notes = []
+  args = []
+  pending = ''      # Code of a statement continued with "&".
+  comment = ''
+
+  for line in lines[1:]:
+    if f90_struct_parser.re_end_type.match(line) or f90_struct_parser.re_contains.match(line): break
+    if line.lstrip()[:1] == '#': continue
+    code, bang, this_comment = line.partition('!')
+    code = code.strip()
+    if pending != '':
+      if code == '': continue
+      code = code.lstrip('&').lstrip()
+    if comment == '': comment = this_comment.strip()
+
+    if code[-1:] == '&':
+      pending += code[:-1] + ' '
+      continue
+
+    statement = pending + code
+    pending = ''
+    if statement != '':
+      if comment != '': statement += ' ! ' + comment
+      try:
+        args += f90_struct_parser.parse_struct_component(statement, struct_name, notes)
+      except (ValueError, IndexError):
+        if errors is not None: errors.append(statement)
+    comment = ''
+
+  return args
+
+# Component row used by the searchf.db components table and print_components:
+#   [name, type, kind, pointer, array, init, comment]
+# where pointer is '', 'pointer', or 'allocatable', and array is the dimensions. EG: "(0:6,3)".
+
+pointer_type_name = {f90_struct_parser.NOT: '', f90_struct_parser.PTR: 'pointer', f90_struct_parser.ALLOC: 'allocatable'}
+
+def component_row (arg):
+  return [arg.f_name, 'integer' if arg.type == 'integer8' else arg.type, arg.kind,
+          pointer_type_name[arg.pointer_type], arg.full_array, arg.init_value, arg.comment]
+
+# Returns the structs of a Fortran file as a dict: struct name -> [components, notes, errors].
+# See parse_components. If a struct is defined more than once, only the first definition is used.
+
+def scan_structs (file_name, hash = None, save = False):
+  structs = {}
+  syms = cached_scan(file_name, 'syms', hash, save)
+  with open(real_path(file_name), 'rb') as f:
+    for sym in syms:
+      if sym.kind != 'type' or sym.name in structs: continue
+      notes = []
+      errors = []
+      args = parse_components(sym.name, read_spans(f, sym.body, 'ISO-8859-1'), notes, errors)
+      structs[sym.name] = [args, notes, errors]
+  return structs
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# scan_file function
+#
+# Returns the list of definitions in a file or None if the file is not a Fortran or C/C++ file.
+
+def file_encoding (file_name):
+  if file_name[-4:] == '.f90' or file_name[-4:] == '.inc': return 'ISO-8859-1'
+  if file_name[-4:] == '.cpp' or file_name[-2:] == '.h' or file_name[-2:] == '.c': return 'utf-8'
+  return None
+
+def scan_file (file_name):
+  encoding = file_encoding(file_name)
+  if encoding is None: return None
+  if encoding == 'utf-8': return scan_c(file_name)
+  return scan_f90(file_name)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# cached_scan function
+#
+# Returns the result of scanning a file using the parse cache (see parse_cache.py) which is shared with
+# cpp_bmad_interface/scripts/create_interface.py. The part argument selects the scan:
+#   'syms'     ! scan_file
+#   'refs'     ! scan_refs
+#   'structs'  ! scan_structs
+# hash is the sha1 hash of the file contents. It is computed if not given.
+# A result not in the cache is only saved if save is True. Only index builds save so that searches
+# without an index do not write to the cache.
+# parse_cache_version must be changed whenever the output of a scan changes.
+
+parse_cache_version = '2'
+
+def cached_scan (file_name, part, hash = None, save = False):
+  if part == 'syms':
+    scan = lambda: scan_file(file_name)
+  elif part == 'refs':
+    scan = lambda: scan_refs(file_name)
+  else:
+    scan = lambda: scan_structs(file_name, hash, save)
+
+  if not parse_cache.enabled(): return scan()
+
+  if hash is None: hash = parse_cache.file_hash(real_path(file_name))
+  key = part + '-' + file_name[file_name.rfind('.')+1:] + '-v' + parse_cache_version   # Scans depend upon the file type.
+  result = parse_cache.load(hash, key, save)
+  if result is None:
+    result = scan()
+    if save: parse_cache.save(hash, key, result)
+  return result
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# map_files function
+#
+# Generator that applies a job function to each item of job_args and returns the results in job_args order.
+# With n_proc > 1 the jobs are run by a pool of processes. Since the results are returned in the same
+# order as a serial run, the output does not depend upon the number of processes.
+# Jobs must not print. Messages are returned to the calling process instead.
+
+min_files_per_process = 20
+
+def map_files (job, job_args, n_proc):
+  n_proc = min(n_proc, len(job_args) // min_files_per_process)
+  if n_proc > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    with multiprocessing.get_context('fork').Pool(n_proc) as pool:
+      for result in pool.imap(job, job_args, 8): yield result
+  else:
+    for args in job_args: yield job(args)
+
+# Scan a file. Returns [syms, note] where note is an error message or blank.
+
+def scan_file_job (file_name):
+  try:
+    return [cached_scan(file_name, 'syms'), '']
+  except IOError:
+    return [[], 'Note: Cannot open: ' + file_name]
+
+# Scan a file for cross references. Returns [refs, note].
+
+def scan_refs_job (file_name):
+  try:
+    return [cached_scan(file_name, 'refs'), '']
+  except IOError:
+    return [[], 'Note: Cannot open: ' + file_name]
+
+# Hash a file and scan it for definitions, cross references and struct components if the hash is not old_hash.
+# Returns [hash, syms, refs, components, note]. syms, refs and components are None if the file was not scanned.
+
+def index_file_job (args):
+  file_name, old_hash = args
+  try:
+    with open(real_path(file_name), 'rb') as f:
+      hash = hashlib.sha1(f.read()).hexdigest()
+    if hash == old_hash: return [hash, None, None, None, '']
+    components = []
+    for name, [args, notes, errors] in cached_scan(file_name, 'structs', hash, True).items():
+      components += [[name, seq] + component_row(arg) for seq, arg in enumerate(args)]
+    return [hash, cached_scan(file_name, 'syms', hash, True), cached_scan(file_name, 'refs', hash, True), components, '']
+  except IOError:
+    return [None, None, None, None, 'Note: Cannot open: ' + file_name]
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# sym_matches function
+#
+# Returns True if a definition matches the search string and the "-s" option.
+
+def sym_matches (sym, search_com):
+  only = search_com.search_only_for
+  kind = sym.kind
+
+  if kind == 'module':
+    if not 'module'.startswith(only): return False
+  elif kind == 'parameter':
+    if not 'parameter'.startswith(only) or search_com.doc_type == 'RAW': return False
+  elif kind == 'type':
+    if not 'struct'.startswith(only): return False
+  elif kind == 'interface':
+    if not 'struct'.startswith(only) and not 'routine'.startswith(only): return False
+  else:
+    if not 'routine'.startswith(only): return False
+
+  name = sym.name
+  if kind == 'c_routine':
+    re_match_str = search_com.re_c_match_str
+    return re_match_str.match(name) or (name[-1] == '_' and re_match_str.match(name[:-1]))
+  else:
+    re_match_str = search_com.re_match_str
+    return re_match_str.match(name) or (kind == 'parameter' and name[-1] == '$' and re_match_str.match(name[:-1]))
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_note function
+#
+# Prints a note, like a file that cannot be opened, found during a search. With --json, notes go to stderr
+# so that the output only has JSON records.
+
+def print_note (note, search_com):
+  print (note, file = sys.stderr if search_com.json else sys.stdout)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_syms function
+#
+# Prints the matched definitions in a file. The definitions must be in file order.
+
+def print_syms (file_name, syms, search_com):
+
+  if len(syms) == 0: return
+  search_com.found_one = True
+
+  if search_com.json:
+    print_syms_json(file_name, syms)
+    return
+
+  doc_type = search_com.doc_type
+  encoding = file_encoding(file_name)
+  have_printed_file_name = False
+  groups_printed = set()
+
+  try:
+    f = open(real_path(file_name), 'rb')
+  except IOError:
+    print ('Note: Cannot open: ' + file_name)
+    return
+
+  for sym in syms:
+    if sym.group in groups_printed: continue
+    groups_printed.add(sym.group)
+
+    doc = read_spans(f, sym.doc, encoding)
+    body = read_spans(f, sym.body, encoding)
+    kind = sym.kind
+    if kind == 'interface' and not 'struct'.startswith(search_com.search_only_for):
+      kind = 'routine'
+      body = body[:1]
+
+    if kind == 'module':
+      if doc_type == 'FULL':
+        print ('\nFile: ', file_name)
+        for com in doc: print (com)
+      elif doc_type == 'SHORT':
+        print ('\nFile: ' + file_name)
+        print ('    ' + body[0])
+
+    elif kind == 'parameter' or (kind == 'c_routine' and doc_type != 'FULL'):
+      if not have_printed_file_name:
+        print ('\nFile: ' + file_name)
+        have_printed_file_name = True
+      for line in body: print ('    ' + line)
+
+    elif kind == 'type' or kind == 'interface':
+      if doc_type == 'FULL':
+        print ('\nFile: ' + file_name)
+        for com in doc: print (com)
+        if len(doc) > 0: print ('')
+        if kind == 'type' and search_com.expand:
+          print (body[0])
+          print_components([component_row(arg) for arg in parse_components(sym.name, body)], search_com, '  ', [sym.name.lower()])
+          print (body[-1])
+        else:
+          for line in body: print (line)
+      elif doc_type == 'SHORT':
+        print ('\nFile: ' + file_name)
+        print ('    ' + body[0])
+      elif doc_type == 'RAW':
+        if re_type_interface_end.match(body[-1].lstrip().lower()) and len(body) > 1: body = body[:-1]
+        for line in body[1:]: print (line)
+
+    else:
+      print ('\nFile: ' + file_name)
+      if doc_type == 'FULL':
+        for com in doc: print (com)
+        for line in body: print (line)
+      else:
+        print ('    ' + body[0])
+
+  f.close()
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_components function
+#
+# Prints struct component rows (see component_row) for the "-e" option. Components that are structs
+# are followed by the components of that struct, indented, unless this would be recursive.
+# path is the list of structs being expanded.
+
+def print_components (rows, search_com, indent, path):
+  for name, type, kind, pointer, array, init, comment in rows:
+    line = indent + type + ('' if kind == '' else '(' + kind + ')') + ('' if pointer == '' else ', ' + pointer) + \
+           ' :: ' + name + array
+    if init != '': line += (' =' if init[0] == '>' else ' = ') + init    # '>' for "=> null()"
+    if comment != '': line = '%-60s ! %s' % (line, comment)
+    print (line)
+
+    if type != 'type' and type != 'class': continue
+    struct_name = kind.lower()
+    if struct_name in path: continue
+    nested = indexed_components(struct_name, search_com)
+    if len(nested) > 0: print_components(nested, search_com, indent + '    ', path + [struct_name])
+
+# Returns the component rows of a struct from the symbol index of the first root search directory that
+# defines the struct. Returns an empty list if the struct is not found.
+
+def indexed_components (struct_name, search_com):
+  if struct_name in search_com.component_cache: return search_com.component_cache[struct_name]
+
+  rows = []
+  for search_base_dir in search_com.dir_list:
+    if search_base_dir == '': continue
+    if search_base_dir[-1] != '/': search_base_dir = search_base_dir + '/'
+    db = open_index(search_base_dir)
+    if db is None: continue
+    rows = db.execute('select file_id, components.name, type, kind, pointer, array, init, comment from components ' + \
+                      'join files on files.id = file_id where struct_lower = ? order by ord, seq', (struct_name,)).fetchall()
+    db.close()
+    if len(rows) > 0:
+      rows = [list(row[1:]) for row in rows if row[0] == rows[0][0]]   # Only use the first definition.
+      break
+
+  search_com.component_cache[struct_name] = rows
+  return rows
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_syms_json function
+#
+# Prints the matched definitions in a file as JSON objects, one per line. Each object is written as soon
+# as it is found so that a program reading the output can process the matches as they come.
+# Unlike the text output, definitions in the same group (for example, parameters defined on the same line)
+# are written separately.
+
+def print_syms_json (file_name, syms):
+  encoding = file_encoding(file_name)
+
+  try:
+    f = open(real_path(file_name), 'rb')
+  except IOError:
+    print ('Note: Cannot open: ' + file_name, file = sys.stderr)
+    return
+
+  for sym in syms:
+    body = read_spans(f, sym.body, encoding)
+    print (json.dumps({'file': file_name, 'line': sym.line_num, 'line_end': sym.line_end, 'kind': sym.kind,
+                       'name': sym.name, 'args': sym_args(sym, body), 'doc': '\n'.join(read_spans(f, sym.doc, encoding)),
+                       'module': sym.module}), flush = True)
+
+  f.close()
+
+# Returns the list of dummy arguments of a routine given the lines of its definition statement.
+# Returns an empty list for other kinds of definitions.
+
+def sym_args (sym, body):
+  if sym.kind == 'routine':
+    code = ' '.join(line.split('!')[0].replace('&', ' ') for line in body)
+    match = re.search(r'\b' + re.escape(sym.name) + r'\s*\(([^)]*)\)', code, re.I)
+  elif sym.kind == 'c_routine':
+    code = ' '.join(line.split('//')[0] for line in body)
+    match = re.search(r'\b' + re.escape(sym.name) + r'\s*\((.*)\)[^()]*{', code)
+  else:
+    return []
+
+  if not match: return []
+
+  args = ['']
+  depth = 0
+  for char in match.group(1):
+    if char == ',' and depth == 0:
+      args.append('')
+      continue
+    if char in '(<[': depth += 1
+    if char in ')>]': depth -= 1
+    args[-1] += char
+  return [arg.strip() for arg in args if arg.strip() != '']
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_refs function
+#
+# Prints the matched cross references in a file. The references are grouped by context.
+# For getf each referencing line is printed. For listf only the contexts and kinds of reference are printed.
+
+def ref_matches (name, search_com):
+  re_match_str = search_com.re_match_str
+  return re_match_str.match(name) or (name[-1] == '$' and re_match_str.match(name[:-1]))
+
+def print_refs (file_name, refs, search_com):
+
+  if len(refs) == 0: return
+  search_com.found_one = True
+
+  contexts = {}    # context -> [kinds, lines]
+  for name, kind, context, lines in sorted(refs, key = lambda ref: (ref[3][0][0], ref[0], ref[1])):
+    this = contexts.setdefault(context, [[], []])
+    if kind not in this[0]: this[0].append(kind)
+    this[1] += lines
+
+  if search_com.json:
+    print_refs_json(file_name, refs)
+    return
+
+  print ('\nFile: ' + file_name)
+
+  if search_com.doc_type != 'FULL':
+    for context, [kinds, lines] in contexts.items():
+      print ('    ' + (context or '(top level)') + '  (' + ', '.join(kinds) + ')')
+    return
+
+  try:
+    f = open(real_path(file_name), 'rb')
+  except IOError:
+    print ('Note: Cannot open: ' + file_name)
+    return
+
+  for context, [kinds, lines] in contexts.items():
+    print ('  In ' + (context or '(top level)') + ':')
+    for line_num, offset in sorted(set(tuple(line) for line in lines)):
+      f.seek(offset)
+      print ('  %6d  ' % line_num + f.readline().splitlines()[0].decode('ISO-8859-1', 'replace').strip())
+
+  f.close()
+
+# JSON version of print_refs. One object per referencing line.
+
+def print_refs_json (file_name, refs):
+  try:
+    f = open(real_path(file_name), 'rb')
+  except IOError:
+    print ('Note: Cannot open: ' + file_name, file = sys.stderr)
+    return
+
+  for line_num, offset, name, kind, context in sorted([line[0], line[1], name, kind, context]
+                                                      for name, kind, context, lines in refs for line in lines):
+    f.seek(offset)
+    print (json.dumps({'file': file_name, 'line': line_num, 'kind': kind, 'name': name, 'context': context,
+                       'text': f.readline().splitlines()[0].decode('ISO-8859-1', 'replace').strip()}), flush = True)
+
+  f.close()
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
@@ -474,8 +1199,402 @@ def search_file (search_base_dir, file_dir, file_name, search_com):
   if file_name[0] == '.': return
   full_file_name = os.path.join(file_dir, file_name)
   search_com.file_name_rel_root = full_file_name.replace(search_base_dir, '', 1)
-  if file_name[-4:] == '.f90' or file_name[-4:] == '.inc': search_f90(full_file_name, search_com)
-  if file_name[-4:] == '.cpp' or file_name[-2:] == '.h' or file_name[-2:] == '.c': search_c(full_file_name, search_com)
+
+  syms, note = scan_file_job(full_file_name)
+  if note != '': print_note(note, search_com)
+  if syms is None: return
+  print_syms(full_file_name, [sym for sym in syms if sym_matches(sym, search_com)], search_com)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# tree_files function
+#
+# Generator for the Fortran and C/C++ files in a root search directory tree in search order.
+# Returns [full_file_name, file_name_rel_root] for each file.
+
+def tree_files (search_base_dir):
+
+  real_base_dir = real_path(search_base_dir)
+  for this_search_base_dir, sub_dirs, files in os.walk(real_base_dir):
+    this_search_base_dir = search_base_dir + this_search_base_dir[len(real_base_dir):]
+
+    # Remove from searching hidden directories plus "production" and "debug" derectories
+    i = 0
+    while i < len(sub_dirs):
+      if sub_dirs[i] == 'production' or sub_dirs[i] == 'debug' or sub_dirs[i][0] == '.':
+        del sub_dirs[i]
+      else:
+        i += 1
+
+    for this_file in files:
+      if re.search ('#', this_file) or this_file[0] == '.': continue
+      if file_encoding(this_file) is None: continue
+      full_file_name = os.path.join(this_search_base_dir, this_file)
+      yield full_file_name, full_file_name.replace(search_base_dir, '', 1)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# Symbol index database.
+#
+# The searchf.db file in a root search directory is an SQLite database with tables:
+#   meta      ! key/value pairs. Key "schema_version" is index_schema_version.
+#   files     ! Files relative to the root search directory. "ord" is the search order.
+#             !   mtime (ns), size and hash (sha1) are used to find the files that have changed.
+#   symbols   ! One row per sym_class definition. Spans are stored as JSON lists.
+#   refs      ! Cross references (see scan_refs). One row per name, kind and context in a file.
+#             !   The [line number, byte offset] list of the references is stored as JSON.
+#   trigrams  ! One row for each three character substring of each distinct definition name.
+#   components  ! Struct components (see component_row). One row per component.
+# Lookup is by an index on the lower case name so only the definitions whose names start
+# with the literal prefix of the search string are examined. If the search string starts with a
+# wild card, the names are found with the trigrams of the literal parts of the search string.
+# The trigrams are also used to find similar names ("did you mean") when nothing matches.
+
+index_file_name = 'searchf.db'
+index_schema_version = 6
+
+index_schema = '''
+  create table meta (key text primary key, value text);
+  create table files (id integer primary key, name text not null unique, ord integer not null,
+                      mtime integer not null, size integer not null, hash text not null);
+  create table symbols (file_id integer not null, seq integer not null, grp integer not null,
+                        kind text not null, name text not null, name_lower text not null,
+                        module text not null, line integer not null, line_end integer not null,
+                        offset integer not null, doc text not null, body text not null);
+  create index symbols_name on symbols (name_lower);
+  create index symbols_file on symbols (file_id);
+  create table refs (file_id integer not null, name_lower text not null, kind text not null,
+                     context text not null, lines text not null);
+  create index refs_name on refs (name_lower);
+  create index refs_file on refs (file_id);
+  create table trigrams (trigram text not null, name_lower text not null);
+  create index trigrams_trigram on trigrams (trigram, name_lower);
+  create table components (file_id integer not null, struct_lower text not null, seq integer not null,
+                           name text not null, type text not null, kind text not null, pointer text not null,
+                           array text not null, init text not null, comment text not null);
+  create index components_struct on components (struct_lower);
+  create index components_file on components (file_id);
+'''
+
+re_literal_prefix = re.compile(r'[^\\.*+?\[\](){}|^$]*')
+
+# Set of three character substrings of a name.
+
+def name_trigrams (name):
+  return set(name[i:i+3] for i in range(len(name)-2))
+
+# Update the trigrams table for a list of names whose definitions may have been added or removed.
+
+def update_trigrams (db, names):
+  for name in names:
+    trigrams = name_trigrams(name)
+    if len(trigrams) == 0: continue
+    defined = db.execute('select 1 from symbols where name_lower = ? limit 1', (name,)).fetchone() is not None
+    trigram = next(iter(trigrams))
+    indexed = db.execute('select 1 from trigrams where trigram = ? and name_lower = ?', (trigram, name)).fetchone() is not None
+    if defined and not indexed:
+      db.executemany('insert into trigrams values (?, ?)', [(trigram, name) for trigram in trigrams])
+    elif indexed and not defined:
+      db.executemany('delete from trigrams where trigram = ? and name_lower = ?', [(trigram, name) for trigram in trigrams])
+
+# Open the searchf.db file of a root search directory. Returns None if there is no usable database.
+
+def open_index (search_base_dir, mode = 'ro'):
+  db_file = real_path(search_base_dir + index_file_name)
+  if not os.path.isfile(db_file): return None
+  try:
+    db = sqlite3.connect('file:' + db_file + '?mode=' + mode, uri = True)
+    row = db.execute('select value from meta where key = ?', ('schema_version',)).fetchone()
+    if row is not None and row[0] == str(index_schema_version): return db
+    db.close()
+  except sqlite3.Error:
+    pass
+  return None
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# index_tree function
+#
+# Creates or updates the searchf.db and searchf.namelist files of a root search directory.
+# Only files that are new or whose modification time or size has changed are read. Of these, only the files
+# whose contents have changed are rescanned. Files that no longer exist are removed from the index.
+# If rebuild is True, or the existing searchf.db cannot be used, the index is made from scratch.
+# Files are hashed and scanned by n_proc processes.
+#
+# Returns the number of files that were rescanned or removed. Returns -1 if the directory is not writable.
+
+def index_tree (search_base_dir, rebuild = False, verbose = True, n_proc = 1):
+
+  if search_base_dir[-1] != '/': search_base_dir = search_base_dir + '/'
+  db_file = search_base_dir + index_file_name
+  namelist_file = search_base_dir + 'searchf.namelist'
+
+  if not os.access(real_path(search_base_dir), os.W_OK):
+    print ('CANNOT WRITE TO: ' + db_file)
+    return -1
+
+  db = None
+  if not rebuild: db = open_index(search_base_dir, 'rw')
+
+  # New database: Built in a temporary file which replaces searchf.db when done.
+
+  new_db = (db is None)
+  if new_db:
+    tmp_file = real_path(db_file + '.tmp')
+    if os.path.exists(tmp_file): os.remove(tmp_file)
+    db = sqlite3.connect(tmp_file)
+    db.executescript(index_schema)
+    db.execute('insert into meta values (?, ?)', ('schema_version', str(index_schema_version)))
+
+  old_files = {}
+  for file_id, name, mtime, size, hash in db.execute('select id, name, mtime, size, hash from files'):
+    old_files[name] = [file_id, mtime, size, hash]
+
+  n_changed = 0
+  n_added = 0
+  names = set()    # Names of definitions that may have been added or removed.
+
+  with db:
+
+    # Files whose modification time and size are unchanged are not read.
+
+    to_index = []
+    for ord, [full_file_name, file_name] in enumerate(tree_files(search_base_dir)):
+      old = old_files.pop(file_name, None)
+      try:
+        stat = os.stat(real_path(full_file_name))
+      except OSError:
+        print ('Note: Cannot open: ' + full_file_name, file = sys.stderr)
+        if old is not None: old_files[file_name] = old    # Will be removed from the index
+        continue
+
+      if old is not None and old[1:3] == [stat.st_mtime_ns, stat.st_size]:
+        db.execute('update files set ord = ? where id = ?', (ord, old[0]))
+      else:
+        to_index.append([ord, full_file_name, file_name, stat, old])
+
+    # Hash and, if the hash has changed, scan the other files.
+
+    job_args = [[full_file_name, None if old is None else old[3]] for [ord, full_file_name, file_name, stat, old] in to_index]
+
+    for [ord, full_file_name, file_name, stat, old], [hash, syms, refs, components, note] in \
+                                              zip(to_index, map_files(index_file_job, job_args, n_proc)):
+      if note != '':
+        print (note, file = sys.stderr)
+        if old is not None: old_files[file_name] = old
+        continue
+
+      if syms is None:   # Contents unchanged
+        db.execute('update files set ord = ?, mtime = ?, size = ? where id = ?', (ord, stat.st_mtime_ns, stat.st_size, old[0]))
+        continue
+
+      if old is None:
+        file_id = db.execute('insert into files (name, ord, mtime, size, hash) values (?, ?, ?, ?, ?)',
+                                      (file_name, ord, stat.st_mtime_ns, stat.st_size, hash)).lastrowid
+        n_added += 1
+      else:
+        file_id = old[0]
+        names.update(row[0] for row in db.execute('select name_lower from symbols where file_id = ?', (file_id,)))
+        db.execute('delete from symbols where file_id = ?', (file_id,))
+        db.execute('delete from refs where file_id = ?', (file_id,))
+        db.execute('delete from components where file_id = ?', (file_id,))
+        db.execute('update files set ord = ?, mtime = ?, size = ?, hash = ? where id = ?',
+                                      (ord, stat.st_mtime_ns, stat.st_size, hash, file_id))
+        n_changed += 1
+
+      db.executemany('insert into symbols values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(file_id, seq, sym.group, sym.kind, sym.name, sym.name.lower(), sym.module, sym.line_num,
+                       sym.line_end, sym.body[0][0], json.dumps(sym.doc), json.dumps(sym.body)) for seq, sym in enumerate(syms)])
+      db.executemany('insert into refs values (?, ?, ?, ?, ?)',
+                     [(file_id, name, kind, context, json.dumps(lines)) for name, kind, context, lines in refs])
+      db.executemany('insert into components values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [[file_id] + row for row in components])
+      names.update(sym.name.lower() for sym in syms)
+
+    # Files that have been deleted.
+
+    for file_name, old in old_files.items():
+      names.update(row[0] for row in db.execute('select name_lower from symbols where file_id = ?', (old[0],)))
+      db.execute('delete from symbols where file_id = ?', (old[0],))
+      db.execute('delete from refs where file_id = ?', (old[0],))
+      db.execute('delete from components where file_id = ?', (old[0],))
+      db.execute('delete from files where id = ?', (old[0],))
+
+    update_trigrams(db, sorted(names))
+
+  n_updated = n_changed + n_added + len(old_files)
+
+  if new_db or n_updated > 0 or not os.path.isfile(real_path(namelist_file)):
+    write_namelist(db, real_path(namelist_file))
+
+  db.close()
+  if new_db: os.replace(tmp_file, real_path(db_file))
+  parse_cache.prune()
+
+  if verbose:
+    if new_db:
+      print ('Created: ' + db_file + '  (' + str(n_added) + ' files)')
+    else:
+      print ('Updated: ' + db_file + '  (' + str(n_changed) + ' changed, ' + str(n_added) + ' added, ' + \
+                                                 str(len(old_files)) + ' removed)')
+
+  return n_updated
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# write_namelist function
+#
+# Writes the searchf.namelist file which lists the names of the definitions in each file.
+# For C/C++ routines, only the first name of a function line is written.
+
+def write_namelist (db, namelist_file):
+  rows = db.execute('select files.name, grp, kind, symbols.name from symbols join files on files.id = symbols.file_id ' + \
+                    'order by ord, seq')
+
+  with open(namelist_file, 'w') as f:
+    this_file = None
+    group = -1
+    for file_name, grp, kind, name in rows:
+      if file_name != this_file:
+        f.write('\nFile: '  + file_name + '\n')
+        this_file = file_name
+      elif kind == 'c_routine' and grp == group:
+        continue
+      group = grp
+      f.write(name + '\n')
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# watch_trees function
+#
+# Keeps the index files of the root search directories up to date until Ctrl-C is pressed.
+
+def watch_trees (dir_list, n_proc = 1, interval = 2.0):
+  print ('Watching for changes. Use Ctrl-C to stop.')
+  try:
+    while True:
+      time.sleep(interval)
+      for search_base_dir in dir_list:
+        if index_tree(search_base_dir, verbose = False, n_proc = n_proc) > 0:
+          print (time.strftime('%H:%M:%S') + '  Updated: ' + os.path.join(search_base_dir, index_file_name))
+  except KeyboardInterrupt:
+    print ('')
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# search_index function
+#
+# Search using the searchf.db file.
+
+def search_index (search_base_dir, db, search_com):
+  print_index_rows(search_base_dir, query_index(db, index_prefix(search_com), search_trigrams(search_com)), search_com)
+  db.close()
+
+# Lower case literal prefix of the search string. All matching names start with this prefix.
+# The last literal character is not part of the prefix if it is optional (followed by "?", "*" or "{").
+# With an alternation ("|"), names need not have a common prefix.
+
+def index_prefix (search_com):
+  match_str = search_com.match_str
+  if '|' in match_str: return ''
+  prefix = re_literal_prefix.match(match_str).group(0)
+  if match_str[len(prefix):len(prefix)+1] in ['?', '*', '{']: prefix = prefix[:-1]
+  return prefix.lower()
+
+# Trigrams that all names matching the search string must contain. These are the trigrams of the literal parts
+# of the search string. Returns an empty list if the search string is too complicated or has no literal parts
+# of three or more characters.
+
+def search_trigrams (search_com):
+  s = search_com.match_str.replace('\\w*', ' ')
+  if re.search(r'[|\\(){}]', s): return []
+  s = re.sub(r'\[[^\]]*\][?*+]?', ' ', s)    # Character sets
+  s = re.sub(r'.[?*]', ' ', s)                # Optional characters
+  s = re.sub(r'[.+^$]', ' ', s)
+  trigrams = set()
+  for part in s.lower().split(): trigrams |= name_trigrams(part)
+  return sorted(trigrams)
+
+# Trigrams are only used if the prefix is shorter than this.
+
+min_index_prefix = 3
+
+# Returns the symbol rows whose name may match in search order. These are the rows whose name starts with
+# prefix or, if the prefix is short, whose name contains all the trigrams.
+# A row is: [file name, group, kind, name, module, line, line_end, doc, body, file search order, seq].
+
+index_query = 'select files.name, grp, kind, symbols.name, module, line, line_end, doc, body, ord, seq ' + \
+              'from symbols join files on files.id = symbols.file_id'
+
+def query_index (db, prefix, trigrams = []):
+  if len(prefix) < min_index_prefix and len(trigrams) > 0:
+    return db.execute(index_query + ' where name_lower in (select name_lower from trigrams where trigram in (' + \
+                      ','.join('?' * len(trigrams)) + ') group by name_lower having count(*) = ?) order by ord, seq',
+                      trigrams + [len(trigrams)])
+  if prefix == '': return db.execute(index_query + ' order by ord, seq')
+  return db.execute(index_query + ' where name_lower >= ? and name_lower < ? order by ord, seq', (prefix, prefix + '\uffff'))
+
+# Returns up to n names of definitions that share the most trigrams with a word.
+
+def index_similar_names (db, word, n):
+  trigrams = sorted(name_trigrams(word))
+  if len(trigrams) == 0: return []
+  return [row[0] for row in db.execute('select name_lower from trigrams where trigram in (' + ','.join('?' * len(trigrams)) + \
+                                       ') group by name_lower order by count(*) desc, name_lower limit ?', trigrams + [n])]
+
+# Print the definitions of a list of symbol rows that match the search string.
+
+def print_index_rows (search_base_dir, rows, search_com):
+  file_name = None
+  syms = []
+  for row in rows:
+    if row[0] != file_name:
+      if file_name is not None: print_syms(search_base_dir + file_name, syms, search_com)
+      file_name = row[0]
+      syms = []
+    sym = sym_class(row[2], row[3], row[5], row[1])
+    sym.module, sym.line_end, sym.doc, sym.body = row[4], row[6], json.loads(row[7]), json.loads(row[8])
+    if sym_matches(sym, search_com): syms.append(sym)
+
+  if file_name is not None: print_syms(search_base_dir + file_name, syms, search_com)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# search_refs function
+#
+# Cross reference search ("-x" option). Uses the searchf.db file if there is one. Otherwise all the
+# files are scanned.
+
+ref_query = 'select files.name, refs.name_lower, kind, context, lines from refs join files on files.id = refs.file_id'
+
+def search_refs (search_base_dir, search_com):
+
+  db = open_index(search_base_dir)
+  if db is not None:
+    prefix = index_prefix(search_com)
+    if prefix == '':
+      rows = db.execute(ref_query + ' order by ord')
+    else:
+      rows = db.execute(ref_query + ' where name_lower >= ? and name_lower < ? order by ord', (prefix, prefix + '\uffff'))
+
+    file_name = None
+    refs = []
+    for row in rows:
+      if row[0] != file_name:
+        if file_name is not None: print_refs(search_base_dir + file_name, refs, search_com)
+        file_name = row[0]
+        refs = []
+      if ref_matches(row[1], search_com): refs.append([row[1], row[2], row[3], json.loads(row[4])])
+
+    if file_name is not None: print_refs(search_base_dir + file_name, refs, search_com)
+    db.close()
+    return
+
+  file_names = [full_file_name for full_file_name, file_name in tree_files(search_base_dir)]
+
+  for full_file_name, [refs, note] in zip(file_names, map_files(scan_refs_job, file_names, search_com.n_proc)):
+    if note != '': print_note(note, search_com)
+    print_refs(full_file_name, [ref for ref in refs if ref_matches(ref[0], search_com)], search_com)
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
@@ -487,21 +1606,30 @@ def search_tree (search_base_dir, search_com):
   if search_base_dir[-1] != '/': search_base_dir = search_base_dir + '/'
   namelist_file = search_base_dir + 'searchf.namelist'
 
-  # Open file for namelist output if needed
+  if search_com.xref:
+    search_refs(search_base_dir, search_com)
+    return
 
-  if search_com.doc_type == 'LIST':
-    if os.access(search_base_dir, os.W_OK):
-      print ('Creating: ' + namelist_file)
-      search_com.namelist_file = open(namelist_file, 'w')
-    else:
-      print ('CANNOT WRITE TO: ' + namelist_file)
+  # When running as a query server, use the index held in memory.
+
+  if search_com.server is not None:
+    index = search_com.server.index(search_base_dir)
+    if index is not None:
+      print_index_rows(search_base_dir, index.lookup(index_prefix(search_com), search_trigrams(search_com)), search_com)
       return
 
+  # If there is a searchf.db file then use this.
+
+  db = open_index(search_base_dir)
+  if db is not None:
+    search_index(search_base_dir, db, search_com)
+    return
+
   # If there is an existing searchf.namelist file then use this to see if there are matches.
 
-  if search_com.doc_type != 'LIST' and os.path.isfile(namelist_file):
+  if os.path.isfile(real_path(namelist_file)):
 
-    f_namelist = open(namelist_file)
+    f_namelist = open(real_path(namelist_file))
     have_searched_file = False
 
     for line in f_namelist:
@@ -527,35 +1655,298 @@ def search_tree (search_base_dir, search_com):
 
     return
 
-  # No searchf.namelist: Loop over all directories
+  # No searchf.namelist: Scan all files
 
-  for this_search_base_dir, sub_dirs, files in os.walk(search_base_dir):
+  file_names = [full_file_name for full_file_name, file_name in tree_files(search_base_dir)]
 
-    # Remove from searching hidden directories plus "production" and "debug" derectories
-    i = 0
-    while i < len(sub_dirs):
-      if sub_dirs[i] == 'production' or sub_dirs[i] == 'debug' or sub_dirs[i][0] == '.': 
-        del sub_dirs[i]
-      else:
-        i += 1
+  for full_file_name, [syms, note] in zip(file_names, map_files(scan_file_job, file_names, search_com.n_proc)):
+    if note != '': print_note(note, search_com)
+    print_syms(full_file_name, [sym for sym in syms if sym_matches(sym, search_com)], search_com)
+
+  return
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# standard_search_dirs function
+#
+# Returns the list of standard root search directories that exist.
+
+def standard_search_dirs (root_dir):
+  dir_list = []
+  choose_path (dir_list, root_dir, 'util_programs', '/mad_to_bmad/madx_to_bmad.py', '')
+  choose_path (dir_list, root_dir, 'forest', '/code/i_tpsa.f90', '')
+  choose_path (dir_list, root_dir, 'bsim', '/code/bsim_interface.f90', '')
+  choose_path (dir_list, root_dir, 'code_examples', '/simple_bmad_program/simple_bmad_program.f90', '')
+  choose_path (dir_list, root_dir, 'sim_utils', '/interfaces/sim_utils.f90', '')
+  choose_path (dir_list, root_dir, 'tao', '/code/tao_struct.f90', '')
+  choose_path (dir_list, root_dir, 'bmad', '/modules/bmad_struct.f90', '')
+  return dir_list
 
-    # Now loop over all files
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# Query server
+#
+# The server (started with the searchf_server script) answers getf/listf queries sent over a Unix socket
+# by searchf_client.query_server. The server keeps the searchf.db symbol index of each root search
+# directory in memory, reloading an index when its searchf.db file changes, and remembers the search
+# directories found by choose_path. Root search directories without a searchf.db file are searched as usual.
+
+# In memory copy of the symbol rows of a searchf.db file sorted by lower case name.
+
+class memory_index_class:
+  def __init__(self, db, stat):
+    self.stat = stat    # [mtime, inode, size] of the searchf.db file.
+    self.rows = sorted(db.execute(index_query), key = lambda row: row[3].lower())
+    self.names = [row[3].lower() for row in self.rows]
+    self.trigrams = {}  # trigram -> set of names containing the trigram.
+    for name in set(self.names):
+      for trigram in name_trigrams(name):
+        self.trigrams.setdefault(trigram, set()).add(name)
+    db.close()
+
+  # Rows whose name may match in search order. Same as query_index.
+
+  def lookup (self, prefix, trigrams = []):
+    if len(prefix) < min_index_prefix and len(trigrams) > 0:
+      names = None
+      for trigram in sorted(trigrams, key = lambda trigram: len(self.trigrams.get(trigram, ()))):
+        names = set(self.trigrams.get(trigram, ())) if names is None else names & self.trigrams[trigram]
+        if len(names) == 0: return []
+      rows = []
+      for name in names:
+        rows += self.rows[bisect.bisect_left(self.names, name):bisect.bisect_right(self.names, name)]
+    else:
+      rows = self.rows[bisect.bisect_left(self.names, prefix):bisect.bisect_left(self.names, prefix + '\uffff')]
+    return sorted(rows, key = lambda row: (row[9], row[10]))
 
-    for this_file in files: search_file (search_base_dir, this_search_base_dir, this_file, search_com)
+  # Same as index_similar_names.
 
-  # End
+  def similar_names (self, word, n):
+    count = {}
+    for trigram in name_trigrams(word):
+      for name in self.trigrams.get(trigram, ()):
+        count[name] = count.get(name, 0) + 1
+    return sorted(count, key = lambda name: (-count[name], name))[:n]
 
-  return
+#
+
+class server_class:
+  def __init__(self):
+    self.indexes = {}     # searchf.db absolute file name -> memory_index_class
+    self.dir_lists = {}   # [cwd, root_dir, release_dir, dist_dir] -> standard_search_dirs list
+
+  # Returns the in memory index of a root search directory. None if there is no usable searchf.db file.
+
+  def index (self, search_base_dir):
+    db_file = os.path.abspath(real_path(search_base_dir + index_file_name))
+    try:
+      st = os.stat(db_file)
+    except OSError:
+      self.indexes.pop(db_file, None)
+      return None
+
+    stat = [st.st_mtime_ns, st.st_ino, st.st_size]
+    index = self.indexes.get(db_file)
+    if index is None or index.stat != stat:
+      db = open_index(search_base_dir)
+      if db is None: return None
+      index = memory_index_class(db, stat)
+      self.indexes[db_file] = index
+    return index
+
+  # standard_search_dirs with caching. Results where a directory was not found are not cached.
+
+  def search_dirs (self, root_dir):
+    key = (os.path.abspath(work_dir), root_dir, release_dir, dist_dir)
+    if key in self.dir_lists: return list(self.dir_lists[key])
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      dir_list = standard_search_dirs(root_dir)
+    if output.getvalue() == '':
+      self.dir_lists[key] = list(dir_list)
+    else:
+      print (output.getvalue(), end = '')
+    return dir_list
+
+  # Do a getf/listf search for a client. The output is written to stream and notes printed to stderr
+  # are written to err_stream.
+
+  def run (self, request, stream, err_stream):
+    global release_dir, dist_dir, work_dir
+
+    work_dir = request['cwd']
+    env = request['env']
+    release_dir = '' if env['ACC_RELEASE_DIR'] is None else env['ACC_RELEASE_DIR'] + '/'
+    dist_dir    = '' if env['DIST_BASE_DIR'] is None else env['DIST_BASE_DIR'] + '/'
+
+    with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(err_stream):
+      try:
+        search_all(request['doc_type'], ['getf'] + request['argv'], self)
+      except SystemExit:    # From print_help_message
+        pass
+    stream.flush()
+    err_stream.flush()
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# reply_stream_class
+#
+# Output of a search done by the server. Text written is held until flush is called and is then sent to
+# the client as one {<kind>: <text>} message where kind is "output" for stdout and "stderr" for stderr.
+# The --json output flushes after each record so the client gets each record as soon as it is found.
+# The text output is sent when the search is done.
+
+class reply_stream_class:
+  def __init__(self, connection, kind = 'output'):
+    self.connection = connection
+    self.kind = kind
+    self.buffer = []
+
+  def write (self, text):
+    self.buffer.append(text)
+    return len(text)
+
+  def flush (self):
+    if len(self.buffer) == 0: return
+    searchf_client.send_message(self.connection, {self.kind: ''.join(self.buffer)})
+    self.buffer = []
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# serve function
+#
+# Runs the query server until Ctrl-C is pressed or the process is killed.
+
+def serve (socket_file):
+
+  if os.path.lexists(socket_file):
+    if not searchf_client.socket_is_safe(socket_file):
+      print ('SOCKET FILE NOT OWNED BY YOU OR OPEN TO OTHER USERS: ' + socket_file)
+      print ('Remove it or use the "-s" option to use a different socket file.')
+      return
+    if searchf_client.server_running(socket_file):
+      print ('SERVER ALREADY RUNNING ON: ' + socket_file)
+      return
+    os.remove(socket_file)
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0o077)     # Only the user may connect.
+  listener.bind(socket_file)
+  os.umask(old_umask)
+  listener.listen(16)
+  print ('searchf server listening on: ' + socket_file)
+  print ('Use Ctrl-C to stop.')
+
+  # Stop on Ctrl-C or kill. Background processes may start with Ctrl-C ignored.
+
+  signal.signal(signal.SIGINT, signal.default_int_handler)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  server = server_class()
+  try:
+    while True:
+      connection, address = listener.accept()
+      with connection:
+        try:
+          request = json.loads(searchf_client.recv_all(connection).decode())
+          try:
+            server.run(request, reply_stream_class(connection), reply_stream_class(connection, 'stderr'))
+            reply = {'done': True}
+          except Exception as err:
+            reply = {'error': str(err)}
+          searchf_client.send_message(connection, reply)
+        except (OSError, ValueError):
+          pass    # Client has gone away or sent garbage.
+
+  except KeyboardInterrupt:
+    print ('')
+
+  finally:
+    listener.close()
+    os.remove(socket_file)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# server_main function
+#
+# Main routine for the searchf_server script.
+
+def server_main ():
+  socket_file = searchf_client.socket_file_name()
+
+  i = 1
+  while i < len(sys.argv):
+    if sys.argv[i] == '-s' and i+1 < len(sys.argv):
+      socket_file = sys.argv[i+1]
+      i += 2
+    else:
+      print ('Usage: searchf_server {-s <socket_file>}')
+      return
+
+  if socket_file == '':
+    print ('NO SOCKET FILE. SEARCHF_SOCKET ENVIRONMENT VARIABLE IS BLANK.')
+    return
+
+  serve (socket_file)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# print_suggestions function
+#
+# Used when nothing matches the search string. Prints the names in the symbol indexes that are similar
+# to the search string ("did you mean"). The names are ranked by similarity and then by the root search
+# directory (suggest_dir_rank) the names are defined in.
+
+suggest_dir_rank     = ['bmad', 'tao', 'sim_utils', 'bsim', 'code_examples', 'util_programs', 'forest']
+max_suggestions      = 10
+min_suggestion_ratio = 0.75  # Minimum difflib similarity ratio.
+
+def print_suggestions (dir_list, search_com):
+  word = re.sub(r'[^\w$]', '', search_com.match_str.replace('\\w*', '')).lower()
+  if len(word) < 3: return
+
+  found = {}    # name -> list of root search directory names.
+  for search_base_dir in dir_list:
+    if search_base_dir == '': continue
+    if search_base_dir[-1] != '/': search_base_dir = search_base_dir + '/'
+    index = None if search_com.server is None else search_com.server.index(search_base_dir)
+    if index is not None:
+      names = index.similar_names(word, 100)
+    else:
+      db = open_index(search_base_dir)
+      if db is None: continue
+      names = index_similar_names(db, word, 100)
+      db.close()
+    for name in names: found.setdefault(name, []).append(os.path.basename(os.path.normpath(search_base_dir)))
+
+  def dir_rank (dir_name):
+    return suggest_dir_rank.index(dir_name) if dir_name in suggest_dir_rank else len(suggest_dir_rank)
+
+  ranked = []
+  for name, dir_names in found.items():
+    ratio = difflib.SequenceMatcher(None, word, name).ratio()
+    if ratio < min_suggestion_ratio: continue
+    dir_names.sort(key = dir_rank)
+    ranked.append([-ratio, dir_rank(dir_names[0]), name, dir_names])
+
+  if len(ranked) == 0: return
+  print ('Did you mean:')
+  for ratio, rank, name, dir_names in sorted(ranked)[:max_suggestions]:
+    print ('    %-40s (%s)' % (name, ', '.join(dir_names)))
 
 #------------------------------------------------------------------------------------
 #------------------------------------------------------------------------------------
 # Main routine
 
-def search_all (doc_type):
+def search_all (doc_type, argv = None, server = None):
+
+  if argv is None: argv = sys.argv
 
   search_com = search_com_class()
   search_com.found_one = False
   search_com.doc_type = doc_type
+  search_com.server = server
 
   #-----------------------------------------------------------
   # Look for arguments
@@ -564,12 +1955,14 @@ def search_all (doc_type):
   root_dir = ''
   search_all = False
   search_com.search_only_for = ''
+  rebuild = False
+  watch = False
 
   i = 0
-  while i < len(sys.argv):
+  while i < len(argv):
     i += 1
-    if i >= len(sys.argv): break
-    arg = sys.argv[i]
+    if i >= len(argv): break
+    arg = argv[i]
 
     if i == 1 and len(arg) == 0:
       print_help_message ()
@@ -585,20 +1978,33 @@ def search_all (doc_type):
       continue
 
     if arg == '-d':
-      dir_list = [sys.argv[i+1]]
+      dir_list = [argv[i+1]]
       i += 1
       continue
 
+    if arg == '-e':
+      search_com.expand = True
+      continue
+
+    if arg == '-f' and doc_type == 'LIST':
+      rebuild = True
+      continue
+
     if arg == '-h':
       print_help_message ()
 
+    if arg == '-j':
+      search_com.n_proc = max(1, int(argv[i+1]))
+      i += 1
+      continue
+
     if arg == '-r':
-      root_dir = sys.argv[i+1]
+      root_dir = argv[i+1]
       i += 1
       continue
 
     if arg == '-s':
-      s = sys.argv[i+1] 
+      s = argv[i+1] 
       search_com.search_only_for = s
       if not 'struct'.startswith(s) and not 'routine'.startswith(s) and \
          not 'parameter'.startswith(s) and not 'module'.startswith(s):
@@ -607,6 +2013,18 @@ def search_all (doc_type):
       i += 1
       continue
 
+    if arg == '-w' and doc_type == 'LIST':
+      watch = True
+      continue
+
+    if arg == '-x':
+      search_com.xref = True
+      continue
+
+    if arg == '--json':
+      search_com.json = True
+      continue
+
     print ('!!! UNKNOWN ARGUMENT: ' + arg)
     print_help_message ()
 
@@ -614,35 +2032,49 @@ def search_all (doc_type):
   # Setup dir_list list, etc
 
   if len(dir_list) == 0:    # If no -d command line arg
-    choose_path (dir_list, root_dir, 'util_programs', '/mad_to_bmad/madx_to_bmad.py', '')
-    choose_path (dir_list, root_dir, 'forest', '/code/i_tpsa.f90', '')
-    choose_path (dir_list, root_dir, 'bsim', '/code/bsim_interface.f90', '')
-    choose_path (dir_list, root_dir, 'code_examples', '/simple_bmad_program/simple_bmad_program.f90', '')
-    choose_path (dir_list, root_dir, 'sim_utils', '/interfaces/sim_utils.f90', '')
-    choose_path (dir_list, root_dir, 'tao', '/code/tao_struct.f90', '')
-    choose_path (dir_list, root_dir, 'bmad', '/modules/bmad_struct.f90', '')
+    if server is None:
+      dir_list = standard_search_dirs(root_dir)
+    else:
+      dir_list = server.search_dirs(root_dir)
 
   if search_com.doc_type == 'LIST':
     search_com.match_str = '(\w+)'
-    if i > 0 and i < len(sys.argv): dir_list = [sys.argv[i]]
+    if i > 0 and i < len(argv): dir_list = [argv[i]]
   else:
-    if i == 0 or i >= len(sys.argv): 
+    if i == 0 or i >= len(argv): 
       print ('NO SEARCH STRING FOUND!')
       print_help_message()  # Nothing to match to
-    match_str_in = sys.argv[i]
+    match_str_in = argv[i]
     search_com.match_str = match_str_in.replace('*', '\w*') 
+    search_com.re_match_str = re.compile(search_com.match_str.lower() + '$')
+    if search_com.case_sensitive:
+      search_com.re_c_match_str = re.compile(search_com.match_str + '$')
+    else:
+      search_com.re_c_match_str = re.compile(search_com.match_str + '$', re.I)
+
+  # Create or update the index files.
+
+  if search_com.doc_type == 'LIST':
+    dir_list = [dir for dir in dir_list if dir != '']
+    for dir in dir_list:
+      index_tree (dir, rebuild, n_proc = search_com.n_proc)
+    if watch: watch_trees (dir_list, search_com.n_proc)
+    return
 
   # Search for a match.
 
+  search_com.dir_list = dir_list
   for dir in dir_list:
     search_tree (dir, search_com)
 
   # And finish
 
-  if search_com.doc_type != 'LIST':
-    if not search_com.found_one:
-      print ('Cannot match String: ' + match_str_in)
-      print ('Use "-h" command line option to list options.')
-    else:
-      print ('')
+  if search_com.json: return
+
+  if not search_com.found_one:
+    print ('Cannot match String: ' + match_str_in)
+    print_suggestions (dir_list, search_com)
+    print ('Use "-h" command line option to list options.')
+  else:
+    print ('')
 
@@ -0,0 +1,126 @@
+#+
+# Client side of the getf/listf query server. See searchf_server for documentation.
+#
+# This module only imports what is needed to talk to the server so that getf and listf
+# start quickly when a server is running.
+#-
+
+import os
+import sys
+import json
+import stat
+import socket
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# socket_file_name function
+#
+# The server socket is set by the SEARCHF_SOCKET environment variable. Default is $XDG_RUNTIME_DIR/searchf.sock
+# or, if XDG_RUNTIME_DIR is not set, /tmp/searchf-<uid>.sock. Setting SEARCHF_SOCKET to blank disables the use
+# of a server.
+
+def socket_file_name ():
+  if 'SEARCHF_SOCKET' in os.environ: return os.environ['SEARCHF_SOCKET']
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '')
+  if runtime_dir != '': return os.path.join(runtime_dir, 'searchf.sock')
+  return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'searchf-' + str(os.getuid()) + '.sock')
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# socket_is_safe function
+#
+# A socket file is only used if it is a socket owned by the user that other users cannot connect to.
+# Otherwise another user could create the socket file first and send back false results.
+
+def socket_is_safe (socket_file):
+  try:
+    st = os.lstat(socket_file)
+  except OSError:
+    return False
+  return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0o077) == 0
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# recv_all function
+#
+# Read from a socket until the other end shuts down its side of the connection.
+
+def recv_all (sock):
+  chunks = []
+  while True:
+    chunk = sock.recv(1 << 16)
+    if not chunk: break
+    chunks.append(chunk)
+  return b''.join(chunks)
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# send_message function
+#
+# The server reply is a sequence of messages. Each message is a JSON object on its own line:
+#   {"output": <text>}    ! Output of the search. There may be any number of these.
+#   {"stderr": <text>}    ! Notes printed to stderr by the search. There may be any number of these.
+#   {"done": true}        ! Last message of a search that finished.
+#   {"error": <text>}     ! Last message of a search that failed.
+
+def send_message (sock, message):
+  sock.sendall((json.dumps(message) + '\n').encode())
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# server_running function
+
+def server_running (socket_file):
+  try:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1.0)
+    sock.connect(socket_file)
+    sock.close()
+    return True
+  except OSError:
+    return False
+
+#------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------
+# query_server function
+#
+# Sends the getf/listf command line, working directory and the environment variables used to find
+# the search directories to the server and prints the reply. Output is printed as it arrives.
+# Returns False, without printing anything, if there is no server or the server could not do the search.
+# If the search fails after some output has been printed, a note is printed to stderr and True is returned
+# so the search is not done a second time.
+
+def query_server (doc_type):
+  socket_file = socket_file_name()
+  if socket_file == '' or not socket_is_safe(socket_file): return False
+
+  request = {'doc_type': doc_type, 'argv': sys.argv[1:], 'cwd': os.getcwd(),
+             'env': {name: os.environ.get(name) for name in ['ACC_RELEASE_DIR', 'DIST_BASE_DIR']}}
+
+  printed = False
+  try:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1.0)
+    sock.connect(socket_file)
+    sock.settimeout(None)
+    sock.sendall(json.dumps(request).encode())
+    sock.shutdown(socket.SHUT_WR)
+    with sock, sock.makefile('rb') as reply:
+      for line in reply:
+        message = json.loads(line.decode())
+        if 'stderr' in message:
+          sys.stderr.write(message['stderr'])
+          continue
+        if 'output' not in message: break
+        sys.stdout.write(message['output'])
+        sys.stdout.flush()
+        printed = True
+      else:
+        message = {'error': 'Connection to server closed'}
+  except (OSError, ValueError) as err:
+    message = {'error': str(err)}
+
+  if 'done' in message: return True
+  if not printed: return False
+  print ('Note: searchf server error: ' + message.get('error', ''), file = sys.stderr)
+  return True
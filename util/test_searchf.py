@@ -0,0 +1,93 @@
+#+
+# Tests of searchf.py searches that use the searchf.db index.
+#
+# Run with:
+#   python -m pytest util/test_searchf.py
+#-
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import searchf
+
+f90_code = '''module lat_mod
+
+type lat_struct
+  integer n
+end type
+
+contains
+
+subroutine lat_sub (a)
+  integer a
+end subroutine
+
+end module
+'''
+
+def listf (capsys, dir, match_str):
+  searchf.search_all('SHORT', ['listf', '-d', dir, match_str])
+  return capsys.readouterr().out
+
+#------------------------------------------------------------------------------------
+# A search string whose last literal character is optional must not use that character as part
+# of the index prefix.
+
+def test_index_optional_last_char (tmp_path, monkeypatch, capsys):
+  monkeypatch.setenv('BMAD_PARSE_CACHE', '')
+  monkeypatch.setenv('SEARCHF_SOCKET', '')
+  (tmp_path / 'lat.f90').write_text(f90_code)
+  searchf.index_tree(str(tmp_path), verbose = False)
+  assert (tmp_path / 'searchf.db').exists()
+
+  for match_str in ['lat_struct', 'lat_structx?', 'lat_structx{0,2}', 'lat_s+truct', 'xxx|lat_struct']:
+    assert 'type lat_struct' in listf(capsys, str(tmp_path), match_str), match_str
+
+  assert 'Cannot match String' in listf(capsys, str(tmp_path), 'lat_structx*')
+
+#------------------------------------------------------------------------------------
+# Searches that scan files do not write to the parse cache. Index builds do. A cache directory that
+# other users can write to is not used.
+
+def test_parse_cache_writes (tmp_path, monkeypatch, capsys):
+  cache = tmp_path / 'cache'
+  code = tmp_path / 'code'
+  code.mkdir()
+  (code / 'lat.f90').write_text(f90_code)
+  monkeypatch.setenv('BMAD_PARSE_CACHE', str(cache))
+  monkeypatch.setenv('SEARCHF_SOCKET', '')
+
+  assert 'type lat_struct' in listf(capsys, str(code), 'lat_struct')
+  assert not cache.exists()
+
+  searchf.index_tree(str(code), verbose = False)
+  assert len(list(cache.glob('*/*.pickle'))) > 0
+
+  hash = searchf.parse_cache.file_hash(str(code / 'lat.f90'))
+  key = 'syms-f90-v' + searchf.parse_cache_version
+  assert searchf.parse_cache.load(hash, key) is not None
+  cache.chmod(0o777)
+  assert searchf.parse_cache.load(hash, key) is None
+
+#------------------------------------------------------------------------------------
+# With --json, a file that cannot be opened is noted on stderr and the output only has JSON records.
+# This is checked when all files are scanned and when the searchf.db index is used.
+
+def test_json_unreadable_file (tmp_path, monkeypatch, capsys):
+  monkeypatch.setenv('BMAD_PARSE_CACHE', '')
+  monkeypatch.setenv('SEARCHF_SOCKET', '')
+  (tmp_path / 'lat.f90').write_text(f90_code)
+  (tmp_path / 'bad.f90').symlink_to(tmp_path / 'missing.f90')    # Cannot be opened, even by root.
+
+  for indexed in [False, True]:
+    if indexed:
+      searchf.index_tree(str(tmp_path), verbose = False)
+      assert 'Cannot open' in capsys.readouterr().err
+
+    searchf.search_all('SHORT', ['listf', '--json', '-d', str(tmp_path), 'lat*'])
+    out, err = capsys.readouterr()
+    records = [json.loads(line) for line in out.splitlines()]
+    assert 'lat_struct' in [record['name'] for record in records]
+    if not indexed: assert 'Cannot open' in err
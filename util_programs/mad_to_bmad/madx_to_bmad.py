@@ -5,7 +5,7 @@
 # See the README file for more details
 #-
 
-import sys, re, math, argparse, time
+import sys, os, io, re, math, argparse, time, heapq, json, shutil, hashlib, contextlib, multiprocessing
 from collections import OrderedDict
 
 if sys.version_info[0] < 3 or sys.version_info[1] < 6:
@@ -50,13 +50,18 @@ class common_struct:
     self.seq_dict = OrderedDict()    # List of all sequences.
     self.ele_dict = {}               # Dict of elements
     self.var_def_list = []           # List of "A = B" sets after translation to Bmad. Does not Include "A->P = B" parameter sets.
-    self.var_name_list = []          # List of madx variable names.
+    self.var_name_set = set()        # Set of madx variable names.
+    self.var_name_list = None        # Variable names in order of definition. Only used by convert_file_job.
     self.super_list = []             # List of superimpose statements to be prepended to the bmad file.
     self.f_in = []         # MADX input files
     self.f_out = []        # Bmad output files
+    self.files_read = []             # Names of all MADX files read. Used for the manifest file.
+    self.files_written = []          # Names of all Bmad files written. Used for the manifest file.
     self.use = ''
-    self.command = ''    # Scratch storage for read_madx_command routine.
     self.drift_count = 0
+    self.file_jobs = {}              # Called files being converted by worker processes. See the -j option.
+    self.more_on_line = False        # Set by read_madx_commands: Is there more on the line after the last command?
+    self.partial_command = False     # Set by read_madx_commands: Did the input end in the middle of a command?
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
@@ -170,64 +175,83 @@ bmad_param_name = {
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
-# Is character a valid character to be used in a label?
+# Match to a label: A run of alphanumeric, "." and "_" characters.
 
-def is_label_char(char):
-  return char.isalnum() or char in '._'
+re_label = re.compile(r'[\w.]+')
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
 # Order var defs so that vars that depend upon other vars are come later.
 # Also comment out first occurances if there are multiple defs of the same var.
+#
+# The defs are topologically sorted: A def is put in the list as soon as all the vars it depends upon
+# are in the list. Defs that are ready at the same time keep their original order.
+# Defs that are part of a circular dependency are put at the end in their original order.
 
 def order_var_def_list():
 
   # Mark duplicates
-  dependent_list = {}   # Stores names and dependencies
+  def_names = set()
   new_def_list = []
 
   for vdef in reversed(common.var_def_list):
-    if vdef[0] in dependent_list:
-      new_def_list.insert(0, ['! Duplicate: ' + vdef[0], vdef[1]])
+    if vdef[0] in def_names:
+      new_def_list.append(['! Duplicate: ' + vdef[0], vdef[1]])
     else:
-      new_def_list.insert(0, vdef)
-      exp_list = re.split('\+|-|\*|/|\(|\)|\^|,', vdef[1])
-      dependent_list[vdef[0]] = list(x.split() for x in exp_list)
+      new_def_list.append(vdef)
+      def_names.add(vdef[0])
 
-  common.var_def_list = new_def_list
+  new_def_list.reverse()
 
-  # Move vars that are dependent upon vars defined further up the list.
-  new_def_list = common.var_def_list[:]
+  # Dependency graph. n_depend[ix] is the number of vars def ix depends upon that are not yet in the list.
+  # dependent_list[ix] is the list of defs that depend upon def ix.
 
-  ix = 0
-  while ix < len(new_def_list):
-    vdef = new_def_list[ix]
+  def_index = {vdef[0]: ix for ix, vdef in enumerate(new_def_list) if vdef[0][0] != '!'}
+  n_depend = [0] * len(new_def_list)
+  dependent_list = [[] for vdef in new_def_list]
 
-    if vdef[0][0] == '!':
-      ix += 1
-      continue
+  for ix, vdef in enumerate(new_def_list):
+    if vdef[0][0] == '!': continue
+    for name in set(re_label.findall(vdef[1])):
+      ix2 = def_index.get(name, ix)
+      if ix2 == ix: continue
+      n_depend[ix] += 1
+      dependent_list[ix2].append(ix)
 
-    moved = False
-    for ix2 in range(len(new_def_list)-1, ix, -1):
-      sub = new_def_list[ix2][0]
-      str = vdef[1]
-      ns = len(str)
-      found = False
-
-      for match in re.finditer(sub, str):
-        j = match.start()
-        k = match.end()
-        if (j == 0 or not is_label_char(str[j-1])) and (k > len(str)-1 or not is_label_char(str[k])): found = True
-
-      if found:
-        new_def_list.pop(ix)
-        new_def_list.insert(ix2, vdef)
-        moved = True
-        break
+  # Sort. "ready" is a heap of defs whose vars are all in the list.
+
+  ready = [ix for ix in range(len(new_def_list)) if n_depend[ix] == 0]
+  common.var_def_list = []
+
+  while len(ready) > 0:
+    ix = heapq.heappop(ready)
+    common.var_def_list.append(new_def_list[ix])
+    for ix2 in dependent_list[ix]:
+      n_depend[ix2] -= 1
+      if n_depend[ix2] == 0: heapq.heappush(ready, ix2)
+
+  if len(common.var_def_list) < len(new_def_list):
+    circular_list = [vdef for ix, vdef in enumerate(new_def_list) if n_depend[ix] > 0]
+    print (f'Circular dependency between variables: {", ".join(vdef[0] for vdef in circular_list)}\n' + 
+           f'  You may have to edit the Bmad lattice file by hand to resolve this.')
+    common.var_def_list += circular_list
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Add a variable name to the set of variable names. Warn if the variable has been defined before.
+# In a worker process (see convert_file_job) the names are just recorded and the check is done
+# when the worker results are merged.
+
+def add_var_name(name):
 
-    if not moved: ix += 1
+  if common.var_name_list is not None:
+    common.var_name_list.append(name)
+    return
 
-  common.var_def_list = new_def_list
+  if name in common.var_name_set:
+    print (f'Duplicate variable name: {name}\n' + 
+           f'  You may have to edit the Bmad lattice file by hand to resolve this.')
+  common.var_name_set.add(name)
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
@@ -395,6 +419,18 @@ def bmad_file_name(madx_file):
   else:
     return madx_file + '.bmad'
 
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Name of the file in a "call, file = ..." command
+
+def call_file_name(command):
+
+  file = command.split('=')[1].strip()
+  if '"' in file or "'" in file:
+    return file.replace('"', '').replace("'", '')
+  else:
+    return file.lower()    
+
 #------------------------------------------------------------------
 #------------------------------------------------------------------
 
@@ -1085,10 +1121,7 @@ def parse_command(command, dlist):
   # the def to before the point where the element is defined.
 
   if dlist[1] == '=' and not '->' in dlist[0]:
-    if dlist[0] in common.var_name_list:
-      print (f'Duplicate variable name: {dlist[0]}\n' + 
-             f'  You may have to edit the Bmad lattice file by hand to resolve this.')
-    common.var_name_list.append(dlist[0])
+    add_var_name(dlist[0])
     name = dlist[0]
     value = bmad_expression(command.split('=')[1].strip(), '')
     if '[' in value or not common.prepend_vars:    # Involves an element parameter
@@ -1117,18 +1150,26 @@ def parse_command(command, dlist):
 
   if dlist[0] == 'call':
 
-    file = command.split('=')[1].strip()
-    if '"' in file or "'" in file:
-      file = file.replace('"', '').replace("'", '')
-    else:
-      file = file.lower()    
+    file = call_file_name(command)
+
+    # Use the conversion done by a worker process if there is one. Not done if there is something
+    # after the call on the same line since that would be parsed as part of the called file.
+
+    if file in common.file_jobs and not common.more_on_line:
+      result = common.file_jobs[file].get()
+      if result is not None:
+        f_out.write(f'call, file = {bmad_file_name(file)}\n')
+        merge_file_job(file, result)
+        return
 
     common.f_in.append(open(file, 'r'))  # Store file handle
+    common.files_read.append(file)
     if common.one_file:
       f_out.write(f'\n! In File: {common.f_in[-1].name}\n')
     else:
       f_out.write(f'call, file = {bmad_file_name(file)}\n')
       common.f_out.append(open(bmad_file_name(file), 'w'))
+      common.files_written.append(bmad_file_name(file))
     return
 
   # Use
@@ -1191,27 +1232,50 @@ def parse_command(command, dlist):
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
-# Get next madx command.
+# Generator for madx commands.
 # Read in MADX file line-by-line.  Assemble lines into commands, which are delimited by a ; (colon).
-
-def read_madx_command ():
+# Yields (command, dlist) for each command. Stops when the root file has been read.
+#
+# Each line is scanned with a regular expression that finds the next character that needs attention
+# (delimiter, quote mark, comment start, etc.). The position in the line is kept in ix0 so the line is
+# never rebuilt while it is being scanned.
+
+re_blank = re.compile(r'\s*')
+re_scan_first = re.compile(r'[{}"\'!;:,=(]|/[*/]')   # Start of command: Also split "if(" or "while(" constructs at "(".
+re_scan = re.compile(r'[{}"\'!;:,=]|/[*/]')
+re_scan_string = {'"': re.compile(r'[{}"]'), "'": re.compile(r"[{}']")}   # Inside a quoted string.
+
+def read_madx_commands ():
   global common
 
-  quote_delim = ''  # Quote mark delimiting a string. Blank means not parsing a string yet.
+  line = ''                # Line being parsed.
+  ix0 = 0                  # Start of the part of the line not yet used.
+  quote_delim = ''         # Quote mark delimiting a string. Blank means not parsing a string yet.
+  quote_str = ''           # String being parsed including the starting quote mark.
   in_extended_comment = False
-  command = ''
+  command = []             # Pieces of the command.
   dlist = []
-  curly_brace_count = 0   # Count "{", "}" pairs
+  curly_brace_count = 0    # Count "{", "}" pairs
+
+  # Add the text before a delimiter, etc. to the command.
 
-  # Loop until a command has been found.
+  def add_text(text):
+    command.append(text)
+    if text.strip() != '': dlist.append(text.strip().lower())
+
+  # Loop over lines.
   # Note: "macro" and "if" statements are strange since they are permitted to 
   # not end with a ';' but with a matching '}'
 
   while True:
 
-    # Get a line
+    # Get a line. Start with what is left of the current line after the last command.
+
+    if ix0 < len(line):
+      f_out = common.f_out[-1]
+      ix0 = re_blank.match(line, ix0).end()
 
-    if common.command == '':
+    else:
       while True:
         f_in = common.f_in[-1]
         f_out = common.f_out[-1]
@@ -1224,122 +1288,298 @@ def read_madx_command ():
         if not common.one_file:
           common.f_out[-1].close()
           common.f_out.pop()       # Remove last file handle
-        if len(common.f_in) == 0: return ['', dlist]  # If root file was closed
+        if len(common.f_in) == 0:         # If root file was closed
+          common.partial_command = (len(command) > 0)
+          return
 
-    else:
-      f_in = common.f_in[-1]
-      f_out = common.f_out[-1]
-      line = common.command
-      common.command = ''
+      line = line.strip()
+      ix0 = 0
 
     # Parse line
 
-    line = line.strip()
-    if line.strip() == '':
+    if ix0 == len(line):
       f_out.write('\n')
       continue
 
-    if len(line) > 1 and line[0:2] == '#!':   # "#!madx" line
-      f_out.write('! ' + line + '\n')
-      line = ''
+    if line.startswith('#!', ix0):   # "#!madx" line
+      f_out.write('! ' + line[ix0:] + '\n')
+      ix0 = len(line)
       continue
 
     if in_extended_comment:
-      if '*/' in line:
-        ix = line.find('*/')
+      ix = line.find('*/')
+      if ix > -1:
         f_out.write('! ' + line[:ix] + '\n')
-        line = line[ix+2:].strip()
         in_extended_comment = False
       else:
         f_out.write ('! ' + line + '\n')
-        line = ''
+      ix0 = len(line)
       continue
 
-    while line != '':
-      for ix in range(len(line)):
-        #print (f'Ix: {ix} {line[ix]} -{quote_delim}- ' + line)
-        #print (f'C: {command}')
-        #print (f'D: {dlist}')
-
-        if line[ix] == '{': curly_brace_count += 1
-        if line[ix] == '}': 
-          curly_brace_count -= 1
-          if curly_brace_count == 0 and len(dlist) > 0 and (dlist[0] in ['if', 'elseif', 'else' 'while'] or 'macro' in dlist):
-            command += line[:ix]
-            if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-            common.command = line[ix+1:]
-            return [command, dlist]
-
-        if (line[ix] == '"' or line[ix] == "'"):
-          if line[ix] == quote_delim:      # Found end of string
-            command += quote_delim + line[:ix+1]
-            dlist.append(quote_delim + line[:ix+1])
-            line = line[ix+1:]
-            quote_delim = ''
-            break
-
-          elif quote_delim == '':          # Found start of string
-            quote_delim = line[ix]
-            command += line[:ix]
-            if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-            line = line[ix+1:]
-            break
-
-        if quote_delim != '': continue    # Cycle if in quote string
-
-        if line[ix] == '!':
-          if len(line) > ix+10 and line[ix:ix+10] == '!!verbatim':
-            f_out.write(line[ix+10:].strip() + '\n')
-          else:
-            f_out.write(line[ix:] + '\n')
-          command += line[:ix]
-          if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-          line = ''
-          break
+    ix = ix0    # Where to start looking for the next character of interest.
 
-        # "if" or "macro" commands can have internal ";" characters that need to be ignored.
-        elif line[ix] == ';' and not ((len(dlist) > 0 and dlist[0] in ['if', 'elseif', 'else', 'while']) or 'macro' in dlist):
-          command += line[:ix]
-          if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-          common.command = line[ix+1:]
-          return [command, dlist]
-
-        # Need to split "if(" or "while(" constructs at "(". 
-        # This only is necessary at the start of the command string.
-        elif line[ix] in '{}:,=' or (len(dlist) == 0 and line[ix] == '('):
-          command += line[:ix+1]
-          if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-          dlist.append(line[ix])
-          line = line[ix+1:]
-          break
+    while ix0 < len(line):
+      if quote_delim != '':
+        match = re_scan_string[quote_delim].search(line, ix)
+      elif len(dlist) == 0:
+        match = re_scan_first.search(line, ix)
+      else:
+        match = re_scan.search(line, ix)
 
-        elif ix == len(line) - 1:
-          command += line
-          dlist.append(line.strip())
-          line = ''
-          break
+      # Nothing of interest in the rest of the line.
 
-        if ix > len(line) - 2: continue
+      if match is None:
+        if quote_delim == '':
+          command.append(line[ix0:])
+          dlist.append(line[ix0:].strip())
+        else:                               # String continued on next line
+          quote_str += line[ix0:] + ' '
+        ix0 = len(line)
+        break
 
-        if line[ix:ix+2] == '/*':
-          command += line[:ix]
-          if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
-          if '*/' in line[ix:]:
-            ix2 = line.find('*/', ix)
-            f_out.write('!' + line[ix+2:ix2] + '\n')
-            line = line[ix+3:]
-          else:
-            f_out.write('!' + line[ix+2:] + '\n')
-            line = ''
-            in_extended_comment = True
+      ix = match.start()
+      char = line[ix]
+
+      if char == '{': curly_brace_count += 1
+      if char == '}': 
+        curly_brace_count -= 1
+        if curly_brace_count == 0 and len(dlist) > 0 and (dlist[0] in ['if', 'elseif', 'else' 'while'] or 'macro' in dlist):
+          add_text(line[ix0:ix])
+          ix0 = ix + 1
+          common.more_on_line = (ix0 < len(line))
+          yield ''.join(command), dlist
+          quote_delim, in_extended_comment, command, dlist, curly_brace_count = '', False, [], [], 0
           break
 
-        elif line[ix:ix+2] == '//':
-          command += line[:ix]
-          if line[:ix].strip() != '': dlist.append(line[:ix].strip().lower())
+      if (char == '"' or char == "'"):
+        if char == quote_delim:      # Found end of string
+          command.append(quote_str + line[ix0:ix+1])
+          dlist.append(quote_str + line[ix0:ix+1])
+          quote_delim = ''
+
+        else:                        # Found start of string
+          quote_delim = char
+          quote_str = char
+          add_text(line[ix0:ix])
+
+        ix0 = ix = ix + 1
+        continue
+
+      if quote_delim != '':          # "{" or "}" in quote string
+        ix += 1
+        continue
+
+      if char == '!':
+        if len(line) > ix+10 and line[ix:ix+10] == '!!verbatim':
+          f_out.write(line[ix+10:].strip() + '\n')
+        else:
+          f_out.write(line[ix:] + '\n')
+        add_text(line[ix0:ix])
+        ix0 = len(line)
+        break
+
+      # "if" or "macro" commands can have internal ";" characters that need to be ignored.
+      elif char == ';':
+        if not ((len(dlist) > 0 and dlist[0] in ['if', 'elseif', 'else', 'while']) or 'macro' in dlist):
+          add_text(line[ix0:ix])
+          ix0 = ix + 1
+          common.more_on_line = (ix0 < len(line))
+          yield ''.join(command), dlist
+          quote_delim, in_extended_comment, command, dlist, curly_brace_count = '', False, [], [], 0
+          break
+        ix += 1
+
+      elif char in '{}:,=(':
+        add_text(line[ix0:ix])
+        command.append(char)
+        dlist.append(char)
+        ix0 = ix = ix + 1
+
+      elif line[ix+1] == '*':        # "/*" comment
+        add_text(line[ix0:ix])
+        ix2 = line.find('*/', ix)
+        if ix2 > -1:
+          f_out.write('!' + line[ix+2:ix2] + '\n')
+          ix0 = ix = ix + 3
+        else:
           f_out.write('!' + line[ix+2:] + '\n')
-          line = ''
+          ix0 = len(line)
+          in_extended_comment = True
+
+      else:                          # "//" comment
+        add_text(line[ix0:ix])
+        f_out.write('!' + line[ix+2:] + '\n')
+        ix0 = len(line)
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Find the files called, directly or indirectly, by a MADX file. Used with the -j option.
+# This is a quick scan for "call" statements. A call that is missed just means that the
+# called file is not converted by a worker process.
+
+re_call = re.compile(r'(?:^|;)\s*(call\s*,?\s*file\s*=[^;]*)', re.IGNORECASE | re.MULTILINE)
+
+def called_files(madx_file, file_list):
+
+  try:
+    with open(madx_file, 'r') as f:
+      text = f.read()
+  except (OSError, UnicodeDecodeError):
+    return
+
+  for match in re_call.finditer(text):
+    file = call_file_name(match.group(1))
+    if file in file_list: continue
+    file_list.append(file)
+    called_files(file, file_list)
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Convert a called MADX file in a worker process. Used with the -j option.
+# The file is converted by itself to the temporary file tmp_file which is named by the parent process so that
+# the parent can remove it if it is not used.
+#
+# Returns [tmp_file, var_name_list, var_def_list, super_list] if the file is independent of the other files.
+# That is, if the file only has commands, like variable definitions, whose translation does not depend upon
+# or change what has been defined in other files. Otherwise None is returned and the parent process 
+# converts the file when the call is reached.
+
+def convert_file_job(args):
+  global common
+
+  madx_file, tmp_file, superimpose_eles, prepend_vars = args
+
+  common = common_struct()
+  common.superimpose_eles = superimpose_eles
+  common.prepend_vars = prepend_vars
+  common.one_file = False
+  common.var_name_list = []
+
+  output = io.StringIO()
+  independent = True
+
+  try:
+    common.f_in.append(open(madx_file, 'r'))
+    common.f_out.append(open(tmp_file, 'w'))
+
+    # Anything printed means the translation involves something that may depend upon other files.
+
+    with contextlib.redirect_stdout(output):
+      for command, dlist in read_madx_commands():
+        if len(dlist) > 0 and (dlist[0].split()[0] in ['call', 'return', 'exit', 'quit', 'stop', 'use', 'install', 'endedit'] or
+                                                                                         '->' in command):
+          independent = False
           break
+        parse_command(command, dlist)
+
+  except Exception:
+    independent = False
+
+  for f in common.f_in + common.f_out: f.close()
+
+  if not independent or output.getvalue() != '' or common.partial_command or len(common.ele_dict) > 0 or \
+          len(common.seq_dict) > 0 or common.in_seq or common.in_match or common.in_track or \
+          common.seqedit_name != '' or common.drift_count > 0:
+    if os.path.exists(tmp_file): os.remove(tmp_file)
+    return None
+
+  return [tmp_file, common.var_name_list, common.var_def_list, common.super_list]
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Merge the result of convert_file_job with the results of the conversion so far.
+
+def merge_file_job(file, result):
+
+  tmp_file, var_name_list, var_def_list, super_list = result
+
+  if tmp_file is not None:       # Not done if the file has been called before.
+    os.replace(tmp_file, bmad_file_name(file))
+    result[0] = None
+
+  common.files_read.append(file)
+  common.files_written.append(bmad_file_name(file))
+
+  for name in var_name_list:
+    add_var_name(name)
+
+  common.var_def_list += var_def_list
+  common.super_list += super_list
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Conversion cache.
+#
+# After a conversion, a manifest file is written next to the Bmad lattice file. The manifest records the
+# conversion options along with the sha1 hashes of this script, of every MADX file read and of every
+# Bmad file written. If nothing has changed since the manifest was written, the conversion is skipped.
+
+manifest_version = 1
+
+def file_hash(file_name):
+  with open(file_name, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def manifest_file_name(bmad_file):
+  return bmad_file + '.manifest'
+
+def manifest_files(file_list):
+  return [[os.path.abspath(file), file_hash(file)] for file in OrderedDict.fromkeys(file_list)]
+
+def conversion_options():
+  return {'version':          manifest_version,
+          'converter':        file_hash(os.path.abspath(__file__)),
+          'many_files':       not common.one_file,
+          'superimpose':      common.superimpose_eles,
+          'prepend_vars':     common.prepend_vars}
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Write the manifest file for a conversion.
+# The manifest is written to a temporary file and then renamed so that a partially written manifest is never seen.
+
+def write_manifest(bmad_lattice_file):
+
+  manifest = conversion_options()
+  manifest['input'] = manifest_files(common.files_read)
+  manifest['output'] = manifest_files(common.files_written)
+
+  manifest_file = manifest_file_name(bmad_lattice_file)
+  tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(manifest, f, indent = 1)
+  os.replace(tmp_file, manifest_file)
+
+#------------------------------------------------------------------
+#------------------------------------------------------------------
+# Returns a list of the reasons why the Bmad files of a previous conversion are out of date.
+# The list is empty if the Bmad files are up to date.
+
+def stale_reasons(bmad_lattice_file):
+
+  manifest_file = manifest_file_name(bmad_lattice_file)
+  try:
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+    files = [(file, hash, 'MADX') for file, hash in manifest.pop('input')] + \
+            [(file, hash, 'Bmad') for file, hash in manifest.pop('output')]
+    if not all(isinstance(file, str) and isinstance(hash, str) for file, hash, what in files): raise ValueError
+  except OSError:
+    return [f'No manifest file: {manifest_file}']
+  except (ValueError, KeyError, AttributeError, TypeError):   # Not JSON or not the right shape.
+    return [f'Corrupt manifest file: {manifest_file}']
+
+  if manifest != conversion_options():
+    return ['Conversion options or madx_to_bmad.py script have changed.']
+
+  reasons = []
+  for file, hash, what in files:
+    if not os.path.exists(file):
+      reasons.append(f'{what} file missing: {file}')
+    elif file_hash(file) != hash:
+      reasons.append(f'{what} file changed: {file}')
+
+  return reasons
 
 #------------------------------------------------------------------
 #------------------------------------------------------------------
@@ -1352,8 +1592,10 @@ start_time = time.time()
 
 argp = argparse.ArgumentParser()
 argp.add_argument('madx_file', help = 'Name of input MADX lattice file')
+argp.add_argument('-c', '--check', help = 'Report if the Bmad files are out of date without converting.', action = 'store_true')
 argp.add_argument('-d', '--debug', help = 'Print debug info (not of general interest).', action = 'store_true')
 argp.add_argument('-f', '--many_files', help = 'Create a Bmad file for each MADX input file.', action = 'store_true')
+argp.add_argument('-j', '--jobs', help = 'With -f, number of processes used to convert called files.', type = int, default = 1)
 argp.add_argument('-s', '--superimpose', help = 'Superimpose elements in a sequence.', action = 'store_true')
 argp.add_argument('-v', '--no_prepend_vars', help = 'Do not move variables to the beginning of the Bmad file.', action = 'store_true')
 arg = argp.parse_args()
@@ -1370,48 +1612,98 @@ bmad_lattice_file = bmad_file_name(madx_lattice_file)
 print ('Input lattice file is:  ' + madx_lattice_file)
 print ('Output lattice file is: ' + bmad_lattice_file)
 
-# Open files for reading and writing
+# Skip the conversion if the Bmad files of a previous conversion are up to date.
+# With --check, the exit status is 1 if the Bmad files are out of date.
 
-common.f_in.append(open(madx_lattice_file, 'r'))  # Store file handle
-common.f_out.append(open(bmad_lattice_file, 'w'))
+reasons = stale_reasons(bmad_lattice_file)
 
-f_out = common.f_out[-1]
+if arg.check:
+  if len(reasons) == 0:
+    print ('Bmad files are up to date.')
+  else:
+    print ('Bmad files are out of date:')
+    for reason in reasons: print ('  ' + reason)
+  sys.exit(0 if len(reasons) == 0 else 1)
+
+if len(reasons) == 0:
+  print ('Bmad files are up to date. Conversion skipped.')
+  sys.exit()
+
+if os.path.exists(manifest_file_name(bmad_lattice_file)): os.remove(manifest_file_name(bmad_lattice_file))
+
+# With -f and -j, start the conversion of called files by worker processes.
+# The worker processes are forked before any output files are opened.
+
+pool = None
+job_tmp_files = []
+if arg.many_files and arg.jobs > 1 and not arg.debug and 'fork' in multiprocessing.get_all_start_methods():
+  file_list = []
+  called_files(madx_lattice_file, file_list)
+  if len(file_list) > 0:
+    sys.stdout.flush()
+    pool = multiprocessing.get_context('fork').Pool(min(arg.jobs, len(file_list)))
+    for ix, file in enumerate(file_list):
+      job_tmp_files.append(f'{bmad_file_name(file)}.{os.getpid()}.{ix}.tmp')
+      common.file_jobs[file] = pool.apply_async(convert_file_job,
+                                                [[file, job_tmp_files[-1], common.superimpose_eles, common.prepend_vars]])
+
+# Open files for reading and writing.
+# The body of the Bmad lattice file is written to a spill file. The header with the prepended variables and
+# superposition statements, which is only known at the end, is then written to the lattice file followed by
+# a copy of the spill file. This way the lattice file never has to be read into memory.
+# The spill file and the output of worker processes that was not used are removed even if the conversion fails.
+
+spill_file = f'{bmad_lattice_file}.{os.getpid()}.tmp'
+
+try:
+  common.f_in.append(open(madx_lattice_file, 'r'))  # Store file handle
+  common.f_out.append(open(spill_file, 'w'))
+  common.files_read.append(madx_lattice_file)
+  common.files_written.append(bmad_lattice_file)
 
-#------------------------------------------------------------------
-# parse, convert and output madx commands
+  f_out = common.f_out[-1]
 
-common.command = ''  # init
+  #------------------------------------------------------------------
+  # parse, convert and output madx commands
 
-while True:
-  [command, dlist] = read_madx_command()
-  if len(common.f_in) == 0: break
-  parse_command(command, dlist)
-  if len(common.f_in) == 0: break   # Hit Quit/Exit/Stop statement.
+  for command, dlist in read_madx_commands():
+    parse_command(command, dlist)
+    if len(common.f_in) == 0: break   # Hit Quit/Exit/Stop statement.
 
-f_out.close()
+  f_out.close()
 
-#------------------------------------------------------------------
-# Prepend variables and superposition statements as needed
+  #------------------------------------------------------------------
+  # Prepend variables and superposition statements as needed
+
+  f_out = open(bmad_lattice_file, 'w')
+  f_out.write (f'!+\n! Translated from MADX to Bmad by madx_to_bmad.py\n! File: {madx_lattice_file}\n!-\n\n')
+
+  if common.prepend_vars:
+    order_var_def_list()
+    for vdef in common.var_def_list:
+      wrap_write(f'{vdef[0]} = {vdef[1]}\n', f_out)
+    f_out.write('\n')
+
+  if len(common.super_list) > 0:
+    for line in common.super_list:
+      f_out.write(line)
+    f_out.write('\n')
 
-f_out = open(bmad_lattice_file, 'r')
-lines = f_out.readlines()
-f_out.close()
+  with open(spill_file, 'r') as f_spill:
+    shutil.copyfileobj(f_spill, f_out, 1 << 20)
 
-f_out = open(bmad_lattice_file, 'w')
-f_out.write (f'!+\n! Translated from MADX to Bmad by madx_to_bmad.py\n! File: {madx_lattice_file}\n!-\n\n')
+  f_out.close()
 
-if common.prepend_vars:
-  order_var_def_list()
-  for vdef in common.var_def_list:
-    wrap_write(f'{vdef[0]} = {vdef[1]}\n', f_out)
-  f_out.write('\n')
+finally:
+  if os.path.exists(spill_file): os.remove(spill_file)
 
-if len(common.super_list) > 0:
-  for line in common.super_list:
-    f_out.write(line)
-  f_out.write('\n')
+  # Stop the worker processes and remove their output that was not used. Output that was used has been
+  # renamed by merge_file_job.
 
-for line in lines:
-  f_out.write(line)
+  if pool is not None:
+    pool.terminate()
+    pool.join()
+    for tmp_file in job_tmp_files:
+      if os.path.exists(tmp_file): os.remove(tmp_file)
 
-f_out.close()
+write_manifest(bmad_lattice_file)